@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import localtime
+
+from .metrics import ALERTS_FAILED, ALERTS_SENT
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SensorState:
+    OK = "ok"
+    LOW = "low"
+    HIGH = "high"
+
+
+def format_alert(sensor, value, timestamp, title):
+    timestamp = localtime(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        f"{title}\n"
+        f"📊 Сенсор: {sensor.name}\n"
+        f"📦​ Тип: {sensor.type}\n"
+        f"📈 Значение: {value} {sensor.unit_of_measurements} \n"
+        f"📟 Контроллер: {sensor.controller.name}\n"
+        f"🌿 Компания: {sensor.controller.company.name}\n"
+        f"Время: {timestamp}"
+    )
+
+
+class AlertDispatcher:
+    """
+    Отправляет уведомления в Telegram из фонового потока.
+
+    Уведомление уходит только при смене состояния датчика (норма / ниже
+    ``critical_min`` / выше ``critical_max``) и затем повторяется раз в
+    ``ALERT_REMINDER_INTERVAL`` секунд, пока значение остаётся критическим.
+    Чтобы значение у самой границы не вызывало серию переходов, выход из
+    критического состояния требует запаса ``ALERT_HYSTERESIS``.
+    """
+
+    def __init__(self):
+        self.api_url = getattr(settings, "TELEGRAM_API_URL", "https://api.telegram.org")
+        self.timeout = getattr(settings, "ALERT_TIMEOUT", 5)
+        self.reminder_interval = getattr(settings, "ALERT_REMINDER_INTERVAL", 900)
+        self.hysteresis = getattr(settings, "ALERT_HYSTERESIS", 0.0)
+        self.recipients_ttl = getattr(settings, "ALERT_RECIPIENTS_TTL", 300)
+
+        self._queue = queue.Queue(maxsize=getattr(settings, "ALERT_QUEUE_SIZE", 1000))
+        self._states = {}
+        self._states_lock = threading.Lock()
+        self._recipients = {}
+        self._thread = None
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=2))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=2))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def check(self, sensor, value, timestamp):
+        current = time.monotonic()
+
+        with self._states_lock:
+            previous, last_sent = self._states.get(sensor.pk, (SensorState.OK, None))
+            state = self._evaluate(sensor, value, previous)
+
+            if state != previous:
+                title = "✅ Значение вернулось в норму" if state == SensorState.OK else "⚠️ Критическое значение!"
+            elif state != SensorState.OK and self.reminder_interval and current - last_sent >= self.reminder_interval:
+                title = "⏰ Значение всё ещё критическое"
+            else:
+                return
+
+            self._states[sensor.pk] = (state, current)
+
+        self.send(sensor.controller.company_id, format_alert(sensor, value, timestamp, title))
+
+    def send(self, company_id, message_text):
+        try:
+            self._queue.put_nowait((company_id, message_text))
+        except queue.Full:
+            logger.error(f"Alert queue is full, dropped alert for company {company_id}")
+            ALERTS_FAILED.labels("queue_full").inc()
+
+    def _evaluate(self, sensor, value, previous):
+        low = sensor.critical_min
+        high = sensor.critical_max
+
+        if low is not None and value < low:
+            return SensorState.LOW
+        if high is not None and value > high:
+            return SensorState.HIGH
+
+        # Гистерезис: остаёмся в критическом состоянии, пока значение у границы
+        if previous == SensorState.LOW and low is not None and value < low + self.hysteresis:
+            return SensorState.LOW
+        if previous == SensorState.HIGH and high is not None and value > high - self.hysteresis:
+            return SensorState.HIGH
+        return SensorState.OK
+
+    def _get_recipients(self, company_id):
+        entry = self._recipients.get(company_id)
+        if entry is not None and time.monotonic() - entry[1] < self.recipients_ttl:
+            return entry[0]
+
+        recipients = list(
+            User.objects.filter(company_id=company_id, role=User.Role.MANAGER, telegram_id__isnull=False)
+            .exclude(telegram_id='')
+            .values_list("telegram_id", "email")
+        )
+        self._recipients[company_id] = (recipients, time.monotonic())
+        return recipients
+
+    def _deliver(self, company_id, message_text):
+        for telegram_id, email in self._get_recipients(company_id):
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
+                    json={
+                        "chat_id": telegram_id,
+                        "text": message_text,
+                    },
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+                ALERTS_SENT.inc()
+            except Exception as e:
+                logger.error(f"Error sending Telegram message to {email}: {e}")
+                ALERTS_FAILED.labels("error").inc()
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                try:
+                    self._deliver(*item)
+                except Exception:
+                    logger.exception("Alert delivery error")
+        finally:
+            connection.close()
+
+
+class AsyncAlertDispatcher(AlertDispatcher):
+    """
+    Те же правила отбора уведомлений, но доставка — задача event loop:
+    запросы к Telegram идут через httpx без блокировки цикла, получателям
+    одной компании — параллельно. ``start()`` вызывается внутри работающего цикла.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._queue = asyncio.Queue(maxsize=getattr(settings, "ALERT_QUEUE_SIZE", 1000))
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def send(self, company_id, message_text):
+        try:
+            self._queue.put_nowait((company_id, message_text))
+        except asyncio.QueueFull:
+            logger.error(f"Alert queue is full, dropped alert for company {company_id}")
+            ALERTS_FAILED.labels("queue_full").inc()
+
+    async def _post(self, http, telegram_id, email, message_text):
+        try:
+            response = await http.post(
+                f"{self.api_url}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
+                json={
+                    "chat_id": telegram_id,
+                    "text": message_text,
+                },
+            )
+            response.raise_for_status()
+            ALERTS_SENT.inc()
+        except Exception as e:
+            logger.error(f"Error sending Telegram message to {email}: {e}")
+            ALERTS_FAILED.labels("error").inc()
+
+    async def _run(self):
+        transport = httpx.AsyncHTTPTransport(retries=2)
+        async with httpx.AsyncClient(transport=transport, timeout=self.timeout) as http:
+            while True:
+                item = await self._queue.get()
+                if item is _STOP:
+                    break
+                company_id, message_text = item
+                try:
+                    recipients = await sync_to_async(self._get_recipients)(company_id)
+                    await asyncio.gather(
+                        *(self._post(http, telegram_id, email, message_text) for telegram_id, email in recipients)
+                    )
+                except Exception:
+                    logger.exception("Alert delivery error")
@@ -0,0 +1,487 @@
+"""
+Приём MQTT на asyncio — альтернатива пулу потоков из ``mqtt_client``.
+
+Сетевой ввод-вывод paho ведёт event loop (``add_reader``/``add_writer`` на
+сокет клиента), а обработка показаний — конвейер задач, связанных
+ограниченными очередями::
+
+    MQTT -> decode -> evaluate -> batch -> write
+
+* ``decode`` — разбор топика и полезной нагрузки, поиск датчика в реестре;
+* ``evaluate`` — время показания, статус, живой поток и проверка порогов;
+* ``batch`` — сборка пачек по размеру или задержке;
+* ``write`` — запись пачки ``store_messages`` в выделенном потоке БД.
+
+Полная очередь останавливает чтение сокета, так что перегрузка доходит до
+брокера, а не приводит к потере сообщений. Стадии однопоточные, поэтому
+порядок показаний сохраняется. Init, команды и статусы реле редки и
+выполняются обработчиками ``mqtt_client`` в потоке БД.
+"""
+import asyncio
+import collections
+import logging
+import math
+import signal
+import time
+
+import paho.mqtt.client as mqtt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from . import logs, metrics, mqtt_client
+from .alerts import AsyncAlertDispatcher
+from .codecs import decode_batch, decode_reading
+from .ingest import resolve_timestamp, store_messages
+from .latest import make_record
+from .live import get_broker
+from .metrics import (
+    DB_FLUSH_FAILURES, MQTT_DECODED, MQTT_DROPPED, MQTT_HANDLER_SECONDS, MQTT_RECEIVED, READINGS_DROPPED, mqtt_topic_type,
+)
+from .models import Controller, Message, Sensor
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _in_loop(loop, callback, *args):
+    """Вызывает callback сразу в потоке цикла, из других потоков — через call_soon_threadsafe."""
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        callback(*args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+
+class AsyncIngestEngine:
+    def __init__(
+        self, queue_size=None, batch_size=None, batch_delay=None, store=None, max_pending=None, retry_max_delay=None,
+    ):
+        self.queue_size = queue_size or getattr(settings, "MQTT_QUEUE_SIZE", 1000)
+        self.batch_size = batch_size or getattr(settings, "MQTT_BUFFER_SIZE", 500)
+        self.batch_delay = batch_delay or getattr(settings, "MQTT_BUFFER_DELAY", 0.2)
+        self.store = store or store_messages
+        # Те же пределы, что у MessageBuffer в движке на потоках
+        self.max_pending = max_pending or getattr(settings, "MQTT_BUFFER_MAX_PENDING", 50000)
+        self.retry_max_delay = retry_max_delay or getattr(settings, "MQTT_BUFFER_RETRY_MAX_DELAY", 30)
+
+        self.alert_dispatcher = AsyncAlertDispatcher()
+
+        self._inbox = None
+        self._readings = None
+        self._messages = None
+        self._batches = None
+        self._tasks = []
+
+        self._client = None
+        self._socket = None
+        self._overflow = None
+        self._stopping = None
+
+        self._received = 0
+        self._stored = 0
+        self._duplicates = 0
+        self._failed = 0
+        # Задержка от приёма до записи в БД по последним показаниям
+        self._latencies = collections.deque(maxlen=100000)
+
+    # Конвейер
+
+    def start(self):
+        """Запускает стадии конвейера; вызывается внутри работающего цикла."""
+        if self._tasks:
+            return
+        self._inbox = asyncio.Queue(self.queue_size)
+        self._readings = asyncio.Queue(self.queue_size)
+        self._messages = asyncio.Queue(self.queue_size)
+        # Пока пишется одна пачка, следующая уже собирается, больше не копится
+        self._batches = asyncio.Queue(2)
+
+        loop = asyncio.get_running_loop()
+        self._tasks = [
+            loop.create_task(self._decode(), name="ingest-decode"),
+            loop.create_task(self._evaluate(), name="ingest-evaluate"),
+            loop.create_task(self._batch(), name="ingest-batch"),
+            loop.create_task(self._write(), name="ingest-write"),
+        ]
+        self.alert_dispatcher.start()
+
+    async def feed(self, msg):
+        """Кладёт сообщение в конвейер, дожидаясь места в очереди."""
+        self._received += 1
+        MQTT_RECEIVED.labels(mqtt_topic_type(msg.topic)).inc()
+        await self._inbox.put((msg, time.perf_counter()))
+
+    async def stop(self):
+        """Дорабатывает всё, что уже в очередях, и записывает последнюю пачку."""
+        if not self._tasks:
+            return
+        await self._inbox.put(_STOP)
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+        await self.alert_dispatcher.stop()
+        logger.info(f"Async engine stopped: {self.stats()}")
+
+    def queue_depth(self):
+        queues = (self._inbox, self._readings, self._messages, self._batches)
+        return sum(q.qsize() for q in queues if q is not None)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(q):
+            return latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else 0.0
+
+        return {
+            "received": self._received,
+            "stored": self._stored,
+            "duplicates": self._duplicates,
+            "failed": self._failed,
+            "queue_depth": self.queue_depth(),
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+        }
+
+    async def _decode(self):
+        while True:
+            item = await self._inbox.get()
+            if item is _STOP:
+                await self._readings.put(_STOP)
+                return
+
+            msg, received = item
+            topic_parts = msg.topic.split("/")
+            topic_type = mqtt_topic_type(msg.topic)
+            started = time.perf_counter()
+            try:
+                if topic_type == "init":
+                    await sync_to_async(mqtt_client.handle_init)(None, None, msg)
+                elif topic_type == "command":
+                    await sync_to_async(mqtt_client.handle_command)(None, None, msg)
+                elif topic_type == "status":
+                    await sync_to_async(mqtt_client.handle_relay_status)(None, None, msg)
+                elif topic_type == "batch":
+                    await self._decode_batch(topic_parts[1], msg, received)
+                else:
+                    sensor = await self._sensor(topic_parts[1], topic_parts[3])
+                    value, ts = decode_reading(sensor.controller.payload_encoding, msg.payload)
+                    MQTT_DECODED.labels(topic_type).inc()
+                    await self._readings.put((sensor, float(value), ts, received))
+            except (Controller.DoesNotExist, Sensor.DoesNotExist):
+                logger.warning(
+                    "Unknown controller or sensor on topic '%s'", msg.topic, extra={"log_key": topic_parts[1]},
+                )
+                MQTT_DROPPED.labels(topic_type, "unknown").inc()
+                self._failed += 1
+            except Exception:
+                logger.exception(f"Failed to decode message on topic '{msg.topic}'")
+                MQTT_DROPPED.labels(topic_type, "invalid").inc()
+                self._failed += 1
+            # Время ожидания места в следующей очереди сюда тоже входит, как и в пуле потоков
+            MQTT_HANDLER_SECONDS.labels(topic_type).observe(time.perf_counter() - started)
+
+    async def _decode_batch(self, controller_uuid, msg, received):
+        controller = registry.peek_controller(controller_uuid)
+        if controller is None:
+            controller = await sync_to_async(registry.get_controller)(controller_uuid)
+
+        readings = decode_batch(controller.payload_encoding, msg.payload)
+        MQTT_DECODED.labels("batch").inc()
+        for sensor_uuid, value, ts in readings:
+            try:
+                sensor = await self._sensor(controller_uuid, sensor_uuid)
+            except Sensor.DoesNotExist:
+                logger.warning(
+                    "Unknown sensor '%s' in batch from controller '%s'", sensor_uuid, controller_uuid,
+                    extra={"log_key": controller_uuid},
+                )
+                self._failed += 1
+                continue
+            if not math.isfinite(value):
+                logger.warning(
+                    "Invalid reading of sensor '%s' in batch: value must be finite, got %s", sensor_uuid, value,
+                    extra={"log_key": controller_uuid},
+                )
+                MQTT_DROPPED.labels("batch", "invalid").inc()
+                self._failed += 1
+                continue
+            await self._readings.put((sensor, value, ts, received))
+
+    async def _sensor(self, controller_uuid, sensor_uuid):
+        # Обычно датчик уже в кэше, в поток БД уходят только промахи
+        sensor = registry.peek_sensor(controller_uuid, sensor_uuid)
+        if sensor is None:
+            sensor = await sync_to_async(registry.get_sensor)(controller_uuid, sensor_uuid)
+        return sensor
+
+    async def _evaluate(self):
+        broker = get_broker()
+        while True:
+            item = await self._readings.get()
+            if item is _STOP:
+                await self._messages.put(_STOP)
+                return
+
+            sensor, value, ts, received = item
+            try:
+                received_at = now()
+                timestamp = resolve_timestamp(ts, received_at)
+                message = Message(sensor=sensor, value=value, status=sensor.get_status(value), timestamp=timestamp)
+
+                # Запоздавшие показания только сохраняются, как и в mqtt_client
+                if received_at - timestamp <= mqtt_client.LATE_THRESHOLD:
+                    broker.publish(make_record(message))
+                    self.alert_dispatcher.check(sensor, value, timestamp)
+            except Exception:
+                logger.exception(f"Failed to evaluate reading of sensor '{sensor.uuid}'")
+                self._failed += 1
+                continue
+            await self._messages.put((message, received))
+
+    async def _batch(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = self._messages.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                try:
+                    item = await asyncio.wait_for(self._messages.get(), timeout)
+                except asyncio.TimeoutError:
+                    item = None
+
+            if item is _STOP:
+                if batch:
+                    await self._batches.put(batch)
+                await self._batches.put(_STOP)
+                return
+            if item is not None:
+                if not batch:
+                    deadline = loop.time() + self.batch_delay
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or (batch and loop.time() >= deadline):
+                await self._batches.put(batch)
+                batch = []
+                deadline = None
+
+    async def _write(self):
+        """
+        Пишет пачки. Неудавшаяся запись не теряет показания: они остаются в
+        ``pending`` и повторяются с удваивающейся задержкой до ``retry_max_delay``,
+        а новые пачки тем временем добавляются к ним (не больше ``max_pending``,
+        самые старые сверх этого отбрасываются). После остановки делается не
+        больше ``stop_attempts`` попыток.
+        """
+        loop = asyncio.get_running_loop()
+        store = sync_to_async(self._store)
+        pending = []
+        retry_delay = 0
+        retry_at = None
+        stopping = False
+        stop_attempts = 3
+        while True:
+            if not stopping:
+                timeout = None if retry_at is None else max(retry_at - loop.time(), 0)
+                try:
+                    batch = await asyncio.wait_for(self._batches.get(), timeout)
+                except asyncio.TimeoutError:
+                    batch = []
+                if batch is _STOP:
+                    stopping = True
+                else:
+                    self._hold(pending, batch)
+                    if retry_at is not None and loop.time() < retry_at:
+                        continue
+            if not pending:
+                return
+
+            messages = [message for message, _ in pending]
+            try:
+                stored = await store(messages)
+            except Exception:
+                logger.exception("Failed to store %d messages", len(messages))
+                DB_FLUSH_FAILURES.inc()
+                retry_delay = min(max(retry_delay * 2, self.batch_delay), self.retry_max_delay)
+                retry_at = loop.time() + retry_delay
+                if stopping:
+                    stop_attempts -= 1
+                    if not stop_attempts:
+                        logger.error("Dropped %d messages on shutdown, database unavailable", len(pending))
+                        READINGS_DROPPED.inc(len(pending))
+                        self._failed += len(pending)
+                        return
+                    await asyncio.sleep(retry_delay)
+                else:
+                    logger.warning("Retrying %d messages in %.1fs", len(pending), retry_delay)
+                continue
+
+            retry_delay = 0
+            retry_at = None
+            done = time.perf_counter()
+            self._latencies.extend(done - received for _, received in pending)
+            self._stored += len(stored)
+            self._duplicates += len(messages) - len(stored)
+            pending = []
+            if stopping:
+                return
+
+    def _hold(self, pending, batch):
+        pending.extend(batch)
+        overflow = len(pending) - self.max_pending
+        if overflow > 0:
+            del pending[:overflow]
+            logger.warning(
+                "Over %d messages wait for the database, dropped %d oldest", self.max_pending, overflow,
+                extra={"log_key": "overflow"},
+            )
+            READINGS_DROPPED.inc(overflow)
+            self._failed += overflow
+
+    def _store(self, messages):
+        close_old_connections()
+        return self.store(messages, self.batch_size)
+
+    # MQTT
+
+    async def serve(self, host, port, subscriptions, protocol=mqtt.MQTTv311, accept=None):
+        """
+        Читает сообщения из брокера до SIGTERM/SIGINT. ``accept`` — фильтр
+        топиков для режима разбиения по хэшу.
+        """
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self.start()
+
+        client = mqtt.Client(protocol=protocol)
+        # connect() выполняется в пуле потоков: оттуда сокет регистрируется в цикле через call_soon_threadsafe
+        client.on_socket_open = lambda c, userdata, sock: _in_loop(loop, self._on_socket_open, loop, sock)
+        client.on_socket_close = lambda c, userdata, sock: _in_loop(loop, self._on_socket_close, loop, sock)
+        client.on_socket_register_write = lambda c, userdata, sock: _in_loop(loop, loop.add_writer, sock, c.loop_write)
+        client.on_socket_unregister_write = lambda c, userdata, sock: _in_loop(loop, loop.remove_writer, sock)
+        client.on_connect = lambda c, userdata, flags, rc, properties=None: self._on_connect(c, rc, subscriptions)
+        client.on_message = lambda c, userdata, msg: self._on_message(loop, msg, accept)
+        self._client = client
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # Под супервизором SIGINT игнорируется, останавливает только SIGTERM
+            if signal.getsignal(signum) is not signal.SIG_IGN:
+                loop.add_signal_handler(signum, self._stopping.set)
+
+        min_delay = getattr(settings, "MQTT_RECONNECT_MIN_DELAY", 1)
+        max_delay = getattr(settings, "MQTT_RECONNECT_MAX_DELAY", 60)
+        delay = min_delay
+        while not self._stopping.is_set():
+            try:
+                # Разрешение имени и установка TCP блокируют, в цикле их делать нельзя
+                await loop.run_in_executor(None, client.connect, host, port, 60)
+            except OSError as e:
+                logger.error(f"Failed to connect to MQTT broker {host}:{port}: {e}, retrying in {delay}s")
+                await self._wait_stopping(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+
+            connected_at = loop.time()
+            # loop_misc шлёт PINGREQ и сообщает о разрыве соединения
+            while not self._stopping.is_set() and client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await self._wait_stopping(1)
+            if self._stopping.is_set():
+                break
+
+            # Соединение, продержавшееся дольше max_delay, сбрасывает паузу; частые разрывы её наращивают
+            if loop.time() - connected_at >= max_delay:
+                delay = min_delay
+            logger.error(f"Lost connection to MQTT broker {host}:{port}, reconnecting in {delay}s")
+            await self._wait_stopping(delay)
+            delay = min(delay * 2, max_delay)
+
+        # Отписка первой, как и в mqtt_client.drain: общая группа отдаёт новые сообщения другим процессам
+        logger.info("Shutdown requested, draining")
+        client.unsubscribe(subscriptions)
+        client.disconnect()
+        await self._resume_after_overflow()
+        await self.stop()
+
+    async def _wait_stopping(self, timeout):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _on_connect(self, client, rc, subscriptions):
+        logger.info(f"Connected to MQTT broker with result code {rc}")
+        for topic in subscriptions:
+            client.subscribe(topic)
+
+    def _on_socket_open(self, loop, sock):
+        self._socket = sock
+        loop.add_reader(sock, self._client.loop_read)
+
+    def _on_socket_close(self, loop, sock):
+        loop.remove_reader(sock)
+        loop.remove_writer(sock)
+        self._socket = None
+
+    def _on_message(self, loop, msg, accept):
+        if accept is not None and not accept(msg.topic):
+            return
+        self._received += 1
+        MQTT_RECEIVED.labels(mqtt_topic_type(msg.topic)).inc()
+        item = (msg, time.perf_counter())
+        if self._overflow is not None:
+            self._overflow.append(item)
+            return
+        try:
+            self._inbox.put_nowait(item)
+        except asyncio.QueueFull:
+            # Перестаём читать сокет, пока конвейер не разгрузится: брокер придержит сообщения
+            self._overflow = collections.deque([item])
+            if self._socket is not None:
+                loop.remove_reader(self._socket)
+            loop.create_task(self._resume_after_overflow())
+
+    async def _resume_after_overflow(self):
+        if self._overflow is None:
+            return
+        while self._overflow:
+            await self._inbox.put(self._overflow.popleft())
+        self._overflow = None
+        if self._socket is not None:
+            asyncio.get_running_loop().add_reader(self._socket, self._client.loop_read)
+
+
+def start(workers=1, index=0, mode="shared", group=None):
+    """Точка входа ``startmqtt --engine asyncio``; режимы масштабирования те же, что у mqtt_client.start()."""
+    logs.configure()
+    subscriptions = list(mqtt_client.TOPICS)
+    protocol = mqtt.MQTTv311
+    accept = None
+    if workers > 1 and mode == "shared":
+        group = group or getattr(settings, "MQTT_SHARE_GROUP", "iot-ingest")
+        subscriptions = [f"$share/{group}/{topic}" for topic in mqtt_client.TOPICS]
+        protocol = mqtt.MQTTv5
+    elif workers > 1 and mode == "hash":
+        accept = lambda topic: mqtt_client.partition(topic, workers) == index
+
+    port = getattr(settings, "MQTT_METRICS_PORT", None)
+    if port:
+        metrics.start_http_server(port + index, getattr(settings, "MQTT_METRICS_ADDR", "127.0.0.1"))
+
+    registry.warm()
+    mqtt_client.relay_writer.start()
+    engine = AsyncIngestEngine()
+    metrics.MQTT_QUEUE_DEPTH.set_function(engine.queue_depth)
+    try:
+        asyncio.run(
+            engine.serve(settings.MQTT_BROKER_HOST, settings.MQTT_BROKER_PORT, subscriptions, protocol, accept)
+        )
+    finally:
+        mqtt_client.relay_writer.close()
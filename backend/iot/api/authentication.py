@@ -1,14 +1,150 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
 from rest_framework.authentication import BaseAuthentication
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import AuthenticationFailed, Throttled
 from .models import Controller
 
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class APIKeyCache:
+    """
+    LRU-кэш с TTL: sha256 ключа → контроллер. Ключи в открытом виде не хранятся,
+    у закэшированных контроллеров поле api_key не загружено.
+
+    Неизвестные ключи кэшируются как None на более короткий срок. Записи
+    сбрасываются сигналами модели Controller, изменения из других процессов
+    подхватываются по истечении TTL.
+    """
+
+    def __init__(self, max_size=None, ttl=None, negative_ttl=None):
+        self.max_size = max_size or getattr(settings, "API_KEY_CACHE_SIZE", 10000)
+        self.ttl = ttl or getattr(settings, "API_KEY_CACHE_TTL", 60)
+        self.negative_ttl = negative_ttl or getattr(settings, "API_KEY_NEGATIVE_TTL", 30)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_hash):
+        """Возвращает (найдено, контроллер или None)."""
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return False, None
+            controller, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key_hash]
+                return False, None
+            self._entries.move_to_end(key_hash)
+            return True, controller
+
+    def set(self, key_hash, controller):
+        ttl = self.ttl if controller is not None else self.negative_ttl
+        with self._lock:
+            self._entries[key_hash] = (controller, time.monotonic() + ttl)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_controller(self, controller_id, api_key=None):
+        with self._lock:
+            for key in [k for k, (obj, _) in self._entries.items() if obj is not None and obj.pk == controller_id]:
+                del self._entries[key]
+            # Новый ключ мог попасть в негативный кэш до сохранения контроллера
+            if api_key:
+                self._entries.pop(hash_api_key(api_key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FailureLimiter:
+    """Ограничивает число неверных ключей с одного адреса за окно в ``window`` секунд."""
+
+    def __init__(self, limit=None, window=None, max_clients=10000):
+        self.limit = limit or getattr(settings, "API_KEY_FAILURE_LIMIT", 20)
+        self.window = window or getattr(settings, "API_KEY_FAILURE_WINDOW", 60)
+        self.max_clients = max_clients
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, client):
+        """Сколько секунд клиенту ждать или None, если лимит не исчерпан."""
+        with self._lock:
+            entry = self._windows.get(client)
+            if entry is None:
+                return None
+            started_at, failures = entry
+            remaining = started_at + self.window - time.monotonic()
+            if remaining <= 0:
+                del self._windows[client]
+                return None
+            return remaining if failures >= self.limit else None
+
+    def fail(self, client):
+        current = time.monotonic()
+        with self._lock:
+            started_at, failures = self._windows.get(client, (current, 0))
+            if current - started_at >= self.window:
+                started_at, failures = current, 0
+            self._windows[client] = (started_at, failures + 1)
+            self._windows.move_to_end(client)
+            while len(self._windows) > self.max_clients:
+                self._windows.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+api_key_cache = APIKeyCache()
+failure_limiter = FailureLimiter()
+
+
+def client_address(request):
+    """
+    Адрес клиента. За обратным прокси REMOTE_ADDR — адрес самого прокси, поэтому
+    адрес берётся из заголовка ``CLIENT_IP_HEADER`` (например, ``HTTP_X_REAL_IP``);
+    в списке через запятую (X-Forwarded-For) доверять можно только последнему,
+    добавленному своим прокси.
+    """
+    header = getattr(settings, "CLIENT_IP_HEADER", None)
+    if header and request.META.get(header):
+        return request.META[header].split(",")[-1].strip()
+    return request.META.get("REMOTE_ADDR")
+
+
 class ControllerAPIKeyAuthentication(BaseAuthentication):
+    """
+    Аутентификация контроллера по ``X-API-Key``. Лимит неверных ключей
+    применяется только к неудавшейся проверке: верный ключ проходит, даже если
+    с того же адреса (общий NAT или прокси) кто-то перебирает ключи.
+    """
+
     def authenticate(self, request):
         api_key = request.headers.get("x-api-key")
         if not api_key:
             return None
-        try:
-            controller = Controller.objects.get(api_key=api_key)
-        except Controller.DoesNotExist:
-            raise AuthenticationFailed("Invalid API Key")
-        return (controller, None)
+
+        key_hash = hash_api_key(api_key)
+        found, controller = api_key_cache.get(key_hash)
+        if not found:
+            controller = (
+                Controller.objects.select_related("company").defer("api_key").filter(api_key=api_key).first()
+            )
+            api_key_cache.set(key_hash, controller)
+        if controller is not None:
+            return (controller, None)
+
+        client = client_address(request)
+        wait = failure_limiter.wait(client)
+        if wait is not None:
+            raise Throttled(wait)
+        failure_limiter.fail(client)
+        raise AuthenticationFailed("Invalid API Key")
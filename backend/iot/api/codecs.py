@@ -0,0 +1,106 @@
+"""
+Декодирование показаний датчиков из MQTT.
+
+Форматы (выбираются контроллером в init, поле ``encoding``):
+
+* ``json`` — ``{"value": 21.5, "ts": 1717171717.0}``, ``ts`` необязателен;
+* ``struct`` — little-endian ``<dd``: время (секунды от эпохи, 0 — нет) и значение, 16 байт;
+* ``msgpack`` — как json, но в MessagePack (нужен пакет msgpack).
+
+Если объявленный формат сервер не поддерживает, показания принимаются в
+``json``, а выбранный формат отправляется контроллеру в ``controller/<uuid>/config``.
+
+Пакетный топик ``controller/<uuid>/sensors/batch`` несёт сразу много показаний:
+
+* ``json`` — ``[{"sensor": "<uuid>", "value": 21.5, "ts": ...}, ...]``;
+* ``struct`` — подряд записи по 32 байта: uuid датчика (16 байт), время и значение (``<dd``);
+* ``msgpack`` — список ``[sensor_uuid, ts, value]``.
+
+HTTP-выгрузка накопленного (``POST /ingest/``) принимает ``struct`` и ``ndjson`` —
+по объекту json на строку.
+"""
+import importlib.util
+import json
+import math
+import struct
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+from django.utils.dateparse import parse_datetime
+
+READING = struct.Struct("<dd")
+BATCH_DTYPE = np.dtype([("sensor", "S16"), ("ts", "<f8"), ("value", "<f8")])
+
+
+def supported_encodings():
+    encodings = ["json", "struct"]
+    if importlib.util.find_spec("msgpack") is not None:
+        encodings.append("msgpack")
+    return encodings
+
+
+def _loads(encoding, payload):
+    if encoding == "msgpack":
+        import msgpack
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload.decode())
+
+
+def finite(value):
+    """Значение показания как float; NaN и бесконечность — ValueError."""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"value must be finite, got {value}")
+    return value
+
+
+def decode_reading(encoding, payload):
+    """Возвращает (value, ts), где ts — секунды от эпохи или None."""
+    if encoding == "struct":
+        ts, value = READING.unpack(payload)
+        return finite(value), ts or None
+
+    data = _loads(encoding, payload)
+    return finite(data["value"]), data.get("ts")
+
+
+def decode_batch(encoding, payload):
+    """
+    Возвращает список (sensor_uuid, value, ts). Записи с NaN и бесконечностью
+    остаются в списке — их отбрасывает получатель, чтобы учесть отказ.
+    """
+    if encoding == "struct":
+        records = np.frombuffer(payload, dtype=BATCH_DTYPE)
+        # uuid собираются один раз на датчик, а не на каждую запись
+        sensors, inverse = np.unique(records["sensor"], return_inverse=True)
+        sensor_uuids = np.array([str(uuid.UUID(bytes=raw.ljust(16, b"\0"))) for raw in sensors], dtype=object)
+        ts = np.where(records["ts"] > 0, records["ts"], np.nan)
+        return [
+            (sensor_uuid, value, None if ts_value != ts_value else ts_value)
+            for sensor_uuid, value, ts_value in zip(sensor_uuids[inverse], records["value"].tolist(), ts.tolist())
+        ]
+
+    if encoding == "ndjson":
+        data = [json.loads(line) for line in payload.splitlines() if line.strip()]
+        return [(item["sensor"], float(item["value"]), item.get("ts")) for item in data]
+
+    data = _loads(encoding, payload)
+    if encoding == "msgpack":
+        return [(str(sensor), float(value), ts) for sensor, ts, value in data]
+    return [(item["sensor"], float(item["value"]), item.get("ts")) for item in data]
+
+
+def to_datetime(ts):
+    """Время устройства: секунды от эпохи или строка ISO 8601. None, если не распознано."""
+    if ts is None:
+        return None
+    if isinstance(ts, str):
+        value = parse_datetime(ts)
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+    try:
+        return datetime.fromtimestamp(float(ts), tz=timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
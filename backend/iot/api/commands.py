@@ -0,0 +1,192 @@
+import bisect
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+
+from .publisher import get_publisher
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержки подтверждения, в секундах
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class PendingCommand:
+    def __init__(self, controller_uuid, relay_uuid, is_working):
+        self.id = uuid.uuid4().hex
+        self.controller_uuid = str(controller_uuid)
+        self.relay_uuid = str(relay_uuid)
+        self.is_working = is_working
+        self.sent_at = time.monotonic()
+        self.latency = None
+        self.status = "pending"
+        self._done = threading.Event()
+
+    def payload(self):
+        return {"is_working": self.is_working, "command_id": self.id}
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self.status == "acked"
+
+    def finish(self, status):
+        self.status = status
+        if status == "acked":
+            self.latency = time.monotonic() - self.sent_at
+        self._done.set()
+
+
+class ControllerCommandStats:
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, latency):
+        self.acked += 1
+        self.latency_sum += latency
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def as_dict(self, pending):
+        cumulative = 0
+        histogram = {}
+        for bound, count in zip([*LATENCY_BUCKETS, "+Inf"], self.buckets):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+        return {
+            "sent": self.sent,
+            "acked": self.acked,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "pending": pending,
+            "latency_avg": self.latency_sum / self.acked if self.acked else None,
+            "latency_histogram": histogram,
+        }
+
+
+class CommandTracker:
+    """
+    Таблица отправленных команд реле, ожидающих подтверждения от контроллера.
+
+    Подтверждение — сообщение ``controller/<uuid>/relays/<relay>/status``.
+    Если контроллер вернул ``command_id``, команда ищется по нему, иначе
+    подтверждается самая старая ожидающая команда этого реле с тем же
+    состоянием. Команды без ответа дольше ``timeout`` секунд считаются
+    просроченными. Таблица и статистика живут в памяти процесса.
+    """
+
+    def __init__(self, timeout=None, max_pending=None):
+        self.timeout = timeout or getattr(settings, "COMMAND_ACK_TIMEOUT", 10)
+        self.max_pending = max_pending or getattr(settings, "COMMAND_MAX_PENDING", 10000)
+        self._pending = OrderedDict()
+        self._stats = defaultdict(ControllerCommandStats)
+        self._lock = threading.Lock()
+
+    def register(self, controller_uuid, relay_uuid, is_working):
+        command = PendingCommand(controller_uuid, relay_uuid, is_working)
+        with self._lock:
+            self._expire()
+            self._pending[command.id] = command
+            self._stats[command.controller_uuid].sent += 1
+            while len(self._pending) > self.max_pending:
+                self._finish(self._pending.popitem(last=False)[1], "timeout")
+        return command
+
+    def ack(self, controller_uuid, relay_uuid, is_working, command_id=None):
+        with self._lock:
+            self._expire()
+            command = self._pending.get(command_id) if command_id else None
+            if command is None:
+                command = next(
+                    (
+                        c for c in self._pending.values()
+                        if c.controller_uuid == controller_uuid and c.relay_uuid == relay_uuid
+                        and c.is_working == is_working
+                    ),
+                    None,
+                )
+            if command is None:
+                return None
+            del self._pending[command.id]
+            self._finish(command, "acked")
+        return command
+
+    def fail(self, command):
+        with self._lock:
+            if self._pending.pop(command.id, None) is not None:
+                self._finish(command, "failed")
+
+    def stats(self, controller_uuids=None):
+        with self._lock:
+            self._expire()
+            pending = defaultdict(int)
+            for command in self._pending.values():
+                pending[command.controller_uuid] += 1
+            keys = self._stats.keys() if controller_uuids is None else [str(c) for c in controller_uuids]
+            return {
+                key: self._stats[key].as_dict(pending[key])
+                for key in keys
+                if key in self._stats
+            }
+
+    def on_status(self, client, userdata, msg):
+        """Обработчик paho для controller/+/relays/+/status."""
+        topic_parts = msg.topic.split("/")
+        try:
+            payload = json.loads(msg.payload.decode())
+            self.ack(topic_parts[1], topic_parts[3], payload.get("is_working"), payload.get("command_id"))
+        except Exception:
+            logger.exception(f"Invalid relay status on topic '{msg.topic}'")
+
+    def _expire(self):
+        # Команды лежат в порядке отправки, просроченные — в начале
+        deadline = time.monotonic() - self.timeout
+        while self._pending:
+            command = next(iter(self._pending.values()))
+            if command.sent_at > deadline:
+                break
+            del self._pending[command.id]
+            self._finish(command, "timeout")
+
+    def _finish(self, command, status):
+        command.finish(status)
+        stats = self._stats[command.controller_uuid]
+        if status == "acked":
+            stats.observe(command.latency)
+        elif status == "timeout":
+            stats.timeouts += 1
+        else:
+            stats.failures += 1
+
+
+command_tracker = CommandTracker()
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def listen_for_acks():
+    """Подписывает общий издатель процесса на статусы реле, чтобы подтверждать команды."""
+    global _listening
+    with _listening_lock:
+        if not _listening:
+            get_publisher().subscribe("controller/+/relays/+/status", command_tracker.on_status)
+            _listening = True
+
+
+def create_command(controller_uuid, relay_uuid, is_working):
+    """
+    Регистрирует команду реле в таблице ожидания. Отслеживается каждая команда,
+    ждёт ли запрос подтверждения или нет, поэтому статистика охватывает весь
+    поток команд; подписка на статусы оформляется при первой команде процесса.
+    """
+    listen_for_acks()
+    return command_tracker.register(controller_uuid, relay_uuid, is_working)
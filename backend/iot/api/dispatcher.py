@@ -0,0 +1,120 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import MQTT_DROPPED, MQTT_HANDLER_SECONDS, MQTT_RECEIVED, mqtt_topic_type
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class HandlerDispatcher:
+    """
+    Выполняет обработчики MQTT-сообщений в пуле потоков, а не в сетевом потоке paho.
+
+    Сообщения одного контроллера всегда попадают в одну и ту же очередь, поэтому
+    обрабатываются строго по порядку. Если очередь заполнена, сетевой поток ждёт
+    до ``put_timeout`` секунд, после чего сообщение отбрасывается.
+    """
+
+    def __init__(self, workers=None, queue_size=None, put_timeout=None):
+        self.workers = workers or getattr(settings, "MQTT_WORKERS", 4)
+        self.queue_size = queue_size or getattr(settings, "MQTT_QUEUE_SIZE", 1000)
+        self.put_timeout = put_timeout or getattr(settings, "MQTT_QUEUE_PUT_TIMEOUT", 5)
+
+        self._queues = []
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._processed = 0
+        self._dropped = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            q = queue.Queue(maxsize=self.queue_size)
+            thread = threading.Thread(target=self._run, args=(q,), name=f"mqtt-worker-{index}", daemon=True)
+            self._queues.append(q)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        # Сначала дорабатываем всё, что уже в очередях
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._threads = []
+        logger.info(f"Dispatcher stopped: {self.stats()}")
+
+    def wrap(self, handler):
+        def callback(client, userdata, msg):
+            self.submit(handler, client, userdata, msg)
+        return callback
+
+    def submit(self, handler, client, userdata, msg):
+        # Второй сегмент топика — uuid контроллера ("init/{uuid}", "controller/{uuid}/...")
+        topic_parts = msg.topic.split("/")
+        key = topic_parts[1] if len(topic_parts) > 1 else msg.topic
+        q = self._queues[zlib.crc32(key.encode()) % len(self._queues)]
+        topic_type = mqtt_topic_type(msg.topic)
+        MQTT_RECEIVED.labels(topic_type).inc()
+
+        try:
+            q.put((handler, client, userdata, msg), timeout=self.put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._dropped += 1
+            MQTT_DROPPED.labels(topic_type, "queue_full").inc()
+            logger.warning("Worker queue is full, dropped message on topic '%s'", msg.topic, extra={"log_key": topic_type})
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._stats_lock:
+            processed = self._processed
+            return {
+                "queue_depth": self.queue_depth(),
+                "processed": processed,
+                "failed": self._failed,
+                "dropped": self._dropped,
+                "latency_avg": self._latency_total / processed if processed else 0.0,
+                "latency_max": self._latency_max,
+            }
+
+    def _run(self, q):
+        try:
+            while True:
+                item = q.get()
+                if item is _STOP:
+                    break
+
+                handler, client, userdata, msg = item
+                started = time.perf_counter()
+                failed = False
+                try:
+                    handler(client, userdata, msg)
+                except Exception:
+                    failed = True
+                    logger.exception(f"Handler failed for topic '{msg.topic}'")
+                elapsed = time.perf_counter() - started
+                MQTT_HANDLER_SECONDS.labels(mqtt_topic_type(msg.topic)).observe(elapsed)
+
+                with self._stats_lock:
+                    self._processed += 1
+                    self._failed += failed
+                    self._latency_total += elapsed
+                    self._latency_max = max(self._latency_max, elapsed)
+        finally:
+            connection.close()
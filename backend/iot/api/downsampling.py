@@ -0,0 +1,57 @@
+import itertools
+
+import numpy as np
+
+
+def fetch_series(queryset, chunk_size=10000):
+    """
+    Читает (timestamp, value) серверным курсором прямо в массивы NumPy,
+    не создавая объектов модели. Время возвращается в секундах от эпохи.
+    """
+    rows = queryset.order_by('timestamp').values_list('timestamp', 'value').iterator(chunk_size=chunk_size)
+    flat = np.fromiter(
+        itertools.chain.from_iterable((timestamp.timestamp(), value) for timestamp, value in rows),
+        dtype=np.float64,
+    )
+    data = flat.reshape(-1, 2)
+    return data[:, 0], data[:, 1]
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: возвращает индексы ``threshold`` точек,
+    визуально наиболее близких к исходному ряду.
+
+    Средние по корзинам считаются векторно; выбор точки в корзине зависит
+    от точки, выбранной в предыдущей, поэтому цикл идёт по корзинам, а не по строкам.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Первая и последняя точки берутся всегда, остальные делятся на threshold - 2 корзины
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    starts, ends = edges[:-1], edges[1:]
+    counts = ends - starts
+
+    avg_x = np.add.reduceat(x[:n - 1], starts) / counts
+    avg_y = np.add.reduceat(y[:n - 1], starts) / counts
+    next_x = np.append(avg_x[1:], x[n - 1])
+    next_y = np.append(avg_y[1:], y[n - 1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = starts[i], ends[i]
+        xa, ya = x[a], y[a]
+        area = np.abs(
+            (xa - next_x[i]) * (y[start:end] - ya)
+            - (xa - x[start:end]) * (next_y[i] - ya)
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
@@ -0,0 +1,158 @@
+import csv
+import json
+import tempfile
+
+from django.utils.timezone import localtime
+
+COLUMNS = ['timestamp', 'sensor_uuid', 'controller_uuid', 'value', 'status']
+FIELDS = ['timestamp', 'sensor__uuid', 'sensor__controller__uuid', 'value', 'status']
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Ограничение Excel на число строк листа, включая заголовок
+XLSX_MAX_ROWS = 1048576
+
+
+def iter_rows(queryset, chunk_size):
+    """Строки из серверного курсора: в памяти одновременно не больше одной пачки."""
+    return queryset.order_by('timestamp', 'id').values_list(*FIELDS).iterator(chunk_size=chunk_size)
+
+
+def iter_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _Buffer:
+    """Файлоподобный объект, который копит записанное до следующего ``drain()``."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def export_csv(rows, chunk_size):
+    buffer = _Buffer()
+
+    class Writer:
+        def write(self, line):
+            buffer.write(line.encode())
+
+    writer = csv.writer(Writer())
+    writer.writerow(COLUMNS)
+    for chunk in iter_chunks(rows, chunk_size):
+        for timestamp, sensor_uuid, controller_uuid, value, status in chunk:
+            writer.writerow([timestamp.isoformat(), sensor_uuid, controller_uuid, value, status])
+        yield buffer.drain()
+    yield buffer.drain()
+
+
+def export_ndjson(rows, chunk_size):
+    for chunk in iter_chunks(rows, chunk_size):
+        yield ''.join(
+            json.dumps({
+                'timestamp': timestamp.isoformat(),
+                'sensor_uuid': str(sensor_uuid),
+                'controller_uuid': str(controller_uuid),
+                'value': value,
+                'status': status,
+            }) + '\n'
+            for timestamp, sensor_uuid, controller_uuid, value, status in chunk
+        ).encode()
+
+
+def export_parquet(rows, chunk_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('sensor_uuid', pa.string()),
+        ('controller_uuid', pa.string()),
+        ('value', pa.float64()),
+        ('status', pa.string()),
+    ])
+    buffer = _Buffer()
+    # Каждая пачка становится отдельной row group и сразу уходит клиенту
+    with pq.ParquetWriter(buffer, schema) as writer:
+        for chunk in iter_chunks(rows, chunk_size):
+            timestamps, sensors, controllers, values, statuses = zip(*chunk)
+            writer.write_table(pa.table([
+                pa.array(timestamps, type=schema.field('timestamp').type),
+                pa.array([str(uuid) for uuid in sensors]),
+                pa.array([str(uuid) for uuid in controllers]),
+                pa.array(values, type=pa.float64()),
+                pa.array(statuses),
+            ], schema=schema))
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def export_xlsx(rows, chunk_size):
+    from openpyxl import Workbook
+
+    # В режиме write_only openpyxl пишет листы во временные файлы, а не держит их в памяти
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_ROWS
+    for chunk in iter_chunks(rows, chunk_size):
+        for timestamp, sensor_uuid, controller_uuid, value, status in chunk:
+            if sheet_rows == XLSX_MAX_ROWS:
+                sheet = workbook.create_sheet(f"messages_{len(workbook.worksheets) + 1}")
+                sheet.append(COLUMNS)
+                sheet_rows = 1
+            sheet.append([localtime(timestamp).replace(tzinfo=None), str(sensor_uuid), str(controller_uuid), value, status])
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet("messages_1").append(COLUMNS)
+
+    with tempfile.TemporaryFile() as file:
+        workbook.save(file)
+        file.seek(0)
+        while data := file.read(1024 * 1024):
+            yield data
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'ndjson': export_ndjson,
+    'parquet': export_parquet,
+    'xlsx': export_xlsx,
+}
+
+# Форматы, которым нужны необязательные зависимости
+REQUIREMENTS = {
+    'parquet': 'pyarrow',
+    'xlsx': 'openpyxl',
+}
@@ -0,0 +1,255 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Q
+
+from .codecs import to_datetime
+from .models import Message
+from .rollups import update_rollups
+from .latest import get_latest_store, make_record
+from .metrics import (
+    DB_FLUSH_FAILURES, DB_FLUSH_SECONDS, DB_FLUSH_SIZE, READINGS_DROPPED, READINGS_DUPLICATE, READINGS_STORED,
+)
+
+logger = logging.getLogger(__name__)
+
+# Время устройства дальше в будущем считается сбитыми часами и заменяется временем приёма
+MAX_CLOCK_SKEW = timedelta(seconds=getattr(settings, "MQTT_MAX_CLOCK_SKEW", 300))
+
+# Ключей (sensor, timestamp) в одном запросе проверки на повторы: параметров SQL не больше лимита SQLite
+DEDUPLICATE_CHUNK_SIZE = 400
+
+
+def resolve_timestamp(ts, received_at):
+    timestamp = to_datetime(ts)
+    if timestamp is None:
+        if ts is not None:
+            logger.warning("Invalid device timestamp %r, using receive time", ts, extra={"log_key": "timestamp"})
+        return received_at
+    if timestamp - received_at > MAX_CLOCK_SKEW:
+        logger.warning(
+            "Device timestamp %s is in the future, using receive time", timestamp.isoformat(),
+            extra={"log_key": "timestamp"},
+        )
+        return received_at
+    return timestamp
+
+
+def deduplicate(messages):
+    """
+    Отбрасывает повторы по (sensor, timestamp) внутри пачки и показания, уже
+    записанные в БД, — контроллер может выгрузить накопленное офлайн повторно.
+    """
+    unique = {}
+    for message in messages:
+        unique.setdefault((message.sensor_id, message.timestamp), message)
+    if not unique:
+        return []
+
+    # Ищутся только сами ключи пачки, а не весь диапазон времени между ними
+    keys = sorted(unique, key=lambda key: key[0])
+    existing = set()
+    for start in range(0, len(keys), DEDUPLICATE_CHUNK_SIZE):
+        timestamps = defaultdict(list)
+        for sensor_id, timestamp in keys[start:start + DEDUPLICATE_CHUNK_SIZE]:
+            timestamps[sensor_id].append(timestamp)
+        condition = Q()
+        for sensor_id, values in timestamps.items():
+            condition |= Q(sensor_id=sensor_id, timestamp__in=values)
+        existing.update(Message.objects.filter(condition).values_list("sensor_id", "timestamp"))
+    return [message for key, message in unique.items() if key not in existing]
+
+
+def store_messages(messages, batch_size, attempts=3):
+    """
+    Пишет показания в БД одной транзакцией вместе с агрегатами и возвращает
+    те, что действительно добавлены. Последние значения обновляются после коммита.
+
+    Если те же показания между проверкой и вставкой записал другой процесс
+    приёма, вставка откатывается до точки сохранения и повторяется по свежей
+    проверке — в агрегаты попадают только добавленные строки.
+    """
+    started = time.perf_counter()
+    received = len(messages)
+    with transaction.atomic():
+        for attempt in range(attempts):
+            messages = deduplicate(messages)
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create(messages, batch_size=batch_size)
+                break
+            except IntegrityError:
+                if attempt == attempts - 1:
+                    raise
+                logger.warning("Readings were stored concurrently, deduplicating again", extra={"log_key": "race"})
+        update_rollups(messages)
+        transaction.on_commit(lambda: update_latest(messages))
+
+    DB_FLUSH_SECONDS.observe(time.perf_counter() - started)
+    DB_FLUSH_SIZE.observe(received)
+    READINGS_STORED.inc(len(messages))
+    READINGS_DUPLICATE.inc(received - len(messages))
+    return messages
+
+
+def update_latest(messages):
+    store = get_latest_store()
+    # Без общего хранилища записи никто не прочитает
+    if not store.shared:
+        return
+    try:
+        store.update([make_record(message) for message in messages])
+    except Exception:
+        logger.exception("Failed to update latest values")
+
+
+class MessageBuffer:
+    """
+    Копит показания датчиков в памяти и пишет их в БД пачками через bulk_create.
+
+    Сброс происходит, когда в буфере набралось ``max_size`` записей или с момента
+    первой записи прошло ``max_delay`` секунд. ``close()`` сбрасывает остаток.
+    Пачку пишет ``store`` — по умолчанию ``store_messages``.
+
+    Если запись не удалась (перезапуск БД, блокировка), пачка возвращается в
+    начало буфера и повторяется с удваивающейся задержкой до ``retry_max_delay``.
+    Пока БД недоступна, буфер держит не больше ``max_pending`` показаний —
+    самые старые сверх этого отбрасываются и считаются потерянными.
+    """
+
+    def __init__(self, max_size=None, max_delay=None, store=None, max_pending=None, retry_max_delay=None):
+        self.max_size = max_size or getattr(settings, "MQTT_BUFFER_SIZE", 500)
+        self.max_delay = max_delay or getattr(settings, "MQTT_BUFFER_DELAY", 0.2)
+        self.store = store or store_messages
+        self.max_pending = max_pending or getattr(settings, "MQTT_BUFFER_MAX_PENDING", 50000)
+        self.retry_max_delay = retry_max_delay or getattr(settings, "MQTT_BUFFER_RETRY_MAX_DELAY", 30)
+
+        self._items = []
+        self._first_added_at = None
+        self._retry_delay = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="message-buffer", daemon=True)
+        self._thread.start()
+
+    def add(self, message):
+        with self._lock:
+            if not self._items:
+                self._first_added_at = time.monotonic()
+            self._items.append(message)
+            full = len(self._items) >= self.max_size
+            # Пока БД недоступна, буфер не растёт сверх max_pending
+            overflow = len(self._items) > self.max_pending
+            if overflow:
+                del self._items[0]
+
+        if overflow:
+            READINGS_DROPPED.inc()
+            logger.warning("Buffer is over %d messages, dropped the oldest", self.max_pending, extra={"log_key": "overflow"})
+        if full:
+            self.flush()
+
+    def flush(self, force=False):
+        """
+        Пишет всё накопленное и возвращает число добавленных строк. После
+        неудачной записи до истечения задержки повтора ничего не делает,
+        если не передан ``force``.
+        """
+        # Один поток пишет в БД за раз, чтобы пачки не перемешивались
+        with self._flush_lock:
+            with self._lock:
+                if not force and time.monotonic() < self._retry_at:
+                    return 0
+                items, self._items = self._items, []
+                first_added_at, self._first_added_at = self._first_added_at, None
+
+            if not items:
+                return 0
+
+            try:
+                stored = self.store(items, self.max_size)
+            except Exception:
+                logger.exception("Failed to flush %d buffered messages", len(items))
+                DB_FLUSH_FAILURES.inc()
+                self._restore(items, first_added_at)
+                return 0
+
+            with self._lock:
+                self._retry_delay = 0
+                self._retry_at = 0.0
+
+        if len(stored) != len(items):
+            logger.info("Skipped %d duplicate messages", len(items) - len(stored), extra={"log_key": "flush"})
+        logger.info("Flushed %d buffered messages", len(stored), extra={"log_key": "flush"})
+        return len(stored)
+
+    def close(self, attempts=3):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        # При остановке повторы не ждут полной задержки, но и не бесконечны
+        for attempt in range(attempts):
+            self.flush(force=True)
+            if not self._items:
+                return
+            if attempt < attempts - 1:
+                time.sleep(min(2 ** attempt, self.retry_max_delay))
+        logger.error("Dropped %d buffered messages on shutdown, database unavailable", len(self._items))
+        READINGS_DROPPED.inc(len(self._items))
+        self._items = []
+
+    def _restore(self, items, first_added_at):
+        """Возвращает неудавшуюся пачку в начало буфера и откладывает следующую попытку."""
+        with self._lock:
+            self._items = items + self._items
+            if first_added_at is not None:
+                self._first_added_at = first_added_at
+            elif self._first_added_at is None:
+                self._first_added_at = time.monotonic()
+
+            overflow = len(self._items) - self.max_pending
+            if overflow > 0:
+                del self._items[:overflow]
+
+            self._retry_delay = min(max(self._retry_delay * 2, self.max_delay), self.retry_max_delay)
+            self._retry_at = time.monotonic() + self._retry_delay
+            retry_delay = self._retry_delay
+
+        if overflow > 0:
+            logger.error("Buffer is over %d messages, dropped %d oldest", self.max_pending, overflow)
+            READINGS_DROPPED.inc(overflow)
+        logger.warning("Retrying %d buffered messages in %.1fs", len(self._items), retry_delay)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.max_delay / 4):
+                with self._lock:
+                    current = time.monotonic()
+                    due = (
+                        self._first_added_at is not None
+                        and current - self._first_added_at >= self.max_delay
+                        and current >= self._retry_at
+                    )
+                if due:
+                    close_old_connections()
+                    self.flush()
+        finally:
+            connection.close()
@@ -0,0 +1,125 @@
+import json
+import threading
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+
+def make_record(message):
+    return {
+        "sensor_uuid": str(message.sensor.uuid),
+        "controller_uuid": str(message.sensor.controller.uuid),
+        "value": message.value,
+        "status": message.status,
+        "timestamp": message.timestamp,
+    }
+
+
+class NullLatestStore:
+    """
+    Хранилище без общего бэкенда. Приём MQTT идёт в отдельном процессе, так
+    что память веб-процесса всё равно не знает последних значений: запись
+    ничего не делает, а /messages/latest/ читает из БД.
+    """
+
+    shared = False
+
+    def update(self, records):
+        pass
+
+    def get_many(self, sensor_uuids):
+        return {}
+
+
+class RedisLatestStore:
+    """
+    Последние значения в хэше Redis — общие для процесса MQTT и веб-процессов.
+    Подойдёт любой клиент с интерфейсом redis-py (hmget/hset).
+    """
+
+    key = "iot:latest"
+    shared = True
+
+    def __init__(self, client=None, url=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or settings.LATEST_VALUE_REDIS_URL)
+        self.client = client
+
+    def update(self, records):
+        newest = {}
+        for record in records:
+            current = newest.get(record["sensor_uuid"])
+            if current is None or record["timestamp"] >= current["timestamp"]:
+                newest[record["sensor_uuid"]] = record
+        if not newest:
+            return
+
+        stored = self.get_many(list(newest))
+        mapping = {
+            uuid: json.dumps({**record, "timestamp": record["timestamp"].isoformat()})
+            for uuid, record in newest.items()
+            if uuid not in stored or record["timestamp"] >= stored[uuid]["timestamp"]
+        }
+        if mapping:
+            self.client.hset(self.key, mapping=mapping)
+
+    def get_many(self, sensor_uuids):
+        if not sensor_uuids:
+            return {}
+        result = {}
+        for uuid, raw in zip(sensor_uuids, self.client.hmget(self.key, sensor_uuids)):
+            if raw is not None:
+                record = json.loads(raw)
+                record["timestamp"] = parse_datetime(record["timestamp"])
+                result[uuid] = record
+        return result
+
+
+class FakeRedis:
+    """Минимальная замена клиента Redis в памяти — для тестов и локального запуска."""
+
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+            added = len(set(items) - set(fields))
+            fields.update({k: v.encode() if isinstance(v, str) else v for k, v in items.items()})
+            return added
+
+    def hmget(self, name, keys):
+        with self._lock:
+            fields = self._hashes.get(name, {})
+            return [fields.get(key) for key in keys]
+
+    def hgetall(self, name):
+        with self._lock:
+            return {key.encode(): value for key, value in self._hashes.get(name, {}).items()}
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._hashes.pop(name, None) is not None for name in names)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_latest_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = getattr(settings, "LATEST_VALUE_BACKEND", "local")
+            if backend == "redis":
+                _store = RedisLatestStore()
+            elif backend == "fake":
+                _store = RedisLatestStore(client=FakeRedis())
+            else:
+                _store = NullLatestStore()
+        return _store
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """
+    Очередь показаний одного клиента. Живёт в event loop подписчика;
+    издатель кладёт в неё данные из любого потока.
+    """
+
+    def __init__(self, loop, controller_uuid, sensor_uuids=None, maxsize=100):
+        self.loop = loop
+        self.controller_uuid = controller_uuid
+        self.sensor_uuids = set(sensor_uuids) if sensor_uuids else None
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def matches(self, record):
+        if record["controller_uuid"] != self.controller_uuid:
+            return False
+        return self.sensor_uuids is None or record["sensor_uuid"] in self.sensor_uuids
+
+    def push(self, record):
+        try:
+            self.loop.call_soon_threadsafe(self._put, record)
+        except RuntimeError:
+            # Цикл подписчика уже закрыт, отписка вот-вот произойдёт
+            pass
+
+    def _put(self, record):
+        # Медленный клиент теряет самые старые показания, а не тормозит остальных
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(record)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class LocalBroker:
+    """Рассылка показаний подписчикам внутри одного процесса."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, controller_uuid, sensor_uuids=None):
+        subscription = Subscription(asyncio.get_running_loop(), controller_uuid, sensor_uuids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, record):
+        self.fanout(record)
+
+    def fanout(self, record):
+        # Без подписчиков показание не стоит даже сверки с фильтрами
+        if not self._subscriptions:
+            return
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.matches(record)]
+        for subscription in subscriptions:
+            subscription.push(record)
+
+
+class MQTTBroker(LocalBroker):
+    """
+    Рассылка между процессами через MQTT-брокер, который уже есть в системе.
+
+    Процесс приёма публикует показания в ``<LIVE_TOPIC_PREFIX>/<controller>/<sensor>``,
+    веб-процесс подписан на эти топики одним соединением и раздаёт
+    сообщения своим подписчикам.
+
+    Публикуются только показания контроллеров, которые кто-то смотрит: пока у
+    веб-процесса есть подписчики контроллера, он раз в ``LIVE_WATCH_INTERVAL``
+    секунд отправляет ``<LIVE_TOPIC_PREFIX>-watch/<controller>``. Процесс приёма
+    считает контроллер просматриваемым ещё три интервала после такого сообщения.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None, watch_interval=None):
+        super().__init__()
+        self.host = host or getattr(settings, "MQTT_BROKER_HOST", "localhost")
+        self.port = port or getattr(settings, "MQTT_BROKER_PORT", 1883)
+        self.prefix = prefix or getattr(settings, "LIVE_TOPIC_PREFIX", "live")
+        self.watch_interval = watch_interval or getattr(settings, "LIVE_WATCH_INTERVAL", 10)
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Издающий процесс на свои же топики не подписывается
+        self._listening = False
+        self._publishing = False
+        self._watched = {}
+        self._watch_thread = None
+
+    def subscribe(self, controller_uuid, sensor_uuids=None):
+        client = self._connect()
+        with self._client_lock:
+            if not self._listening:
+                self._listening = True
+                client.subscribe(f"{self.prefix}/#")
+            if self._watch_thread is None:
+                self._watch_thread = threading.Thread(target=self._announce, name="live-watch", daemon=True)
+                self._watch_thread.start()
+        with self._lock:
+            watched = any(s.controller_uuid == controller_uuid for s in self._subscriptions)
+        subscription = super().subscribe(controller_uuid, sensor_uuids)
+        # Первый подписчик контроллера объявляется сразу, не дожидаясь очередного интервала
+        if not watched:
+            client.publish(f"{self.prefix}-watch/{controller_uuid}")
+        return subscription
+
+    def publish(self, record):
+        if not self._publishing:
+            with self._client_lock:
+                self._publishing = True
+                if self._client is not None:
+                    self._client.subscribe(f"{self.prefix}-watch/+")
+        client = self._connect()
+
+        watched_at = self._watched.get(record["controller_uuid"])
+        if watched_at is None or time.monotonic() - watched_at > 3 * self.watch_interval:
+            return
+        client.publish(
+            f"{self.prefix}/{record['controller_uuid']}/{record['sensor_uuid']}",
+            json.dumps(record, cls=DjangoJSONEncoder),
+        )
+
+    def _announce(self):
+        while True:
+            time.sleep(self.watch_interval)
+            with self._lock:
+                controllers = {s.controller_uuid for s in self._subscriptions}
+            for controller_uuid in controllers:
+                self._client.publish(f"{self.prefix}-watch/{controller_uuid}")
+
+    def _connect(self):
+        with self._client_lock:
+            if self._client is None:
+                client = mqtt.Client()
+                client.on_connect = self._on_connect
+                client.on_message = self._on_message
+                client.message_callback_add(f"{self.prefix}-watch/+", self._on_watch)
+                client.connect_async(self.host, self.port, 60)
+                client.loop_start()
+                self._client = client
+            return self._client
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # После переподключения подписку нужно восстановить
+        if self._listening:
+            client.subscribe(f"{self.prefix}/#")
+        if self._publishing:
+            client.subscribe(f"{self.prefix}-watch/+")
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            self.fanout(json.loads(msg.payload))
+        except Exception:
+            logger.exception(f"Invalid live message on topic '{msg.topic}'")
+
+    def _on_watch(self, client, userdata, msg):
+        self._watched[msg.topic.split("/")[1]] = time.monotonic()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            if getattr(settings, "LIVE_BACKEND", "mqtt") == "local":
+                _broker = LocalBroker()
+            else:
+                _broker = MQTTBroker()
+        return _broker
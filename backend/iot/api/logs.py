@@ -0,0 +1,149 @@
+"""
+Логирование процессов приёма MQTT.
+
+На горячем пути (каждое показание, каждый статус реле) строки лога
+прореживаются по ключу — полю ``log_key`` из ``extra``:
+
+* INFO и ниже пишется одна запись из ``MQTT_LOG_SAMPLE_RATE`` для ключа;
+* WARNING и ниже — не больше ``MQTT_LOG_RATE_LIMIT`` записей на ключ за
+  ``MQTT_LOG_RATE_WINDOW`` секунд;
+* ERROR и выше пишется всегда.
+
+Ключ — шаблон сообщения вместе с ``log_key``, поэтому такие вызовы
+форматируются лениво (``logger.info("... %s", value, extra=...)``), а не
+f-строкой: отброшенная запись не форматируется вовсе. Число пропущенных
+записей попадает в поле ``suppressed`` следующей записанной.
+
+Записи уходят в очередь, форматирование (JSON или текст) и вывод выполняет
+отдельный поток, так что поток приёма на вводе-выводе не ждёт.
+"""
+import atexit
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+from .metrics import LOG_RECORDS_DROPPED
+
+# Атрибуты, которые есть у любой LogRecord; всё остальное — поля из extra
+_RECORD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rate=None, rate_limit=None, window=None, max_keys=10000):
+        super().__init__()
+        self.sample_rate = sample_rate or getattr(settings, "MQTT_LOG_SAMPLE_RATE", 100)
+        self.rate_limit = rate_limit or getattr(settings, "MQTT_LOG_RATE_LIMIT", 10)
+        self.window = window or getattr(settings, "MQTT_LOG_RATE_WINDOW", 60)
+        self.max_keys = max_keys
+        # ключ -> [всего, начало окна, записано в окне, пропущено с последней записи]
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        log_key = getattr(record, "log_key", None)
+        if log_key is None or record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.msg, log_key)
+        current = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = [0, current, 0, 0]
+                # Вытесняется ключ, который дольше всех не встречался
+                if len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+            else:
+                self._keys.move_to_end(key)
+            if current - state[1] >= self.window:
+                state[1] = current
+                state[2] = 0
+
+            state[0] += 1
+            if record.levelno < logging.WARNING and (state[0] - 1) % self.sample_rate:
+                reason = "sampled"
+            elif state[2] >= self.rate_limit:
+                reason = "rate_limited"
+            else:
+                state[2] += 1
+                if state[3]:
+                    record.suppressed = state[3]
+                    state[3] = 0
+                return True
+            state[3] += 1
+
+        LOG_RECORDS_DROPPED.labels(reason).inc()
+        return False
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна запись — один объект JSON в строке; поля из extra добавляются как есть."""
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS:
+                data[name] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Очередь внутри процесса: запись кладётся как есть, без форматирования
+    в вызывающем потоке (стандартный QueueHandler форматирует её сразу).
+    Если поток вывода не успевает, новые записи отбрасываются.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def configure(level=logging.INFO):
+    """Настраивает корневой логгер процесса приёма; повторный вызов ничего не меняет."""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return _listener
+
+        output = logging.StreamHandler()
+        if getattr(settings, "MQTT_LOG_FORMAT", "json") == "json":
+            output.setFormatter(JSONFormatter())
+        else:
+            output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+        handler = LocalQueueHandler(queue.Queue(getattr(settings, "MQTT_LOG_QUEUE_SIZE", 10000)))
+        handler.addFilter(SamplingFilter())
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(level)
+
+        _listener = QueueListener(handler.queue, output)
+        _listener.start()
+        # Остаток очереди выводится при завершении процесса
+        atexit.register(_listener.stop)
+        return _listener
@@ -0,0 +1,57 @@
+import resource
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.export import EXPORTERS, iter_rows
+from api.models import Company, Controller, Sensor, Message
+
+
+class Command(BaseCommand):
+    help = 'Замеряет скорость потоковой выгрузки сообщений и пиковое потребление памяти'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500000)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--formats', default=','.join(EXPORTERS))
+
+    def handle(self, *args, **options):
+        company = Company.objects.create(name=f"bench-{uuid.uuid4().hex[:8]}")
+        try:
+            controller = Controller.objects.create(company=company, name="bench")
+            sensor = Sensor.objects.create(controller=controller, name="bench", type=Sensor.SensorType.TEMPERATURE)
+            self.insert(sensor, options['rows'])
+
+            self.stdout.write(f"{'format':>8} {'rows/s':>10} {'MB':>8} {'peak RSS MB':>12}")
+            for export_format in options['formats'].split(','):
+                queryset = Message.objects.filter(sensor=sensor)
+                started = time.perf_counter()
+                size = 0
+                for data in EXPORTERS[export_format](iter_rows(queryset, options['chunk_size']), options['chunk_size']):
+                    size += len(data)
+                elapsed = time.perf_counter() - started
+
+                # ru_maxrss — пик за всё время процесса, в килобайтах (Linux)
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                self.stdout.write(
+                    f"{export_format:>8} {options['rows'] / elapsed:>10.0f} {size / 2 ** 20:>8.1f} {peak:>12.1f}"
+                )
+        finally:
+            company.delete()
+
+    def insert(self, sensor, count):
+        end = timezone.now()
+        table = Message._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            for offset in range(0, count, 10000):
+                cursor.executemany(
+                    f'INSERT INTO {table} (sensor_id, value, timestamp, status) VALUES (%s, %s, %s, %s)',
+                    [
+                        (sensor.pk, i * 0.1, end - timedelta(seconds=i), Message.Status.OK)
+                        for i in range(offset, min(offset + 10000, count))
+                    ],
+                )
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+import numpy as np
+
+import paho.mqtt.client as mqtt
+from django.core.management.base import BaseCommand
+
+from api.codecs import BATCH_DTYPE, READING, to_datetime
+from api.ingest import MessageBuffer, store_messages
+from api.models import Company, Controller, Sensor, Message
+
+
+class Command(BaseCommand):
+    help = 'Замеряет пропускную способность обработчика показаний датчиков'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--sensors', type=int, default=10)
+        parser.add_argument(
+            '--dispatch', action='store_true',
+            help='Пропускать сообщения через пул обработчиков, как в start()',
+        )
+        parser.add_argument('--encoding', choices=['json', 'struct'], default='json')
+        parser.add_argument(
+            '--engine', choices=['threads', 'asyncio', 'both'], default='threads',
+            help='Движок приёма: пул потоков mqtt_client, конвейер async_ingest или оба по очереди',
+        )
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='Сообщений в секунду; 0 — всё сразу, задержка тогда включает ожидание в очереди',
+        )
+        parser.add_argument(
+            '--batch', type=int, default=0,
+            help='Показаний в одной публикации controller/<uuid>/sensors/batch; 0 — по одному',
+        )
+
+    def handle(self, *args, **options):
+        # Лог на каждое показание не должен попадать в замер
+        for name in ('api.mqtt_client', 'api.ingest', 'api.dispatcher', 'api.async_ingest'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        company = Company.objects.create(name=f"bench-{uuid.uuid4().hex[:8]}")
+        try:
+            controller = Controller.objects.create(
+                company=company, name="bench", payload_encoding=options['encoding'],
+            )
+            sensors = [
+                Sensor.objects.create(
+                    controller=controller,
+                    name=f"bench-{i}",
+                    type=Sensor.SensorType.TEMPERATURE,
+                )
+                for i in range(options['sensors'])
+            ]
+
+            # У каждого показания своё время: по (датчик, время) ищется момент его записи в БД
+            base = time.time()
+            readings = [(sensors[i % len(sensors)], base - i / 1000, 20 + i % 10) for i in range(options['messages'])]
+            if options['batch']:
+                messages, keys = self.make_batches(controller, readings, options)
+            else:
+                messages, keys = self.make_messages(controller, readings, options)
+            size = sum(len(msg.payload) for msg in messages)
+
+            engines = ['threads', 'asyncio'] if options['engine'] == 'both' else [options['engine']]
+            for engine in engines:
+                Message.objects.filter(sensor__controller=controller).delete()
+
+                completed = {}
+
+                def store(batch, batch_size):
+                    stored = store_messages(batch, batch_size)
+                    done = time.perf_counter()
+                    for message in batch:
+                        completed[(message.sensor_id, message.timestamp)] = done
+                    return stored
+
+                if engine == 'asyncio':
+                    elapsed, submitted = asyncio.run(self.run_asyncio(messages, store, options))
+                else:
+                    elapsed, submitted = self.run_threads(messages, store, options)
+
+                latencies = sorted(
+                    completed[key] - submitted[index]
+                    for index, message_keys in enumerate(keys)
+                    for key in message_keys
+                    if key in completed
+                )
+                p50, p99 = (
+                    (latencies[int(len(latencies) * 0.5)], latencies[int(len(latencies) * 0.99)])
+                    if latencies else (0.0, 0.0)
+                )
+                stored = Message.objects.filter(sensor__controller=controller).count()
+                self.stdout.write(
+                    f"{engine}: {options['messages']} readings in {len(messages)} publishes, {size} bytes, "
+                    f"{elapsed:.3f}s ({options['messages'] / elapsed:.0f} msg/s), stored {stored}, "
+                    f"latency p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms"
+                )
+        finally:
+            company.delete()
+
+    def pace(self, started, index, rate):
+        """Сколько ждать до отправки сообщения index при заданной частоте; 0 — без ограничения."""
+        if not rate:
+            return 0
+        return max(started + index / rate - time.perf_counter(), 0)
+
+    def run_threads(self, messages, store, options):
+        from api import mqtt_client
+
+        buffer = MessageBuffer(store=store)
+        previous, mqtt_client.message_buffer = mqtt_client.message_buffer, buffer
+        try:
+            handler = mqtt_client.handle_sensor_data
+            dispatcher = mqtt_client.dispatcher
+            if options['dispatch']:
+                dispatcher.start()
+                handler = dispatcher.wrap(handler)
+            buffer.start()
+
+            submitted = []
+            started = time.perf_counter()
+            for index, msg in enumerate(messages):
+                delay = self.pace(started, index, options['rate'])
+                if delay:
+                    time.sleep(delay)
+                submitted.append(time.perf_counter())
+                handler(mqtt_client.client, None, msg)
+            if options['dispatch']:
+                dispatcher.stop()
+            buffer.close()
+            elapsed = time.perf_counter() - started
+
+            if options['dispatch']:
+                self.stdout.write(f"dispatcher: {dispatcher.stats()}")
+            return elapsed, submitted
+        finally:
+            mqtt_client.message_buffer = previous
+
+    async def run_asyncio(self, messages, store, options):
+        from api.async_ingest import AsyncIngestEngine
+
+        engine = AsyncIngestEngine(store=store)
+        engine.start()
+
+        submitted = []
+        started = time.perf_counter()
+        for index, msg in enumerate(messages):
+            delay = self.pace(started, index, options['rate'])
+            if delay:
+                await asyncio.sleep(delay)
+            submitted.append(time.perf_counter())
+            await engine.feed(msg)
+        await engine.stop()
+        return time.perf_counter() - started, submitted
+
+    def make_messages(self, controller, readings, options):
+        messages, keys = [], []
+        for sensor, ts, value in readings:
+            msg = mqtt.MQTTMessage(topic=f"controller/{controller.uuid}/sensors/{sensor.uuid}".encode())
+            if options['encoding'] == 'struct':
+                msg.payload = READING.pack(ts, value)
+            else:
+                msg.payload = json.dumps({"value": value, "ts": ts}).encode()
+            messages.append(msg)
+            keys.append([(sensor.pk, to_datetime(ts))])
+        return messages, keys
+
+    def make_batches(self, controller, readings, options):
+        topic = f"controller/{controller.uuid}/sensors/batch".encode()
+        messages, keys = [], []
+        for offset in range(0, len(readings), options['batch']):
+            chunk = readings[offset:offset + options['batch']]
+            msg = mqtt.MQTTMessage(topic=topic)
+            if options['encoding'] == 'struct':
+                records = np.zeros(len(chunk), dtype=BATCH_DTYPE)
+                records['sensor'] = [sensor.uuid.bytes for sensor, _, _ in chunk]
+                records['ts'] = [ts for _, ts, _ in chunk]
+                records['value'] = [value for _, _, value in chunk]
+                msg.payload = records.tobytes()
+            else:
+                msg.payload = json.dumps([
+                    {"sensor": str(sensor.uuid), "value": value, "ts": ts} for sensor, ts, value in chunk
+                ]).encode()
+            messages.append(msg)
+            keys.append([(sensor.pk, to_datetime(ts)) for sensor, ts, _ in chunk])
+        return messages, keys
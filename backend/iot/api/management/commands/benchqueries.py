@@ -0,0 +1,86 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.models import Company, Controller, Sensor, Message
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время типовых запросов к сообщениям в зависимости от числа строк'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', default='10000,100000,1000000',
+            help='Размеры таблицы через запятую',
+        )
+        parser.add_argument('--sensors', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['rows'].split(','))
+
+        company = Company.objects.create(name=f"bench-{uuid.uuid4().hex[:8]}")
+        try:
+            controller = Controller.objects.create(company=company, name="bench")
+            sensors = [
+                Sensor.objects.create(controller=controller, name=f"bench-{i}", type=Sensor.SensorType.TEMPERATURE)
+                for i in range(options['sensors'])
+            ]
+
+            self.stdout.write(f"{'rows':>10} {'range':>10} {'latest':>10} {'status':>10}  (ms per query)")
+            inserted = 0
+            for size in sizes:
+                self.insert(sensors, inserted, size - inserted)
+                inserted = size
+                self.stdout.write(f"{size:>10} " + " ".join(
+                    f"{self.measure(query, sensors, options['repeat']):>10.2f}"
+                    for query in (self.range_query, self.latest_query, self.status_query)
+                ))
+        finally:
+            company.delete()
+
+    def insert(self, sensors, offset, count):
+        # Сырой INSERT через executemany: миллионы строк без экземпляров модели вставляются быстрее bulk_create
+        end = timezone.now()
+        table = Message._meta.db_table
+        chunk = []
+        with transaction.atomic(), connection.cursor() as cursor:
+            for i in range(offset, offset + count):
+                chunk.append((
+                    sensors[i % len(sensors)].pk,
+                    random.uniform(0, 40),
+                    end - timedelta(seconds=i),
+                    Message.Status.OK if i % 100 else Message.Status.ERROR,
+                ))
+                if len(chunk) == 10000:
+                    self.write_chunk(cursor, table, chunk)
+                    chunk = []
+            if chunk:
+                self.write_chunk(cursor, table, chunk)
+
+    def write_chunk(self, cursor, table, rows):
+        cursor.executemany(
+            f'INSERT INTO {table} (sensor_id, value, timestamp, status) VALUES (%s, %s, %s, %s)',
+            rows,
+        )
+
+    def measure(self, query, sensors, repeat):
+        started = time.perf_counter()
+        for i in range(repeat):
+            query(sensors[i % len(sensors)])
+        return (time.perf_counter() - started) / repeat * 1000
+
+    def range_query(self, sensor):
+        end = timezone.now()
+        list(Message.objects.filter(sensor=sensor, timestamp__range=(end - timedelta(hours=1), end)))
+
+    def latest_query(self, sensor):
+        sensor.messages.order_by('-timestamp').first()
+
+    def status_query(self, sensor):
+        list(Message.objects.filter(status=Message.Status.ERROR).order_by('-timestamp')[:100])
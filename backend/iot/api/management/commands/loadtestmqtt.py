@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Company, Controller, Sensor, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест приёма через настоящий брокер: публикует показания и ждёт, '
+        'пока запущенные startmqtt процессы запишут их в БД. Брокер — mqtt-brocker '
+        '(docker compose up), процессы приёма запускаются отдельно: startmqtt --workers N'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--controllers', type=int, default=20)
+        parser.add_argument('--sensors', type=int, default=5, help='Датчиков на контроллер')
+        parser.add_argument('--publishers', type=int, default=4, help='Параллельных соединений-издателей')
+        parser.add_argument('--rate', type=float, default=0, help='Сообщений в секунду на все соединения; 0 — без ограничения')
+        parser.add_argument('--timeout', type=float, default=120, help='Сколько секунд ждать записи всех показаний')
+        parser.add_argument('--broker-host', default=getattr(settings, 'MQTT_BROKER_HOST', 'localhost'))
+        parser.add_argument('--broker-port', type=int, default=getattr(settings, 'MQTT_BROKER_PORT', 1883))
+        parser.add_argument('--qos', type=int, choices=[0, 1], default=1)
+
+    def handle(self, *args, **options):
+        company = Company.objects.create(name=f"loadtest-{uuid.uuid4().hex[:8]}")
+        try:
+            sensors = []
+            for c in range(options['controllers']):
+                controller = Controller.objects.create(company=company, name=f"loadtest-{c}")
+                sensors.extend(
+                    Sensor.objects.create(
+                        controller=controller, name=f"loadtest-{s}", type=Sensor.SensorType.TEMPERATURE,
+                    )
+                    for s in range(options['sensors'])
+                )
+
+            # Время у каждого показания своё: одинаковые (датчик, время) отбрасываются как дубли
+            now = time.time()
+            messages = []
+            for i in range(options['messages']):
+                sensor = sensors[i % len(sensors)]
+                messages.append((
+                    f"controller/{sensor.controller.uuid}/sensors/{sensor.uuid}",
+                    json.dumps({"value": 20 + i % 10, "ts": now - i / 1000}),
+                ))
+
+            started = time.perf_counter()
+            published = self.publish(messages, options)
+            self.stdout.write(
+                f"published {len(messages)} messages in {published - started:.3f}s "
+                f"({len(messages) / (published - started):.0f} msg/s)"
+            )
+
+            stored = 0
+            deadline = published + options['timeout']
+            while time.perf_counter() < deadline:
+                stored = Message.objects.filter(sensor__controller__company=company).count()
+                if stored >= len(messages):
+                    break
+                time.sleep(0.2)
+            finished = time.perf_counter()
+
+            self.stdout.write(
+                f"stored {stored}/{len(messages)} in {finished - started:.3f}s "
+                f"({stored / (finished - started):.0f} msg/s), lag after publish {finished - published:.3f}s"
+            )
+            if stored < len(messages):
+                self.stderr.write(
+                    f"{len(messages) - stored} messages not stored within {options['timeout']}s — "
+                    f"is startmqtt running against {options['broker_host']}:{options['broker_port']}?"
+                )
+        finally:
+            company.delete()
+
+    def publish(self, messages, options):
+        publishers = options['publishers']
+        interval = publishers / options['rate'] if options['rate'] else 0
+        errors = []
+
+        def run(chunk):
+            client = mqtt.Client()
+            try:
+                client.connect(options['broker_host'], options['broker_port'], 60)
+            except OSError as e:
+                errors.append(e)
+                return
+            client.loop_start()
+            infos = []
+            next_at = time.perf_counter()
+            for topic, payload in chunk:
+                if interval:
+                    next_at += interval
+                    delay = next_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                infos.append(client.publish(topic, payload, qos=options['qos']))
+            for info in infos:
+                info.wait_for_publish(options['timeout'])
+            client.disconnect()
+            client.loop_stop()
+
+        threads = [
+            threading.Thread(target=run, args=(messages[i::publishers],))
+            for i in range(publishers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise CommandError(f"Cannot connect to MQTT broker: {errors[0]}")
+        return time.perf_counter()
@@ -0,0 +1,91 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.models import Message
+
+
+def month_start(day, offset=0):
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class Command(BaseCommand):
+    help = (
+        'Секционирует таблицу сообщений по месяцам (только PostgreSQL). '
+        'С --convert переводит существующую таблицу на секции, без него '
+        'создаёт секции на ближайшие месяцы — удобно запускать по cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', help='Перевести существующую таблицу на секции')
+        parser.add_argument('--months-ahead', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning is only supported on PostgreSQL.')
+
+        table = Message._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            if options['convert']:
+                self.convert(cursor, table, options['months_ahead'])
+            else:
+                self.create_partitions(cursor, table, month_start(date.today()), options['months_ahead'])
+
+    def create_partitions(self, cursor, table, first_month, months_ahead):
+        last_month = month_start(date.today(), months_ahead)
+        month = first_month
+        while month <= last_month:
+            next_month = month_start(month, 1)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}_y{month.year}m{month.month:02d}" '
+                f'PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                [month, next_month],
+            )
+            month = next_month
+        self.stdout.write(f'Partitions of {table} exist up to {last_month:%Y-%m}')
+
+    def convert(self, cursor, table, months_ahead):
+        cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [table])
+        if cursor.fetchone()[0] == 'p':
+            raise CommandError(f'{table} is already partitioned.')
+
+        old = f'{table}_unpartitioned'
+        cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{old}"')
+
+        # Первичный ключ секционированной таблицы обязан включать ключ секционирования
+        cursor.execute(
+            f'CREATE TABLE "{table}" (LIKE "{old}" INCLUDING DEFAULTS INCLUDING IDENTITY) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+        cursor.execute(f'ALTER TABLE "{table}" ADD PRIMARY KEY ("id", "timestamp")')
+        cursor.execute(
+            f'ALTER TABLE "{table}" ADD FOREIGN KEY ("sensor_id") '
+            f'REFERENCES "{Message._meta.get_field("sensor").related_model._meta.db_table}" ("id") '
+            f'DEFERRABLE INITIALLY DEFERRED'
+        )
+        cursor.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+
+        cursor.execute(f'SELECT MIN("timestamp") FROM "{old}"')
+        oldest = cursor.fetchone()[0]
+        self.create_partitions(cursor, table, month_start(oldest or date.today()), months_ahead)
+
+        cursor.execute(f'INSERT INTO "{table}" SELECT * FROM "{old}"')
+        cursor.execute(f'DROP TABLE "{old}"')
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f'COALESCE((SELECT MAX("id") FROM "{table}"), 1))'
+        )
+
+        # Индексы модели пересоздаются с теми же именами, что и в миграциях
+        with connection.schema_editor(atomic=False) as editor:
+            for index in Message._meta.indexes:
+                editor.add_index(Message, index)
+            for constraint in Message._meta.constraints:
+                editor.add_constraint(Message, constraint)
+            for field in Message._meta.local_fields:
+                if field.db_index and not field.primary_key:
+                    editor.execute(editor._create_index_sql(Message, fields=[field]))
+
+        self.stdout.write(f'{table} converted to a partitioned table')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.models import Message, MessageRollup
+from api.rollups import bucket_start, update_rollups
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает агрегаты 1m/1h/1d по уже сохранённым сообщениям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Начало периода в ISO 8601, по умолчанию вся история')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        messages = Message.objects.order_by('timestamp')
+        rollups = MessageRollup.objects.all()
+
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError('--since must be an ISO 8601 datetime.')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            # Начало периода может попасть в середину дневной корзины — её пересчитываем целиком
+            since = bucket_start(since, MessageRollup.Resolution.DAY)
+            messages = messages.filter(timestamp__gte=since)
+            rollups = rollups.filter(bucket__gte=since)
+
+        with transaction.atomic():
+            rollups.delete()
+
+            chunk = []
+            total = 0
+            for message in messages.iterator(chunk_size=options['chunk_size']):
+                chunk.append(message)
+                if len(chunk) == options['chunk_size']:
+                    update_rollups(chunk)
+                    total += len(chunk)
+                    chunk = []
+            update_rollups(chunk)
+            total += len(chunk)
+
+        self.stdout.write(f"Rolled up {total} messages")
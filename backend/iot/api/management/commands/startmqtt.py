@@ -1,9 +1,45 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from api.mqtt_client import start
 
 class Command(BaseCommand):
     help = 'Запускает MQTT клиент'
 
-    def handle(self, *args, **kwargs):
-        self.stdout.write("Запуск MQTT клиента...")
-        start()
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'MQTT_PROCESSES', 1),
+            help='Число процессов приёма; больше одного — под супервизором',
+        )
+        parser.add_argument(
+            '--mode', choices=['shared', 'hash'], default=getattr(settings, 'MQTT_SCALING_MODE', 'shared'),
+            help='shared — общие подписки MQTT v5, hash — разбиение контроллеров по хэшу uuid',
+        )
+        parser.add_argument(
+            '--engine', choices=['threads', 'asyncio'], default=getattr(settings, 'MQTT_ENGINE', 'threads'),
+            help='threads — paho и пул потоков, asyncio — конвейер на event loop',
+        )
+        parser.add_argument('--group', default=None, help='Имя группы общей подписки')
+        parser.add_argument(
+            '--drain-timeout', type=float, default=None,
+            help='Сколько секунд ждать дообработки после SIGTERM, прежде чем убить процесс',
+        )
+
+    def handle(self, *args, **options):
+        from api import logs
+
+        logs.configure()
+        if options['workers'] <= 1:
+            if options['engine'] == 'asyncio':
+                from api.async_ingest import start
+            else:
+                from api.mqtt_client import start
+
+            self.stdout.write("Запуск MQTT клиента...")
+            start()
+            return
+
+        from api.supervisor import WorkerSupervisor
+
+        self.stdout.write(f"Запуск {options['workers']} процессов MQTT клиента ({options['mode']})...")
+        WorkerSupervisor(
+            options['workers'], options['mode'], options['group'], options['drain_timeout'], options['engine'],
+        ).run()
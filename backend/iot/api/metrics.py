@@ -0,0 +1,291 @@
+"""
+Метрики в текстовом формате Prometheus.
+
+Счётчики и гистограммы живут в памяти процесса; каждый процесс отдаёт свои:
+веб-приложение — по ``/metrics``, процесс приёма MQTT — встроенным
+HTTP-сервером на ``MQTT_METRICS_PORT`` (воркер под супервизором — на порту
+``MQTT_METRICS_PORT + index``). Отдельная библиотека не нужна: формат
+простой, а обновление метрики — один захват блокировки.
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы по умолчанию для длительностей, в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _render_child(self, values, child):
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _child(self):
+        return _Value()
+
+    def _render_child(self, values, child):
+        yield f"{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(Metric):
+    """Значение задаётся ``set()`` или вычисляется при выдаче функцией из ``set_function()``."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            self.labels().set(self._function())
+        return super().render()
+
+    def _child(self):
+        return _Value()
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _HistogramValue:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.buckets[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _child(self):
+        return _HistogramValue(self.bounds)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            buckets = list(child.buckets)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip([*self.bounds, float("inf")], buckets):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, ("le", _format_value(bound)))
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def mqtt_topic_type(topic):
+    """Тип топика для меток: init, sensor, batch, command, status."""
+    parts = topic.split("/")
+    if parts[0] == "init":
+        return "init"
+    if len(parts) > 2 and parts[2] == "sensors":
+        return "batch" if parts[3:4] == ["batch"] else "sensor"
+    if len(parts) > 2 and parts[2] == "commands":
+        return "command"
+    if len(parts) > 4 and parts[4] == "status":
+        return "status"
+    return "other"
+
+
+# Приём MQTT
+
+MQTT_RECEIVED = registry.register(Counter(
+    "iot_mqtt_messages_received", "MQTT messages accepted by this process", ["topic"],
+))
+MQTT_DECODED = registry.register(Counter(
+    "iot_mqtt_messages_decoded", "MQTT messages with a valid payload", ["topic"],
+))
+MQTT_DROPPED = registry.register(Counter(
+    "iot_mqtt_messages_dropped", "MQTT messages dropped before storing", ["topic", "reason"],
+))
+MQTT_HANDLER_SECONDS = registry.register(Histogram(
+    "iot_mqtt_handler_seconds", "Time spent handling one MQTT message", ["topic"],
+))
+MQTT_QUEUE_DEPTH = registry.register(Gauge(
+    "iot_mqtt_queue_depth", "Messages waiting in ingestion queues",
+))
+
+# Запись показаний
+
+READINGS_STORED = registry.register(Counter(
+    "iot_readings_stored", "Sensor readings inserted into the database",
+))
+READINGS_DUPLICATE = registry.register(Counter(
+    "iot_readings_duplicate", "Sensor readings skipped as already stored",
+))
+READINGS_DROPPED = registry.register(Counter(
+    "iot_readings_dropped", "Buffered sensor readings lost because the database stayed unavailable",
+))
+DB_FLUSH_SECONDS = registry.register(Histogram(
+    "iot_db_flush_seconds", "Duration of one batch write of readings",
+))
+DB_FLUSH_SIZE = registry.register(Histogram(
+    "iot_db_flush_batch_size", "Readings per batch write",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+))
+DB_FLUSH_FAILURES = registry.register(Counter(
+    "iot_db_flush_failures", "Batch writes of readings that failed",
+))
+
+# Уведомления
+
+ALERTS_SENT = registry.register(Counter(
+    "iot_alerts_sent", "Telegram alert messages delivered",
+))
+ALERTS_FAILED = registry.register(Counter(
+    "iot_alerts_failed", "Telegram alert messages that failed or were dropped", ["reason"],
+))
+
+# Логи
+
+LOG_RECORDS_DROPPED = registry.register(Counter(
+    "iot_log_records_dropped", "Log records suppressed by sampling, rate limits or a full queue", ["reason"],
+))
+
+# HTTP API
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    "iot_http_request_seconds", "API request latency", ["view", "method"],
+))
+HTTP_RESPONSES = registry.register(Counter(
+    "iot_http_responses", "API responses by status code", ["view", "method", "status"],
+))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опрос раз в несколько секунд не должен попадать в лог
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """
+    Отдаёт /metrics из фонового потока; для процессов без Django-сервера.
+    Проверки доступа нет, поэтому по умолчанию слушается только localhost.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Metrics server failed to listen on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on {host}:{port}")
+    return server
@@ -0,0 +1,29 @@
+import time
+
+from .metrics import HTTP_REQUEST_SECONDS, HTTP_RESPONSES
+
+# Прочие методы попадают в метку "other": произвольная строка из запроса не должна плодить ряды
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class RequestMetricsMiddleware:
+    """
+    Задержка и коды ответов по эндпоинтам. Метка — имя маршрута
+    (``sensor-list``, ``relay-control``), а не путь: uuid в путях не
+    должны плодить ряды метрик.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = (match.view_name or match.url_name or "unnamed") if match is not None else "unmatched"
+        method = request.method if request.method in METHODS else "other"
+        HTTP_REQUEST_SECONDS.labels(view, method).observe(elapsed)
+        HTTP_RESPONSES.labels(view, method, response.status_code).inc()
+        return response
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:27
+
+from django.db import migrations, models
+
+import api.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('api', '0012_message_status_ts_idx'),
+    ]
+
+    operations = [
+        api.operations.AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['sensor', '-timestamp'], name='message_sensor_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_message_sensor_ts_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('bucket', models.DateTimeField()),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('sum', models.FloatField()),
+                ('count', models.PositiveIntegerField()),
+                ('last', models.FloatField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('sensor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='api.sensor')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagerollup',
+            constraint=models.UniqueConstraint(fields=('sensor', 'resolution', 'bucket'), name='rollup_sensor_bucket_uniq'),
+        ),
+    ]
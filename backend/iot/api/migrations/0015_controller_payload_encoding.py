@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_messagerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='controller',
+            name='payload_encoding',
+            field=models.CharField(choices=[('json', 'JSON'), ('struct', 'Binary struct'), ('msgpack', 'MessagePack')], default='json', max_length=10),
+        ),
+    ]
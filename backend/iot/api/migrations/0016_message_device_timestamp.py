@@ -0,0 +1,73 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:37
+
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+import django.utils.timezone
+
+# Длительность корзин агрегатов на момент миграции, как в MessageRollup.SECONDS
+ROLLUP_SECONDS = {'1m': 60, '1h': 60 * 60, '1d': 24 * 60 * 60}
+
+
+def bucket_start(timestamp, seconds):
+    epoch = int(timestamp.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    До ограничения уникальности одинаковые (sensor, timestamp) могли попасть
+    в таблицу. Повторы уже учтены в агрегатах, поэтому затронутые корзины
+    пересчитываются по оставшимся строкам здесь же, без rebuildrollups.
+    """
+    Message = apps.get_model('api', 'Message')
+    MessageRollup = apps.get_model('api', 'MessageRollup')
+    duplicates = list(
+        Message.objects.values('sensor_id', 'timestamp')
+        .annotate(keep=Min('id'), count=Count('id'))
+        .filter(count__gt=1)
+    )
+
+    affected = set()
+    for row in duplicates:
+        Message.objects.filter(sensor_id=row['sensor_id'], timestamp=row['timestamp']).exclude(id=row['keep']).delete()
+        for resolution, seconds in ROLLUP_SECONDS.items():
+            affected.add((row['sensor_id'], resolution, bucket_start(row['timestamp'], seconds)))
+
+    for sensor_id, resolution, bucket in affected:
+        messages = Message.objects.filter(
+            sensor_id=sensor_id, timestamp__gte=bucket,
+            timestamp__lt=bucket + timedelta(seconds=ROLLUP_SECONDS[resolution]),
+        )
+        last = messages.order_by('-timestamp', '-id').values('value', 'timestamp').first()
+        # Корзины, которых ещё нет (агрегаты не строились), не создаются
+        MessageRollup.objects.filter(sensor_id=sensor_id, resolution=resolution, bucket=bucket).update(
+            **messages.aggregate(min=Min('value'), max=Max('value'), sum=Sum('value'), count=Count('id')),
+            last=last['value'],
+            last_timestamp=last['timestamp'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_controller_payload_encoding'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('sensor', 'timestamp'), name='message_sensor_ts_uniq'),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_sensor_ts_idx',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_message_device_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=100)),
+                ('received', models.PositiveIntegerField(default=0)),
+                ('stored', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('controller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingest_batches', to='api.controller')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ingestbatch',
+            constraint=models.UniqueConstraint(fields=('controller', 'idempotency_key'), name='ingest_batch_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_ingestbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelayStateLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_working', models.BooleanField()),
+                ('source', models.CharField(choices=[('command', 'Command'), ('status', 'Controller status'), ('manual', 'Manual control')], max_length=10)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('relay', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='state_log', to='api.relay')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['relay', '-timestamp'], name='relay_state_ts_idx')],
+            },
+        ),
+    ]
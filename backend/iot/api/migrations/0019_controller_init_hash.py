@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-18 03:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_relaystatelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='controller',
+            name='init_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
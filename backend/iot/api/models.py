@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
+from django.utils import timezone
 import uuid
 
 
@@ -56,6 +58,11 @@ class User(AbstractUser):
 
 
 class Controller(models.Model):
+    class PayloadEncoding(models.TextChoices):
+        JSON = "json", "JSON"
+        STRUCT = "struct", "Binary struct"
+        MSGPACK = "msgpack", "MessagePack"
+
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
     uuid = models.UUIDField(unique=True, default=uuid.uuid4)
     name = models.CharField(max_length=100)
@@ -65,6 +72,12 @@ class Controller(models.Model):
         choices=(("manual", "Manual"), ("auto", "Auto")),
         default="manual"
     )
+    # Формат показаний датчиков, о котором контроллер сообщает в init
+    payload_encoding = models.CharField(
+        max_length=10, choices=PayloadEncoding.choices, default=PayloadEncoding.JSON
+    )
+    # sha256 последнего применённого init: повторный init с тем же содержимым не трогает БД
+    init_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -100,6 +113,25 @@ class Sensor(models.Model):
     def company(self):
         return self.controller.company if self.controller else None
 
+    def get_status(self, value):
+        low, high = self.critical_min, self.critical_max
+
+        if (low is not None and value < low) or (high is not None and value > high):
+            return Message.Status.ERROR
+
+        # Зона предупреждения — доля диапазона у каждой из границ; при одной границе
+        # диапазона нет, и доля берётся от самой границы, а у нулевой — абсолютный запас
+        band = getattr(settings, "SENSOR_WARNING_BAND", 0.1)
+        if low is not None and high is not None:
+            margin = (high - low) * band
+        else:
+            limit = low if low is not None else high
+            margin = abs(limit or 0) * band or getattr(settings, "SENSOR_WARNING_MARGIN", 1.0)
+
+        if (low is not None and value < low + margin) or (high is not None and value > high - margin):
+            return Message.Status.WARNING
+        return Message.Status.OK
+
 
 class Relay(models.Model):
     class RelayType(models.TextChoices):
@@ -121,6 +153,27 @@ class Relay(models.Model):
         return f"{self.name} ({self.type}) - {'ON' if self.is_working else 'OFF'}"
 
 
+class RelayStateLog(models.Model):
+    """История переключений реле: строка пишется только при смене состояния."""
+    class Source(models.TextChoices):
+        COMMAND = "command", "Command"
+        STATUS = "status", "Controller status"
+        MANUAL = "manual", "Manual control"
+
+    relay = models.ForeignKey(Relay, on_delete=models.CASCADE, related_name='state_log')
+    is_working = models.BooleanField()
+    source = models.CharField(max_length=10, choices=Source.choices)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["relay", "-timestamp"], name="relay_state_ts_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.timestamp}: {self.relay.name} -> {'ON' if self.is_working else 'OFF'} ({self.source})"
+
+
 class Message(models.Model):
     class Status(models.TextChoices):
         OK = "ok", "OK"
@@ -129,13 +182,59 @@ class Message(models.Model):
 
     sensor = models.ForeignKey(Sensor, on_delete=models.CASCADE, related_name='messages')
     value = models.FloatField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Время измерения на устройстве; если контроллер его не прислал — время приёма
+    timestamp = models.DateTimeField(default=timezone.now)
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.OK)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "timestamp"], name="message_status_ts_idx"),
+        ]
+        constraints = [
+            # Повторная выгрузка того же показания не создаёт дубликат.
+            # Индекс ограничения заменяет прежний message_sensor_ts_idx
+            models.UniqueConstraint(fields=["sensor", "timestamp"], name="message_sensor_ts_uniq"),
+        ]
+
     def __str__(self):
         return f"{self.sensor.name}: {self.value} ({self.status})"
 
 
+class MessageRollup(models.Model):
+    class Resolution(models.TextChoices):
+        MINUTE = "1m", "1 minute"
+        HOUR = "1h", "1 hour"
+        DAY = "1d", "1 day"
+
+    SECONDS = {
+        Resolution.MINUTE: 60,
+        Resolution.HOUR: 60 * 60,
+        Resolution.DAY: 24 * 60 * 60,
+    }
+
+    sensor = models.ForeignKey(Sensor, on_delete=models.CASCADE, related_name='rollups')
+    resolution = models.CharField(max_length=2, choices=Resolution.choices)
+    bucket = models.DateTimeField()
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+    count = models.PositiveIntegerField()
+    last = models.FloatField()
+    last_timestamp = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["sensor", "resolution", "bucket"], name="rollup_sensor_bucket_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.sensor.name} [{self.resolution} {self.bucket}]: {self.avg}"
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else None
+
+
 class ManualControlLog(models.Model):
     controller = models.ForeignKey(Controller, on_delete=models.CASCADE, related_name='manual_logs')
     relay = models.ForeignKey(Relay, on_delete=models.CASCADE)
@@ -145,3 +244,21 @@ class ManualControlLog(models.Model):
 
     def __str__(self):
         return f"{self.timestamp}: {self.relay.name} -> {self.action}"
+
+
+class IngestBatch(models.Model):
+    """Выгрузка накопленных показаний по HTTP; ключ идемпотентности защищает от повторной отправки."""
+    controller = models.ForeignKey(Controller, on_delete=models.CASCADE, related_name='ingest_batches')
+    idempotency_key = models.CharField(max_length=100)
+    received = models.PositiveIntegerField(default=0)
+    stored = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["controller", "idempotency_key"], name="ingest_batch_key_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.controller.name} [{self.idempotency_key}]: {self.stored}/{self.received}"
@@ -1,38 +1,70 @@
 import os
 import json
 import uuid
+import signal
+import hashlib
 import django
+from datetime import timedelta
 import logging
 import paho.mqtt.client as mqtt
-import requests
-from django.utils.timezone import localtime
-from api.models import User
-
 from django.conf import settings
+from django.utils.timezone import now
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "iot.settings")
 django.setup()
 
-from api.models import Controller, Sensor, Message, Company, Relay
+from api.models import Sensor, Message, RelayStateLog
+from api.ingest import MessageBuffer, resolve_timestamp
+from api.registry import registry
+from api.dispatcher import HandlerDispatcher
+from api.alerts import AlertDispatcher
+from api.relays import RelayStateWriter
+from api.live import get_broker
+from api.latest import make_record
+from api.codecs import decode_reading, decode_batch, finite
+from api.provisioning import init_hash, is_unchanged, provision
+from api import logs, metrics
+from api.metrics import MQTT_DECODED, MQTT_DROPPED
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-BROKER_HOST = 'localhost'
-BROKER_PORT = 1883
+BROKER_HOST = settings.MQTT_BROKER_HOST
+BROKER_PORT = settings.MQTT_BROKER_PORT
 
 client = mqtt.Client()
 
+# Показания датчиков пишутся в БД пачками, а не по одному INSERT на сообщение
+message_buffer = MessageBuffer()
+
+# Обработчики выполняются в пуле потоков, сетевой поток paho только принимает сообщения
+dispatcher = HandlerDispatcher()
+
+# Уведомления в Telegram уходят из отдельного потока
+alert_dispatcher = AlertDispatcher()
+
+# Состояния реле пишутся в БД пачками и только при изменении
+relay_writer = RelayStateWriter()
+
+# Показания старше этого порога считаются выгрузкой накопленного и не идут в живой поток и алерты
+LATE_THRESHOLD = timedelta(seconds=getattr(settings, "MQTT_LATE_THRESHOLD", 60))
+
 # Подключение
 
-def on_connect(client, userdata, flags, rc):
+TOPICS = [
+    "init/+",
+    "controller/+/sensors/+",
+    "controller/+/commands/+",
+    "controller/+/relays/+/status",
+]
+
+# Фильтры подписки; в режиме общих подписок start() добавляет к ним $share/<group>/
+subscriptions = list(TOPICS)
+
+def on_connect(client, userdata, flags, rc, properties=None):
     logger.info(f"Connected to MQTT broker with result code {rc}")
 
-    client.subscribe("init/+")
-    client.subscribe("controller/+/sensors/+")
-    client.subscribe("controller/+/commands/+")
-    client.subscribe("controller/+/relays/+/status")
+    for topic in subscriptions:
+        client.subscribe(topic)
 
 # Обработчики сообщений
 
@@ -43,7 +75,8 @@ logger = logging.getLogger(__name__)
 
 def handle_init(client, userdata, msg):
     controller_uuid = msg.topic.split("/")[1]  # "init/{uuid}"
-    logger.info(f"Received init message on topic '{msg.topic}' with payload: {msg.payload!r}\n\n")
+    logger.info(f"Received init message on topic '{msg.topic}' ({len(msg.payload)} bytes)")
+    logger.debug("Init payload: %r", msg.payload, extra={"log_key": controller_uuid})
 
     try:
         # Попытка декодировать JSON
@@ -51,141 +84,136 @@ def handle_init(client, userdata, msg):
             payload = json.loads(msg.payload.decode())
         except json.JSONDecodeError as e:
             logger.error(f"Failed to decode JSON: {e}")
+            MQTT_DROPPED.labels("init", "invalid").inc()
             return
 
         if not isinstance(payload, dict):
             logger.error(f"Expected JSON object, got: {type(payload).__name__}")
+            MQTT_DROPPED.labels("init", "invalid").inc()
             return
 
-        api_key = payload.get("api_key")
-        name = payload.get("name")
-        company_name = payload.get("company_name")
-        sensors = payload.get("sensors", [])
-        relays = payload.get("relays", [])
-
-        if not company_name:
+        if not payload.get("company_name"):
             logger.warning("company_name not provided")
+            MQTT_DROPPED.labels("init", "invalid").inc()
             return
+        MQTT_DECODED.labels("init").inc()
 
-        company, _ = Company.objects.get_or_create(name=company_name)
-
-        controller, created = Controller.objects.get_or_create(
-            uuid=controller_uuid,
-            defaults={
-                "api_key": api_key,
-                "name": name,
-                "company": company
-            }
-        )
+        # При массовой перезагрузке контроллеры присылают тот же init — его можно пропустить
+        payload_hash = init_hash(payload)
+        if is_unchanged(controller_uuid, payload_hash):
+            logger.info("Init for controller %s unchanged, skipped", controller_uuid, extra={"log_key": controller_uuid})
+            return
 
-        for sensor in sensors:
-            try:
-                Sensor.objects.get_or_create(
-                    controller=controller,
-                    name=sensor["name"],
-                    type=sensor["type"],
-                    uuid=sensor["uuid"],
-                    unit_of_measurements=sensor["unit_of_measurements"]
-                )
-            except KeyError as e:
-                logger.warning(f"Missing sensor field: {e}")
-            except Exception as e:
-                logger.error(f"Error creating sensor: {e}")
-
-        for relay in relays:
-            try:
-                Relay.objects.get_or_create(
-                    controller=controller,
-                    name=relay["name"],
-                    uuid=relay["uuid"],
-                    defaults={"description": relay.get("description", "")}
-                )
-            except KeyError as e:
-                logger.warning(f"Missing relay field: {e}")
-            except Exception as e:
-                logger.error(f"Error creating relay: {e}")
-
-        logger.info(f"Controller '{controller.name}' initialized under company '{company.name}'\n\n")
+        provision(controller_uuid, payload, payload_hash)
 
     except Exception as e:
         logger.exception("Init handling error")
+        MQTT_DROPPED.labels("init", "error").inc()
 
 
-def handle_sensor_data(client, userdata, msg):
-    topic_parts = msg.topic.split("/")
-    controller_uuid = topic_parts[1]
-    sensor_uuid = topic_parts[3]
+def ingest_reading(sensor, value, ts=None):
+    value = finite(value)
+    received_at = now()
+    timestamp = resolve_timestamp(ts, received_at)
 
-    try:
-        controller = Controller.objects.get(uuid=controller_uuid)
-        sensor = Sensor.objects.get(uuid=sensor_uuid, controller=controller)
+    # Кладём сообщение в буфер, в БД оно попадёт при следующем сбросе
+    status = sensor.get_status(value)
+    message = Message(sensor=sensor, value=value, status=status, timestamp=timestamp)
+    message_buffer.add(message)
+    # Строка на каждое показание прореживается по датчику (api/logs.py), поэтому без f-строки
+    logger.info("Buffered sensor data: %s = %s (%s)", sensor.name, value, status, extra={"log_key": sensor.pk})
 
-        payload = json.loads(msg.payload.decode())
-        value = float(payload["value"])
+    # Запоздавшие показания только сохраняются: они не текущие и не повод для тревоги
+    if received_at - timestamp > LATE_THRESHOLD:
+        return
 
-        # Сохраняем сообщение
-        message = Message.objects.create(sensor=sensor, value=value, status=Message.Status.OK)
-        logger.info(f"Saved sensor data: {sensor.name} = {value}")
+    # Подписчики живого потока получают показание сразу, не дожидаясь записи в БД
+    get_broker().publish(make_record(message))
 
-        # Проверка на критические значения
-        is_critical = (
-            (sensor.critical_min is not None and value < sensor.critical_min)
-            or
-            (sensor.critical_max is not None and value > sensor.critical_max)
-        )
+    # Уведомления отправляются в фоне и только при смене состояния датчика
+    alert_dispatcher.check(sensor, value, message.timestamp)
 
-        if is_critical:
-            timestamp = localtime(message.timestamp).strftime("%Y-%m-%d %H:%M:%S")
-
-            message_text = (
-                f"⚠️ Критическое значение!\n"
-                f"📊 Сенсор: {sensor.name}\n"
-                f"📦​ Тип: {sensor.type}\n"
-                f"📈 Значение: {value} {sensor.unit_of_measurements} \n"
-                f"📟 Контроллер: {sensor.controller.name}\n"
-                f"🌿 Компания: {sensor.controller.company.name}\n"
-                f"Время: {timestamp}"
-            )
-            send_telegram_alert(sensor.company, message_text)
 
+def handle_sensor_data(client, userdata, msg):
+    topic_parts = msg.topic.split("/")
+    controller_uuid = topic_parts[1]
+    sensor_uuid = topic_parts[3]
+
+    # controller/+/sensors/batch подпадает под тот же фильтр, что и одиночные показания
+    if sensor_uuid == "batch":
+        handle_sensor_batch(client, userdata, msg)
+        return
+
+    try:
+        sensor = registry.get_sensor(controller_uuid, sensor_uuid)
+        value, ts = decode_reading(sensor.controller.payload_encoding, msg.payload)
+        MQTT_DECODED.labels("sensor").inc()
+        ingest_reading(sensor, float(value), ts)
+
+    except Sensor.DoesNotExist:
+        logger.warning("Unknown sensor on topic '%s'", msg.topic, extra={"log_key": controller_uuid})
+        MQTT_DROPPED.labels("sensor", "unknown").inc()
+    except ValueError as e:
+        logger.warning("Invalid reading on topic '%s': %s", msg.topic, e, extra={"log_key": controller_uuid})
+        MQTT_DROPPED.labels("sensor", "invalid").inc()
     except Exception as e:
         logger.exception("Sensor data handling error")
+        MQTT_DROPPED.labels("sensor", "invalid").inc()
+
 
+def handle_sensor_batch(client, userdata, msg):
+    controller_uuid = msg.topic.split("/")[1]
 
-def send_telegram_alert(company, message_text):
-    users = company.user_set.filter(role=User.Role.MANAGER, telegram_id__isnull=False).exclude(telegram_id='')
+    try:
+        controller = registry.get_controller(controller_uuid)
+        readings = decode_batch(controller.payload_encoding, msg.payload)
+    except Exception as e:
+        logger.exception("Sensor batch decoding error")
+        MQTT_DROPPED.labels("batch", "invalid").inc()
+        return
+    MQTT_DECODED.labels("batch").inc()
 
-    for user in users:
+    for sensor_uuid, value, ts in readings:
         try:
-            requests.post(
-                f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
-                json={
-                    "chat_id": user.telegram_id,
-                    "text": message_text,
-                }
+            ingest_reading(registry.get_sensor(controller_uuid, sensor_uuid), value, ts)
+        except Sensor.DoesNotExist:
+            logger.warning(
+                "Unknown sensor '%s' in batch from controller '%s'", sensor_uuid, controller_uuid,
+                extra={"log_key": controller_uuid},
+            )
+        except ValueError as e:
+            logger.warning(
+                "Invalid reading of sensor '%s' in batch: %s", sensor_uuid, e, extra={"log_key": controller_uuid},
             )
+            MQTT_DROPPED.labels("batch", "invalid").inc()
         except Exception as e:
-            logger.error(f"Error sending Telegram message to {user.email}: {e}")
+            logger.exception("Sensor data handling error")
+
+
+def parse_relay_state(payload):
+    data = json.loads(payload.decode())
+    is_working = data.get("is_working")
+    if not isinstance(is_working, bool):
+        raise ValueError(f"is_working must be boolean, got {is_working!r}")
+    return is_working, data.get("command_id")
 
 
 def handle_command(client, userdata, msg):
     topic_parts = msg.topic.split("/")
-    controller_uuid = topic_parts[1]
     relay_uuid = topic_parts[3]
 
     try:
-        payload = json.loads(msg.payload.decode())
-        is_working = payload.get("is_working")
+        is_working, command_id = parse_relay_state(msg.payload)
+        MQTT_DECODED.labels("command").inc()
 
-        controller = Controller.objects.get(uuid=controller_uuid)
-        relay = Relay.objects.get(controller=controller, uuid=relay_uuid)
-
-        relay.is_working = is_working
-        relay.save()
-
-        logger.info(f"Relay '{relay.name}' updated: is_working = {relay.is_working}")
+        # Команда ещё не исполнена: состояние реле записывается только по его статусу
+        logger.info(
+            "Command for relay '%s': is_working = %s (command_id %s)", relay_uuid, is_working, command_id,
+            extra={"log_key": relay_uuid},
+        )
     except Exception as e:
         logger.exception("Command handling error")
+        MQTT_DROPPED.labels("command", "invalid").inc()
 
 def handle_relay_status(client, userdata, msg):
     topic_parts = msg.topic.split("/")
@@ -193,31 +221,97 @@ def handle_relay_status(client, userdata, msg):
     relay_uuid = topic_parts[3]
 
     try:
-        payload = json.loads(msg.payload.decode())
-        is_working = payload.get("is_working")
+        is_working, _ = parse_relay_state(msg.payload)
+        MQTT_DECODED.labels("status").inc()
+        relay = registry.get_relay(controller_uuid, relay_uuid)
 
-        controller = Controller.objects.get(uuid=controller_uuid)
-        relay = Relay.objects.get(controller=controller, uuid=relay_uuid)
+        relay_writer.update(relay, is_working, RelayStateLog.Source.STATUS)
 
-        relay.is_working = is_working
-        relay.save()
-
-        logger.info(f"Relay '{relay.name}' status synced: is_working = {is_working}")
+        logger.info("Relay '%s' status synced: is_working = %s", relay.name, is_working, extra={"log_key": relay.pk})
     except Exception as e:
         logger.exception("Relay status handling error")
+        MQTT_DROPPED.labels("status", "invalid").inc()
 
 # Главный запуск
 
-def start():
-    client.on_connect = on_connect
+def partition(topic, workers):
+    """
+    Номер процесса, за которым закреплён контроллер из топика.
+    Хэш отличается от crc32 диспетчера, иначе часть его потоков простаивала бы.
+    """
+    key = topic.split("/")[1].encode()
+    return int.from_bytes(hashlib.md5(key).digest()[:4], "big") % workers
+
+
+def partitioned(callback, index, workers):
+    """Пропускает только сообщения контроллеров, закреплённых за этим процессом."""
+    def filtered(client, userdata, msg):
+        if partition(msg.topic, workers) == index:
+            callback(client, userdata, msg)
+    return filtered
+
+
+def drain(signum, frame):
+    # Отписка первой: общая группа сразу отдаёт новые сообщения другим процессам,
+    # а уже принятые дорабатываются в finally блока start()
+    logger.info("Shutdown requested, draining")
+    client.unsubscribe(subscriptions)
+    client.disconnect()
 
-    client.message_callback_add("init/+", handle_init)
-    client.message_callback_add("controller/+/sensors/+", handle_sensor_data)
-    client.message_callback_add("controller/+/commands/+", handle_command)
-    client.message_callback_add("controller/+/relays/+/status", handle_relay_status)
 
-    client.connect(BROKER_HOST, BROKER_PORT, 60)
-    client.loop_forever()
+def start(workers=1, index=0, mode="shared", group=None):
+    """
+    Запускает приём. При ``workers > 1`` процесс — один из нескольких:
+    ``shared`` — общая подписка MQTT v5, брокер раздаёт сообщения по процессам;
+    ``hash`` — каждый процесс получает всё и обрабатывает свою долю контроллеров,
+    порядок сообщений одного контроллера при этом сохраняется.
+    """
+    global client
+
+    # Логирование процесса приёма: JSON, прореживание по ключу и вывод из отдельного потока
+    logs.configure()
+
+    if workers > 1 and mode == "shared":
+        group = group or getattr(settings, "MQTT_SHARE_GROUP", "iot-ingest")
+        client = mqtt.Client(protocol=mqtt.MQTTv5)
+        subscriptions[:] = [f"$share/{group}/{topic}" for topic in TOPICS]
+
+    client.on_connect = on_connect
+
+    handlers = {
+        "init/+": handle_init,
+        "controller/+/sensors/+": handle_sensor_data,
+        "controller/+/commands/+": handle_command,
+        "controller/+/relays/+/status": handle_relay_status,
+    }
+    for topic, handler in handlers.items():
+        callback = dispatcher.wrap(handler)
+        if workers > 1 and mode == "hash":
+            callback = partitioned(callback, index, workers)
+        client.message_callback_add(topic, callback)
+
+    # SIGTERM завершает цикл штатно, чтобы успеть сбросить буфер
+    signal.signal(signal.SIGTERM, drain)
+
+    # Под супервизором у каждого процесса свой порт
+    port = getattr(settings, "MQTT_METRICS_PORT", None)
+    if port:
+        metrics.start_http_server(port + index, getattr(settings, "MQTT_METRICS_ADDR", "127.0.0.1"))
+    metrics.MQTT_QUEUE_DEPTH.set_function(lambda: dispatcher.queue_depth() + len(message_buffer))
+
+    registry.warm()
+    message_buffer.start()
+    relay_writer.start()
+    alert_dispatcher.start()
+    dispatcher.start()
+    try:
+        client.connect(BROKER_HOST, BROKER_PORT, 60)
+        client.loop_forever()
+    finally:
+        dispatcher.stop()
+        message_buffer.close()
+        relay_writer.close()
+        alert_dispatcher.stop()
 
 if __name__ == "__main__":
     start()
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """
+    AddIndex, который на PostgreSQL строит индекс через CREATE INDEX
+    CONCURRENTLY и не блокирует запись в таблицу. На остальных СУБД — обычный
+    AddIndex. Миграция с этой операцией должна быть ``atomic = False``.
+
+    django.contrib.postgres импортируется только на PostgreSQL: ему нужен
+    psycopg, которого может не быть при локальном запуске на SQLite.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._operation(schema_editor).database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._operation(schema_editor).database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def _operation(self, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return migrations.AddIndex(self.model_name, self.index)
+        from django.contrib.postgres.operations import AddIndexConcurrently
+        return AddIndexConcurrently(self.model_name, self.index)
@@ -0,0 +1,97 @@
+import base64
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset-пагинация по (timestamp, id).
+
+    Курсор хранит последнюю отданную пару, и следующая страница выбирается
+    условием ``(timestamp, id) > курсор`` по индексу, поэтому стоимость
+    страницы не зависит от её номера.
+    """
+
+    time_field = 'timestamp'
+    page_size = 1000
+    max_page_size = 10000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def paginate_queryset(self, queryset, request, view=None, page_size=None):
+        """``page_size`` задаёт размер страницы вместо параметра запроса и ограничения max_page_size."""
+        self.request = request
+        self.page_size = page_size or self.get_page_size(request)
+
+        queryset = queryset.order_by(self.time_field, 'id')
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            timestamp, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f'{self.time_field}__gt': timestamp}) | Q(**{self.time_field: timestamp, 'id__gt': pk})
+            )
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.last = rows[-1] if rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # Строки приходят либо словарями из values(), либо экземплярами модели
+        if isinstance(self.last, dict):
+            timestamp, pk = self.last[self.time_field], self.last['id']
+        else:
+            timestamp, pk = getattr(self.last, self.time_field), self.last.pk
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(timestamp, pk))
+
+    def encode_cursor(self, timestamp, pk):
+        return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{pk}".encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError
+            return timestamp, int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor.')
+
+
+class RollupCursorPagination(MessageCursorPagination):
+    """Та же keyset-пагинация для агрегатов — по (bucket, id)."""
+
+    time_field = 'bucket'
@@ -1,4 +1,5 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from .models import Controller
 
 class IsSuperUser(BasePermission):
     def has_permission(self, request, view):
@@ -19,3 +20,11 @@ class IsCompanyUser(BasePermission):
         if hasattr(obj, 'sensor'):  # Message
             return obj.sensor.controller.company == request.user.company
         return False
+
+
+class IsController(BasePermission):
+    """
+    Доступ для контроллера, аутентифицированного по x-api-key.
+    """
+    def has_permission(self, request, view):
+        return isinstance(request.user, Controller)
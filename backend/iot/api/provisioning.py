@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import uuid
+
+from django.db import transaction
+
+from .codecs import supported_encodings
+from .models import Company, Controller, Sensor, Relay
+from .publisher import PublishError, get_publisher
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+# Поля, которые описывает сам контроллер; остальное (пороги, описания) правится в API
+SENSOR_FIELDS = ["name", "type", "unit_of_measurements"]
+RELAY_FIELDS = ["name"]
+
+
+def init_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def is_unchanged(controller_uuid, payload_hash):
+    try:
+        return registry.get_controller(controller_uuid).init_hash == payload_hash
+    except Controller.DoesNotExist:
+        return False
+
+
+def _announced(items, required, kind):
+    """
+    Объявленные элементы по uuid. Элементы без обязательных полей или с
+    неверным uuid пропускаются, чтобы одна ошибка не откатывала весь init.
+    """
+    result = {}
+    for item in items:
+        missing = [field for field in required if not isinstance(item, dict) or field not in item]
+        if missing:
+            logger.warning(f"Missing {kind} field: {', '.join(missing)}")
+            continue
+        try:
+            item_uuid = str(uuid.UUID(str(item["uuid"])))
+        except ValueError:
+            logger.warning(f"Invalid {kind} uuid {item['uuid']!r}, skipped")
+            continue
+        result[item_uuid] = {**item, "uuid": item_uuid}
+    return result
+
+
+def _sync(model, controller, announced, fields, build):
+    """
+    Приводит строки ``model`` к объявленным: одна выборка по uuid, затем
+    bulk_create для новых и bulk_update для изменившихся.
+    """
+    existing = {str(obj.uuid): obj for obj in model.objects.filter(uuid__in=announced)}
+
+    created, updated = [], []
+    for item_uuid, item in announced.items():
+        obj = existing.get(item_uuid)
+        if obj is None:
+            created.append(build(item))
+            continue
+        if obj.controller_id != controller.pk:
+            logger.error(f"{model.__name__} {item_uuid} belongs to another controller, skipped")
+            continue
+        changed = False
+        for field in fields:
+            if getattr(obj, field) != item[field]:
+                setattr(obj, field, item[field])
+                changed = True
+        if changed:
+            updated.append(obj)
+
+    model.objects.bulk_create(created)
+    if updated:
+        model.objects.bulk_update(updated, fields)
+    return len(created), len(updated)
+
+
+def provision(controller_uuid, payload, payload_hash=None):
+    """
+    Применяет init-сообщение одной транзакцией: компания, контроллер, датчики
+    и реле. Ошибка откатывает всё, частично применённого init не бывает.
+    """
+    company_name = payload["company_name"]
+    requested = payload.get("encoding", Controller.PayloadEncoding.JSON)
+    # Формат показаний согласуется при каждом init: контроллер мог обновить прошивку
+    encoding = requested
+    if encoding not in supported_encodings():
+        encoding = Controller.PayloadEncoding.JSON
+
+    sensors = _announced(payload.get("sensors", []), ["uuid", *SENSOR_FIELDS], "sensor")
+    relays = _announced(payload.get("relays", []), ["uuid", "name"], "relay")
+
+    with transaction.atomic():
+        company, _ = Company.objects.get_or_create(name=company_name)
+        controller, _ = Controller.objects.select_for_update().get_or_create(
+            uuid=controller_uuid,
+            defaults={
+                "api_key": payload.get("api_key"),
+                "name": payload.get("name"),
+                "company": company,
+            },
+        )
+
+        sensor_counts = _sync(
+            Sensor, controller, sensors, SENSOR_FIELDS,
+            lambda item: Sensor(controller=controller, uuid=item["uuid"], **{f: item[f] for f in SENSOR_FIELDS}),
+        )
+        relay_counts = _sync(
+            Relay, controller, relays, RELAY_FIELDS,
+            lambda item: Relay(
+                controller=controller, uuid=item["uuid"], name=item["name"],
+                type=item.get("type", ""), description=item.get("description", ""),
+            ),
+        )
+
+        # Сохранение контроллера через save() сбрасывает его кэши сигналом,
+        # в том числе датчики и реле, изменённые bulk-операциями без сигналов
+        controller.payload_encoding = encoding
+        controller.init_hash = payload_hash or init_hash(payload)
+        controller.save(update_fields=["payload_encoding", "init_hash"])
+
+    logger.info(
+        f"Controller '{controller.name}' initialized under company '{company.name}': "
+        f"sensors +{sensor_counts[0]}/~{sensor_counts[1]}, relays +{relay_counts[0]}/~{relay_counts[1]}"
+    )
+    if encoding != requested:
+        logger.warning(
+            f"Controller {controller_uuid} announced unsupported payload encoding '{requested}', "
+            f"told it to use '{encoding}'"
+        )
+        send_config(controller_uuid, {"encoding": encoding})
+    return controller
+
+
+def send_config(controller_uuid, config):
+    """
+    Сообщает контроллеру параметры, выбранные сервером, в ``controller/<uuid>/config``.
+    Сообщение сохраняется брокером (retain): контроллер получит его и после переподключения.
+    """
+    try:
+        get_publisher().publish(f"controller/{controller_uuid}/config", config, retain=True)
+    except PublishError as e:
+        logger.error(f"Failed to send config to controller {controller_uuid}: {e}")
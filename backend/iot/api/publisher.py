@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    pass
+
+
+class MQTTPublisher:
+    """
+    Одно долгоживущее соединение с брокером для публикаций из веб-процесса.
+
+    Сетевой цикл paho работает в своём потоке и сам переподключается с
+    экспоненциальной задержкой; ``publish`` можно вызывать из любого потока.
+    """
+
+    def __init__(self, host=None, port=None, qos=None, timeout=None):
+        self.host = host or getattr(settings, "MQTT_BROKER_HOST", "localhost")
+        self.port = port or getattr(settings, "MQTT_BROKER_PORT", 1883)
+        self.qos = getattr(settings, "MQTT_PUBLISH_QOS", 1) if qos is None else qos
+        self.timeout = timeout or getattr(settings, "MQTT_PUBLISH_TIMEOUT", 5)
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._subscriptions = {}
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """Публикует одно сообщение и ждёт подтверждения брокера."""
+        self.wait([self.publish_async(topic, payload, qos, retain)])
+
+    def publish_many(self, messages, qos=None):
+        """
+        Публикует пары (topic, payload) без ожидания каждой и затем ждёт
+        подтверждений разом — по соединению идёт один поток PUBLISH.
+        """
+        self.wait([self.publish_async(topic, payload, qos) for topic, payload in messages])
+
+    def publish_async(self, topic, payload, qos=None, retain=False):
+        client = self._connect()
+        if not self._connected.wait(self.timeout):
+            raise PublishError(f"MQTT broker {self.host}:{self.port} is not available")
+        if not isinstance(payload, (str, bytes)):
+            payload = json.dumps(payload)
+        info = client.publish(topic, payload, qos=self.qos if qos is None else qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise PublishError(f"Failed to publish to '{topic}': {mqtt.error_string(info.rc)}")
+        return info
+
+    def subscribe(self, topic, callback):
+        """Подписка на том же соединении; восстанавливается после переподключения."""
+        client = self._connect()
+        with self._client_lock:
+            self._subscriptions[topic] = callback
+            client.message_callback_add(topic, callback)
+            if self._connected.is_set():
+                client.subscribe(topic)
+
+    def wait(self, infos):
+        for info in infos:
+            try:
+                info.wait_for_publish(self.timeout)
+            except (RuntimeError, ValueError) as e:
+                raise PublishError(str(e))
+            if not info.is_published():
+                raise PublishError(f"Publish was not confirmed within {self.timeout}s")
+
+    def close(self):
+        with self._client_lock:
+            if self._client is not None:
+                self._client.disconnect()
+                self._client.loop_stop()
+                self._client = None
+                self._connected.clear()
+
+    def _connect(self):
+        with self._client_lock:
+            if self._client is None:
+                client = mqtt.Client()
+                client.on_connect = self._on_connect
+                client.on_disconnect = self._on_disconnect
+                client.reconnect_delay_set(
+                    min_delay=getattr(settings, "MQTT_RECONNECT_MIN_DELAY", 1),
+                    max_delay=getattr(settings, "MQTT_RECONNECT_MAX_DELAY", 60),
+                )
+                client.connect_async(self.host, self.port, 60)
+                client.loop_start()
+                self._client = client
+            return self._client
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            with self._client_lock:
+                for topic in self._subscriptions:
+                    client.subscribe(topic)
+            self._connected.set()
+            logger.info(f"Publisher connected to MQTT broker {self.host}:{self.port}")
+        else:
+            logger.error(f"Publisher failed to connect to MQTT broker: {rc}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        if rc != 0:
+            logger.warning(f"Publisher lost connection to MQTT broker: {rc}, reconnecting")
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = MQTTPublisher()
+        return _publisher
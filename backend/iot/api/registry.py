@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Controller, Sensor, Relay
+
+logger = logging.getLogger(__name__)
+
+
+class TopologyRegistry:
+    """
+    Кэш контроллеров, датчиков и реле для MQTT-клиента.
+
+    Контроллеры хранятся по uuid, датчики и реле — по парам (controller_uuid, sensor_uuid) и (controller_uuid, relay_uuid)
+    в том виде, в каком они приходят в топике. Датчики хранятся вместе с
+    контроллером и компанией, так что обработчик не делает лишних запросов.
+    Записи сбрасываются сигналами моделей, а изменения из других процессов
+    подхватываются по истечении TTL.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or getattr(settings, "MQTT_REGISTRY_TTL", 60)
+        self._controllers = {}
+        self._sensors = {}
+        self._relays = {}
+        self._lock = threading.Lock()
+
+    def warm(self):
+        loaded_at = time.monotonic()
+        controllers = {
+            str(controller.uuid): (controller, loaded_at)
+            for controller in Controller.objects.select_related("company")
+        }
+        sensors = {
+            (str(sensor.controller.uuid), str(sensor.uuid)): (sensor, loaded_at)
+            for sensor in Sensor.objects.select_related("controller__company")
+        }
+        relays = {
+            (str(relay.controller.uuid), str(relay.uuid)): (relay, loaded_at)
+            for relay in Relay.objects.select_related("controller__company")
+        }
+        with self._lock:
+            self._controllers = controllers
+            self._sensors = sensors
+            self._relays = relays
+        logger.info(
+            f"Registry warmed: {len(controllers)} controllers, {len(sensors)} sensors, {len(relays)} relays"
+        )
+
+    def get_controller(self, controller_uuid):
+        return self._get(
+            self._controllers,
+            controller_uuid,
+            lambda: Controller.objects.select_related("company").get(uuid=controller_uuid),
+        )
+
+    def get_sensor(self, controller_uuid, sensor_uuid):
+        return self._get(
+            self._sensors,
+            (controller_uuid, sensor_uuid),
+            lambda: Sensor.objects.select_related("controller__company").get(
+                uuid=sensor_uuid, controller__uuid=controller_uuid
+            ),
+        )
+
+    def get_relay(self, controller_uuid, relay_uuid):
+        return self._get(
+            self._relays,
+            (controller_uuid, relay_uuid),
+            lambda: Relay.objects.select_related("controller__company").get(
+                uuid=relay_uuid, controller__uuid=controller_uuid
+            ),
+        )
+
+    def peek_controller(self, controller_uuid):
+        """Контроллер из кэша без обращения к БД; None, если его там нет или запись устарела."""
+        return self._peek(self._controllers, controller_uuid)
+
+    def peek_sensor(self, controller_uuid, sensor_uuid):
+        return self._peek(self._sensors, (controller_uuid, sensor_uuid))
+
+    def invalidate_controller(self, controller_id):
+        with self._lock:
+            for key in [k for k, (obj, _) in self._controllers.items() if obj.pk == controller_id]:
+                del self._controllers[key]
+            for entries in (self._sensors, self._relays):
+                for key in [k for k, (obj, _) in entries.items() if obj.controller_id == controller_id]:
+                    del entries[key]
+
+    def invalidate_sensor(self, sensor_id):
+        with self._lock:
+            for key in [k for k, (obj, _) in self._sensors.items() if obj.pk == sensor_id]:
+                del self._sensors[key]
+
+    def invalidate_relay(self, relay_id):
+        with self._lock:
+            for key in [k for k, (obj, _) in self._relays.items() if obj.pk == relay_id]:
+                del self._relays[key]
+
+    def clear(self):
+        with self._lock:
+            self._controllers = {}
+            self._sensors = {}
+            self._relays = {}
+
+    def _peek(self, entries, key):
+        entry = entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def _get(self, entries, key, load):
+        obj = self._peek(entries, key)
+        if obj is not None:
+            return obj
+
+        # DoesNotExist пробрасывается обработчику, как и раньше
+        obj = load()
+        with self._lock:
+            entries[key] = (obj, time.monotonic())
+        return obj
+
+
+registry = TopologyRegistry()
@@ -0,0 +1,121 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models import Relay, RelayStateLog
+
+logger = logging.getLogger(__name__)
+
+
+def apply_states(states):
+    """
+    Записывает состояния реле {relay_id: (is_working, source, timestamp)}.
+
+    Обновляются только строки, где состояние действительно изменилось, и только
+    для них пишется история. Возвращает id изменённых реле.
+    """
+    if not states:
+        return []
+
+    with transaction.atomic():
+        current = dict(
+            Relay.objects.select_for_update().filter(pk__in=states).values_list("pk", "is_working")
+        )
+        changed = [pk for pk, (is_working, _, _) in states.items() if pk in current and current[pk] != is_working]
+        if not changed:
+            return []
+
+        for is_working in (True, False):
+            ids = [pk for pk in changed if states[pk][0] == is_working]
+            if ids:
+                # Условие по is_working повторяет проверку выше на уровне UPDATE
+                Relay.objects.filter(pk__in=ids).exclude(is_working=is_working).update(is_working=is_working)
+
+        RelayStateLog.objects.bulk_create([
+            RelayStateLog(relay_id=pk, is_working=states[pk][0], source=states[pk][1], timestamp=states[pk][2])
+            for pk in changed
+        ])
+    return changed
+
+
+def set_relay_state(relay, is_working, source):
+    """Немедленная запись состояния одного реле. True, если оно изменилось."""
+    # UPDATE ... WHERE is_working != new: неизменное состояние обходится одним запросом без записи
+    changed = Relay.objects.filter(pk=relay.pk).exclude(is_working=is_working).update(is_working=is_working)
+    if changed:
+        RelayStateLog.objects.create(relay_id=relay.pk, is_working=is_working, source=source)
+    relay.is_working = is_working
+    return bool(changed)
+
+
+class RelayStateWriter:
+    """
+    Копит состояния реле из MQTT и пишет их раз в ``max_delay`` секунд.
+
+    Из серии сообщений об одном реле за это время в БД попадает только
+    последнее, а неизменившееся состояние не пишется вовсе. Если запись не
+    удалась, состояния возвращаются в очередь и пишутся на следующем тике;
+    пришедшие за это время более новые состояния тех же реле важнее.
+    """
+
+    def __init__(self, max_delay=None):
+        self.max_delay = max_delay or getattr(settings, "MQTT_RELAY_FLUSH_DELAY", 0.5)
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="relay-state-writer", daemon=True)
+        self._thread.start()
+
+    def update(self, relay, is_working, source):
+        relay.is_working = is_working
+        with self._lock:
+            self._pending[relay.pk] = (is_working, source, timezone.now())
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                states, self._pending = self._pending, {}
+
+            if not states:
+                return 0
+
+            try:
+                changed = apply_states(states)
+            except Exception:
+                logger.exception(f"Failed to write {len(states)} relay states, retrying on the next flush")
+                with self._lock:
+                    self._pending = {**states, **self._pending}
+                return 0
+
+        if changed:
+            logger.info("Relay states changed: %d of %d", len(changed), len(states), extra={"log_key": "flush"})
+        return len(changed)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._pending:
+            logger.error(f"Dropped {len(self._pending)} relay states on shutdown, database unavailable")
+            self._pending = {}
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.max_delay):
+                close_old_connections()
+                self.flush()
+        finally:
+            connection.close()
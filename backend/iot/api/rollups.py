@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+from django.db import IntegrityError, transaction
+
+from .models import MessageRollup
+
+
+def bucket_start(timestamp, resolution):
+    seconds = MessageRollup.SECONDS[resolution]
+    epoch = int(timestamp.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def aggregate(messages):
+    """
+    Сворачивает сообщения в агрегаты по (sensor_id, resolution, bucket).
+    Сообщения должны быть уже сохранены, то есть иметь timestamp.
+    """
+    buckets = {}
+    for message in messages:
+        for resolution in MessageRollup.Resolution:
+            key = (message.sensor_id, resolution, bucket_start(message.timestamp, resolution))
+            entry = buckets.get(key)
+            if entry is None:
+                buckets[key] = MessageRollup(
+                    sensor_id=message.sensor_id,
+                    resolution=resolution,
+                    bucket=key[2],
+                    min=message.value,
+                    max=message.value,
+                    sum=message.value,
+                    count=1,
+                    last=message.value,
+                    last_timestamp=message.timestamp,
+                )
+            else:
+                merge(entry, message.value, message.value, message.value, 1, message.value, message.timestamp)
+    return buckets
+
+
+def merge(rollup, min_value, max_value, sum_value, count, last, last_timestamp):
+    rollup.min = min(rollup.min, min_value)
+    rollup.max = max(rollup.max, max_value)
+    rollup.sum += sum_value
+    rollup.count += count
+    # Запоздавшие показания не должны перетирать последнее значение
+    if last_timestamp >= rollup.last_timestamp:
+        rollup.last = last
+        rollup.last_timestamp = last_timestamp
+
+
+def update_rollups(messages):
+    """
+    Добавляет сохранённые сообщения в агрегаты 1m/1h/1d.
+
+    Затрагивает только корзины, в которые попали сообщения: существующие
+    строки читаются одним запросом и обновляются через bulk_update, новые
+    создаются через bulk_create.
+    """
+    buckets = aggregate(messages)
+    if not buckets:
+        return
+
+    try:
+        _apply(buckets)
+    except IntegrityError:
+        # Ту же корзину успел создать другой процесс — перечитываем и повторяем
+        for rollup in buckets.values():
+            rollup.pk = None
+        _apply(buckets)
+
+
+def _apply(buckets):
+    with transaction.atomic():
+        existing = {
+            (rollup.sensor_id, rollup.resolution, rollup.bucket): rollup
+            for rollup in MessageRollup.objects.select_for_update().filter(
+                sensor_id__in={key[0] for key in buckets},
+                bucket__in={key[2] for key in buckets},
+            )
+        }
+
+        to_create = []
+        to_update = []
+        for key, fresh in buckets.items():
+            rollup = existing.get(key)
+            if rollup is None:
+                to_create.append(fresh)
+            else:
+                merge(rollup, fresh.min, fresh.max, fresh.sum, fresh.count, fresh.last, fresh.last_timestamp)
+                to_update.append(rollup)
+
+        MessageRollup.objects.bulk_update(
+            to_update, ["min", "max", "sum", "count", "last", "last_timestamp"], batch_size=500
+        )
+        MessageRollup.objects.bulk_create(to_create, batch_size=500)
@@ -1,6 +1,6 @@
 # serializers.py
 from rest_framework import serializers
-from .models import Company, User, Controller, Sensor, Message, Relay, ManualControlLog
+from .models import Company, User, Controller, Sensor, Message, MessageRollup, Relay, ManualControlLog
 
 
 class CompanySerializer(serializers.ModelSerializer):
@@ -62,6 +62,8 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'sensor', 'sensor_uuid', 'controller_uuid', 'value', 'status', 'timestamp']
+        # Время ставит сервер, как и до появления времени устройства
+        read_only_fields = ['timestamp']
 
     def get_sensor_uuid(self, obj):
         return str(obj.sensor.uuid)
@@ -70,6 +72,46 @@ class MessageSerializer(serializers.ModelSerializer):
         return str(obj.sensor.controller.uuid)
 
 
+class MessageValuesSerializer(serializers.Serializer):
+    """
+    То же представление, что у MessageSerializer, но для словарей из
+    ``Message.objects.values(...)`` — без создания экземпляров модели.
+    """
+    id = serializers.IntegerField()
+    sensor = serializers.IntegerField()
+    sensor_uuid = serializers.UUIDField(source='sensor__uuid')
+    controller_uuid = serializers.UUIDField(source='sensor__controller__uuid')
+    value = serializers.FloatField()
+    status = serializers.CharField()
+    timestamp = serializers.DateTimeField()
+
+    class Meta:
+        fields = ['id', 'sensor', 'sensor__uuid', 'sensor__controller__uuid', 'value', 'status', 'timestamp']
+
+
+class LatestValueSerializer(serializers.Serializer):
+    sensor_uuid = serializers.UUIDField()
+    controller_uuid = serializers.UUIDField()
+    value = serializers.FloatField()
+    status = serializers.CharField()
+    timestamp = serializers.DateTimeField()
+
+
+class MessageRollupSerializer(serializers.ModelSerializer):
+    sensor_uuid = serializers.UUIDField(source='sensor.uuid', read_only=True)
+    controller_uuid = serializers.UUIDField(source='sensor.controller.uuid', read_only=True)
+    # timestamp и value названы как у MessageSerializer, чтобы графики работали без изменений
+    timestamp = serializers.DateTimeField(source='bucket')
+    value = serializers.FloatField(source='avg')
+
+    class Meta:
+        model = MessageRollup
+        fields = [
+            'sensor', 'sensor_uuid', 'controller_uuid', 'resolution',
+            'timestamp', 'value', 'min', 'max', 'count', 'last',
+        ]
+
+
 class RelaySerializer(serializers.ModelSerializer):
     class Meta:
         model = Relay
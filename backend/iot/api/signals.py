@@ -0,0 +1,40 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Company, Controller, Sensor, Relay
+from .registry import registry
+from .authentication import api_key_cache
+
+
+@receiver([post_save, post_delete], sender=Company)
+def invalidate_company(sender, instance, **kwargs):
+    registry.clear()
+    api_key_cache.clear()
+
+
+@receiver([post_save, post_delete], sender=Controller)
+def invalidate_controller(sender, instance, **kwargs):
+    registry.invalidate_controller(instance.pk)
+    # У контроллеров из кэша ключей api_key отложен — не загружаем его ради сброса
+    api_key_cache.invalidate_controller(instance.pk, instance.__dict__.get("api_key"))
+
+
+@receiver([post_save, post_delete], sender=Sensor)
+def invalidate_sensor(sender, instance, **kwargs):
+    registry.invalidate_sensor(instance.pk)
+    reset_init_hash(instance.controller_id)
+
+
+@receiver([post_save, post_delete], sender=Relay)
+def invalidate_relay(sender, instance, update_fields=None, **kwargs):
+    # Смена состояния реле не меняет топологию, кэш сбрасывать незачем
+    if update_fields is not None and set(update_fields) == {"is_working"}:
+        return
+    registry.invalidate_relay(instance.pk)
+    reset_init_hash(instance.controller_id)
+
+
+def reset_init_hash(controller_id):
+    # Датчики или реле изменены не через init: следующий init нужно применить, а не пропустить
+    if Controller.objects.filter(pk=controller_id).exclude(init_hash="").update(init_hash=""):
+        registry.invalidate_controller(controller_id)
@@ -0,0 +1,121 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from django.conf import settings
+
+from . import logs
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(index, workers, mode, group, engine="threads"):
+    """Точка входа процесса приёма; запускается через spawn, Django настраивается заново."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "iot.settings")
+    # Ctrl+C получает вся группа процессов, останавливает воркеры только супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import django
+    django.setup()
+    if engine == "asyncio":
+        from api.async_ingest import start
+    else:
+        from api.mqtt_client import start
+
+    start(workers=workers, index=index, mode=mode, group=group)
+
+
+class WorkerSupervisor:
+    """
+    Держит ``workers`` процессов приёма и перезапускает упавшие.
+
+    Процесс, проживший меньше ``min_uptime`` секунд, перезапускается с
+    удваивающейся задержкой (не больше ``max_backoff``). SIGTERM и SIGINT
+    пересылаются воркерам как SIGTERM; тем, кто не успел доработать за
+    ``drain_timeout`` секунд, отправляется SIGKILL.
+    """
+
+    def __init__(
+        self, workers, mode="shared", group=None, drain_timeout=None, engine="threads", min_uptime=10, max_backoff=60,
+    ):
+        self.workers = workers
+        self.engine = engine
+        self.mode = mode
+        self.group = group
+        self.drain_timeout = drain_timeout or getattr(settings, "MQTT_DRAIN_TIMEOUT", 30)
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._backoff = [1.0] * workers
+        self._restart_at = [0.0] * workers
+        self._stopping = threading.Event()
+
+    def run(self):
+        logs.configure()
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        try:
+            while not self._stopping.wait(0.5):
+                for index in range(self.workers):
+                    self._check(index)
+        finally:
+            self._stop_all()
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.workers, self.mode, self.group, self.engine),
+            name=f"mqtt-worker-{index}",
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Started MQTT worker {index} (pid {process.pid})")
+
+    def _check(self, index):
+        process = self._processes[index]
+        current = time.monotonic()
+        if process is not None:
+            if process.is_alive():
+                return
+            uptime = current - self._started_at[index]
+            # Долго проработавший воркер перезапускается сразу, быстро падающий — с нарастающей паузой
+            if uptime < self.min_uptime:
+                self._restart_at[index] = current + self._backoff[index]
+                self._backoff[index] = min(self._backoff[index] * 2, self.max_backoff)
+            else:
+                self._restart_at[index] = current
+                self._backoff[index] = 1.0
+            logger.error(
+                f"MQTT worker {index} (pid {process.pid}) exited with code {process.exitcode} "
+                f"after {uptime:.1f}s, restarting in {self._restart_at[index] - current:.1f}s"
+            )
+            self._processes[index] = None
+        if current >= self._restart_at[index]:
+            self._spawn(index)
+
+    def _request_stop(self, signum, frame):
+        logger.info(f"Received signal {signum}, stopping MQTT workers")
+        self._stopping.set()
+
+    def _stop_all(self):
+        processes = [p for p in self._processes if p is not None and p.is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error(f"MQTT worker {process.name} did not drain in {self.drain_timeout}s, killing")
+                process.kill()
+                process.join()
+        logger.info("All MQTT workers stopped")
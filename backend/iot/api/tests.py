@@ -1,3 +1,1395 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from paho.mqtt.client import MQTTMessage
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from django.db import OperationalError, connection
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Company, User, Controller, Sensor, Relay, Message, MessageRollup, RelayStateLog, ManualControlLog
+from .serializers import MessageSerializer
+from .latest import FakeRedis, NullLatestStore, RedisLatestStore, make_record
+from . import ingest
+from .dispatcher import HandlerDispatcher
+from .downsampling import lttb
+from .supervisor import WorkerSupervisor
+from .ingest import MessageBuffer, store_messages
+from .rollups import update_rollups
+from .registry import TopologyRegistry
+from .live import LocalBroker, MQTTBroker
+from .relays import RelayStateWriter, set_relay_state
+from .publisher import PublishError
+from .commands import CommandTracker, command_tracker
+from .provisioning import init_hash, is_unchanged, provision
+from .authentication import api_key_cache, failure_limiter
+from .alerts import AlertDispatcher
+from .codecs import BATCH_DTYPE, READING, decode_batch, decode_reading
+from .metrics import ALERTS_FAILED, MQTT_DROPPED, READINGS_DROPPED, READINGS_STORED, Histogram
+from .logs import JSONFormatter, LocalQueueHandler, SamplingFilter
+
+
+class QueryCountTests(APITestCase):
+    """
+    Число запросов на список не должно зависеть от числа строк в ответе.
+    """
+
+    def setUp(self):
+        self.company = Company.objects.create(name="Acme")
+        self.manager = User.objects.create_user(
+            "manager@example.com", None, role=User.Role.MANAGER, company=self.company
+        )
+        self.superuser = User.objects.create_user(
+            "root@example.com", None, role=User.Role.SUPERUSER
+        )
+        self.client.force_authenticate(self.manager)
+
+    def add_rows(self, count):
+        for _ in range(count):
+            controller = Controller.objects.create(company=self.company, name="controller")
+            sensor = Sensor.objects.create(controller=controller, name="sensor", type=Sensor.SensorType.TEMPERATURE)
+            Relay.objects.create(controller=controller, name="relay", type=Relay.RelayType.PUMP)
+            Message.objects.bulk_create([
+                Message(sensor=sensor, value=i, timestamp=timezone.now() + timedelta(microseconds=i))
+                for i in range(3)
+            ])
+            User.objects.create_user(f"user{User.objects.count()}@example.com", None, company=self.company)
+            Company.objects.create(name="Other")
+
+    def count_queries(self, url, params=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url, params=None, expected=None):
+        self.add_rows(2)
+        small = self.count_queries(url, params)
+        self.add_rows(10)
+        large = self.count_queries(url, params)
+        self.assertEqual(small, large, f"{url} issues queries per row")
+        if expected is not None:
+            self.assertEqual(large, expected)
+
+    def test_companies(self):
+        self.client.force_authenticate(self.superuser)
+        self.assertConstantQueries("/api/companies/", expected=1)
+
+    def test_users(self):
+        self.assertConstantQueries("/api/users/", expected=1)
+
+    def test_controllers(self):
+        self.assertConstantQueries("/api/controllers/", expected=1)
+
+    def test_sensors(self):
+        self.assertConstantQueries("/api/sensors/", expected=1)
+
+    def test_relays(self):
+        self.assertConstantQueries("/api/relays/", expected=1)
+
+    def test_messages(self):
+        self.assertConstantQueries("/api/messages/", expected=1)
+
+    def test_messages_by_sensor(self):
+        sensor = Sensor.objects.create(
+            controller=Controller.objects.create(company=self.company, name="controller"),
+            name="sensor",
+            type=Sensor.SensorType.TEMPERATURE,
+        )
+        Message.objects.bulk_create([
+            Message(sensor=sensor, value=i, timestamp=timezone.now() + timedelta(microseconds=i))
+            for i in range(20)
+        ])
+        # Поиск датчика по uuid и сама выборка
+        self.assertEqual(self.count_queries("/api/messages/", {"sensor": str(sensor.uuid)}), 2)
+
+    def test_message_detail(self):
+        self.add_rows(1)
+        message = Message.objects.first()
+        self.assertEqual(self.count_queries(f"/api/messages/{message.pk}/"), 1)
+
+    def test_messages_response_format(self):
+        # Быстрый путь отдаёт то же, что и MessageSerializer
+        self.add_rows(1)
+        message = Message.objects.order_by("pk").first()
+        response = self.client.get("/api/messages/")
+        self.assertEqual(response.json()["results"][0], dict(MessageSerializer(message).data))
+
+    def test_latest_message(self):
+        self.add_rows(1)
+        sensor = Sensor.objects.first()
+        self.assertEqual(self.count_queries("/messages/latest/", {"sensor": str(sensor.uuid)}), 2)
+
+
+class MessagePaginationTests(APITestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.client.force_authenticate(
+            User.objects.create_user("manager@example.com", None, role=User.Role.MANAGER, company=company)
+        )
+        controller = Controller.objects.create(company=company, name="controller")
+        self.sensors = [
+            Sensor.objects.create(controller=controller, name=f"sensor-{i}", type=Sensor.SensorType.TEMPERATURE)
+            for i in range(5)
+        ]
+        # Одинаковое время у соседних строк (разных датчиков) проверяет разбиение по id
+        start = timezone.now()
+        Message.objects.bulk_create([
+            Message(sensor=self.sensors[i % 5], value=i, timestamp=start + timedelta(seconds=i // 5))
+            for i in range(25)
+        ])
+
+    def test_pages_cover_all_rows_once(self):
+        url = "/api/messages/"
+        params = {"page_size": 7}
+        seen = []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                data = self.client.get(url, params).json()
+            # Одна выборка страницы
+            self.assertEqual(len(context.captured_queries), 1)
+            seen.extend(row["id"] for row in data["results"])
+            url, params = data["next"], None
+
+        expected = list(Message.objects.order_by("timestamp", "id").values_list("id", flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/messages/", {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_rollups_are_paginated(self):
+        update_rollups(list(Message.objects.all()))
+        url, params = "/api/messages/", {"resolution": "1m", "page_size": 2}
+        seen = []
+        while url:
+            data = self.client.get(url, params).json()
+            seen.extend((row["sensor_uuid"], row["timestamp"]) for row in data["results"])
+            url, params = data["next"], None
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), MessageRollup.objects.filter(resolution="1m").count())
+
+    def test_status_filter(self):
+        Message.objects.filter(value__in=[3, 7]).update(status=Message.Status.ERROR)
+        Message.objects.filter(value=5).update(status=Message.Status.WARNING)
+
+        data = self.client.get("/api/messages/", {"status": "error,warning"}).json()
+        self.assertEqual(sorted(row["value"] for row in data["results"]), [3, 5, 7])
+        self.assertEqual(self.client.get("/api/messages/", {"status": "broken"}).status_code, 400)
+
+        # С ?max_points= статус не теряется: ответ строится по сырым строкам
+        data = self.client.get("/api/messages/", {
+            "status": "error", "max_points": 1, "start": (timezone.now() - timedelta(days=1)).isoformat(),
+        }).json()
+        self.assertEqual(sorted(row["value"] for row in data["results"]), [3, 7])
+
+    def test_status_with_rollups_is_rejected(self):
+        response = self.client.get("/api/messages/", {"status": "error", "resolution": "1m"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("status", response.json())
+        self.assertEqual(self.client.get("/api/messages/", {"status": "error", "resolution": "raw"}).status_code, 200)
+
+    def test_max_points_raw_fallback_is_not_cut_at_page_size(self):
+        start = timezone.now() - timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(sensor=self.sensors[0], value=i, timestamp=start + timedelta(seconds=i)) for i in range(3000)
+        ])
+        data = self.client.get("/api/messages/", {
+            "sensor": str(self.sensors[0].uuid), "start": start.isoformat(), "max_points": 5000,
+        }).json()
+        self.assertEqual(len(data["results"]), 3005)
+        self.assertIsNone(data["next"])
+
+
+class MessageExportTests(APITestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.client.force_authenticate(
+            User.objects.create_user("manager@example.com", None, role=User.Role.MANAGER, company=company)
+        )
+        self.controllers = [Controller.objects.create(company=company, name=f"controller-{i}") for i in range(2)]
+        self.sensors = [
+            Sensor.objects.create(controller=controller, name="sensor", type=Sensor.SensorType.TEMPERATURE)
+            for controller in self.controllers
+        ]
+        other = Controller.objects.create(company=Company.objects.create(name="Other"), name="foreign")
+        foreign = Sensor.objects.create(controller=other, name="foreign", type=Sensor.SensorType.TEMPERATURE)
+
+        self.start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+        Message.objects.bulk_create([
+            Message(sensor=self.sensors[i % 2], value=i, timestamp=self.start + timedelta(minutes=i))
+            for i in range(6)
+        ] + [Message(sensor=foreign, value=100, timestamp=self.start)])
+
+    def export(self, **params):
+        response = self.client.get("/api/messages/export/", params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def csv_rows(self, **params):
+        return list(csv.DictReader(io.StringIO(self.export(export_format="csv", **params).decode())))
+
+    def test_csv(self):
+        rows = self.csv_rows()
+        # Чужая компания в выгрузку не попадает
+        self.assertEqual([float(row["value"]) for row in rows], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(rows[1]["sensor_uuid"], str(self.sensors[1].uuid))
+        self.assertEqual(rows[1]["controller_uuid"], str(self.controllers[1].uuid))
+
+    def test_ndjson(self):
+        lines = self.export(export_format="ndjson").decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row["value"] for row in rows], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(rows[0]["sensor_uuid"], str(self.sensors[0].uuid))
+
+    @skipUnless(importlib.util.find_spec("openpyxl"), "openpyxl is not installed")
+    def test_xlsx(self):
+        from openpyxl import load_workbook
+
+        sheet = load_workbook(io.BytesIO(self.export(export_format="xlsx")), read_only=True).active
+        rows = list(sheet.values)
+        self.assertEqual(list(rows[0]), ["timestamp", "sensor_uuid", "controller_uuid", "value", "status"])
+        self.assertEqual([row[3] for row in rows[1:]], [0, 1, 2, 3, 4, 5])
+
+    @skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(io.BytesIO(self.export(export_format="parquet")))
+        self.assertEqual(table.column("value").to_pylist(), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(table.column("controller_uuid").to_pylist()[0], str(self.controllers[0].uuid))
+
+    def test_filters(self):
+        rows = self.csv_rows(sensor=str(self.sensors[0].uuid))
+        self.assertEqual([float(row["value"]) for row in rows], [0, 2, 4])
+
+        rows = self.csv_rows(controller=str(self.controllers[1].uuid))
+        self.assertEqual([float(row["value"]) for row in rows], [1, 3, 5])
+
+        rows = self.csv_rows(
+            start=(self.start + timedelta(minutes=2)).isoformat(),
+            end=(self.start + timedelta(minutes=3)).isoformat(),
+        )
+        self.assertEqual([float(row["value"]) for row in rows], [2, 3])
+
+    def test_unknown_format(self):
+        response = self.client.get("/api/messages/export/", {"export_format": "xml"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("export_format", response.json())
+
+    def test_missing_dependency(self):
+        with mock.patch("api.views.importlib.util.find_spec", return_value=None):
+            for export_format, requirement in [("xlsx", "openpyxl"), ("parquet", "pyarrow")]:
+                response = self.client.get("/api/messages/export/", {"export_format": export_format})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(requirement, response.json()["export_format"])
+
+
+class LatestValuesTests(APITestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.client.force_authenticate(
+            User.objects.create_user("manager@example.com", None, role=User.Role.MANAGER, company=company)
+        )
+        self.controller = Controller.objects.create(company=company, name="controller")
+        self.sensors = [
+            Sensor.objects.create(controller=self.controller, name=f"sensor{i}", type=Sensor.SensorType.TEMPERATURE)
+            for i in range(5)
+        ]
+        for sensor in self.sensors:
+            Message.objects.bulk_create([
+                Message(sensor=sensor, value=i, timestamp=timezone.now() + timedelta(microseconds=i))
+                for i in range(3)
+            ])
+
+        # Датчик чужой компании не должен попадать в ответ
+        other = Controller.objects.create(company=Company.objects.create(name="Other"), name="other")
+        Sensor.objects.create(controller=other, name="foreign", type=Sensor.SensorType.TEMPERATURE)
+
+    def test_by_controller_from_db(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/messages/latest/", {"controller": str(self.controller.uuid)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual({row["value"] for row in response.json()}, {2.0})
+
+    def test_etag(self):
+        params = {"sensors": ",".join(str(sensor.uuid) for sensor in self.sensors[:2])}
+        response = self.client.get("/messages/latest/", params)
+        etag = response["ETag"]
+
+        response = self.client.get("/messages/latest/", params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Message.objects.create(sensor=self.sensors[0], value=42)
+        response = self.client.get("/messages/latest/", params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_store_is_used_before_db(self):
+        store = RedisLatestStore(client=FakeRedis())
+        message = Message(sensor=self.sensors[0], value=99, status=Message.Status.ERROR, timestamp=timezone.now())
+        store.update([make_record(message)])
+
+        with mock.patch("api.views.get_latest_store", return_value=store):
+            response = self.client.get("/messages/latest/", {"sensors": str(self.sensors[0].uuid)})
+        self.assertEqual(response.json()[0]["value"], 99)
+        self.assertEqual(response.json()[0]["status"], Message.Status.ERROR)
+
+    def test_local_backend_is_not_written(self):
+        with override_settings(LATEST_VALUE_BACKEND="local"), mock.patch("api.latest._store", None), \
+                mock.patch("api.ingest.make_record") as make_record:
+            ingest.update_latest([Message(sensor=self.sensors[0], value=99, timestamp=timezone.now())])
+            self.assertIsInstance(ingest.get_latest_store(), NullLatestStore)
+        make_record.assert_not_called()
+
+        Message.objects.create(sensor=self.sensors[0], value=42, timestamp=timezone.now())
+        with mock.patch("api.views.get_latest_store", return_value=NullLatestStore()):
+            response = self.client.get("/messages/latest/", {"sensors": str(self.sensors[0].uuid)})
+        self.assertEqual(response.json()[0]["value"], 42)
+
+
+class CodecTests(SimpleTestCase):
+    def test_reading(self):
+        self.assertEqual(decode_reading("json", b'{"value": 1.5}'), (1.5, None))
+        self.assertEqual(decode_reading("struct", READING.pack(1700000000.0, 1.5)), (1.5, 1700000000.0))
+
+    def test_non_finite_reading_is_rejected(self):
+        for payload in (b'{"value": NaN}', b'{"value": "inf"}'):
+            with self.assertRaises(ValueError):
+                decode_reading("json", payload)
+        with self.assertRaises(ValueError):
+            decode_reading("struct", READING.pack(1700000000.0, float("-inf")))
+
+    def test_non_finite_mqtt_reading_is_dropped_with_warning(self):
+        from .mqtt_client import handle_sensor_data
+
+        sensor = mock.Mock(**{"controller.payload_encoding": "json"})
+        msg = MQTTMessage(topic=f"controller/{uuid.uuid4()}/sensors/{uuid.uuid4()}".encode())
+        msg.payload = b'{"value": NaN}'
+        with mock.patch("api.mqtt_client.registry.get_sensor", return_value=sensor), \
+                mock.patch("api.mqtt_client.ingest_reading") as ingest_reading, \
+                self.assertLogs("api.mqtt_client", "WARNING") as logs:
+            handle_sensor_data(None, None, msg)
+        ingest_reading.assert_not_called()
+        self.assertEqual(logs.records[0].levelname, "WARNING")
+        self.assertIsNone(logs.records[0].exc_info)
+
+    def test_struct_batch_matches_json(self):
+        # uuid с нулевым последним байтом: numpy обрезает завершающие нули у S16
+        sensors = [uuid.uuid4(), uuid.UUID(bytes=uuid.uuid4().bytes[:15] + b"\0")]
+        records = np.zeros(4, dtype=BATCH_DTYPE)
+        records["sensor"] = [sensors[i % 2].bytes for i in range(4)]
+        records["ts"] = [0, 1700000000.0, 0, 1700000001.0]
+        records["value"] = [1.0, 2.0, 3.0, 4.0]
+
+        expected = [
+            {"sensor": str(sensors[i % 2]), "value": float(i + 1), "ts": records["ts"][i] or None}
+            for i in range(4)
+        ]
+        self.assertEqual(decode_batch("struct", records.tobytes()), decode_batch("json", json.dumps(expected).encode()))
+
+
+class SensorStatusTests(SimpleTestCase):
+    def status(self, value, **limits):
+        return Sensor(type=Sensor.SensorType.TEMPERATURE, **limits).get_status(value)
+
+    def test_warning_band(self):
+        self.assertEqual(self.status(15, critical_min=10, critical_max=30), Message.Status.OK)
+        self.assertEqual(self.status(11, critical_min=10, critical_max=30), Message.Status.WARNING)
+        self.assertEqual(self.status(29, critical_min=10, critical_max=30), Message.Status.WARNING)
+        self.assertEqual(self.status(31, critical_min=10, critical_max=30), Message.Status.ERROR)
+        self.assertEqual(self.status(95, critical_max=100), Message.Status.WARNING)
+
+    def test_zero_limit_still_has_a_warning_band(self):
+        with self.settings(SENSOR_WARNING_MARGIN=1.0):
+            self.assertEqual(self.status(0.5, critical_min=0), Message.Status.WARNING)
+            self.assertEqual(self.status(2, critical_min=0), Message.Status.OK)
+            self.assertEqual(self.status(-0.5, critical_max=0), Message.Status.WARNING)
+            self.assertEqual(self.status(-0.5, critical_min=0), Message.Status.ERROR)
+
+
+class LTTBTests(SimpleTestCase):
+    def test_known_series(self):
+        x = np.arange(10.0)
+        y = np.array([0, 1, 0, 5, 0, 1, 0, -3, 0, 0.0])
+        # Пик и провал сохраняются, соседние с ними точки отбрасываются
+        self.assertEqual(lttb(x, y, 4).tolist(), [0, 3, 7, 9])
+        self.assertEqual(lttb(x, y, 5).tolist(), [0, 2, 3, 7, 9])
+
+    def test_first_and_last_points_are_kept(self):
+        rng = np.random.default_rng(1)
+        x = np.cumsum(rng.uniform(0.5, 1.5, 5000))
+        y = rng.normal(size=5000)
+        for threshold in (3, 10, 999):
+            selected = lttb(x, y, threshold)
+            self.assertEqual(len(selected), threshold)
+            self.assertEqual((selected[0], selected[-1]), (0, 4999))
+            self.assertTrue(np.all(np.diff(selected) > 0))
+
+    def test_short_series_is_returned_whole(self):
+        x = np.arange(5.0)
+        for threshold in (5, 6, 2):
+            self.assertEqual(lttb(x, x, threshold).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(lttb(np.array([]), np.array([]), 10).tolist(), [])
+
+
+class HandlerDispatcherTests(SimpleTestCase):
+    def message(self, controller_uuid, seq):
+        msg = MQTTMessage(topic=f"controller/{controller_uuid}/sensors/sensor".encode())
+        msg.payload = str(seq).encode()
+        return msg
+
+    def test_messages_of_one_controller_stay_in_order(self):
+        handled = []
+
+        def handler(client, userdata, msg):
+            # Разная длительность обработки перемешала бы порядок, если бы очередь была общей
+            time.sleep(0.001 * (int(msg.payload) % 3))
+            handled.append((msg.topic.split("/")[1], int(msg.payload), threading.current_thread().name))
+
+        dispatcher = HandlerDispatcher(workers=4, queue_size=1000)
+        dispatcher.start()
+        controllers = [f"controller-{i}" for i in range(6)]
+        for seq in range(20):
+            for controller_uuid in controllers:
+                dispatcher.submit(handler, None, None, self.message(controller_uuid, seq))
+        dispatcher.stop()
+
+        for controller_uuid in controllers:
+            rows = [(seq, thread) for key, seq, thread in handled if key == controller_uuid]
+            self.assertEqual([seq for seq, _ in rows], list(range(20)))
+            self.assertEqual(len({thread for _, thread in rows}), 1)
+
+    def test_full_queue_drops_and_counts(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(client, userdata, msg):
+            started.set()
+            release.wait(5)
+
+        dispatcher = HandlerDispatcher(workers=1, queue_size=2, put_timeout=0.01)
+        dispatcher.start()
+        dropped = MQTT_DROPPED.labels("sensor", "queue_full").value
+
+        # Первое сообщение занимает поток, два следующих заполняют очередь
+        dispatcher.submit(handler, None, None, self.message("c1", 0))
+        started.wait(5)
+        with self.assertLogs("api.dispatcher", "WARNING"):
+            for seq in range(1, 6):
+                dispatcher.submit(handler, None, None, self.message("c1", seq))
+        self.assertEqual(dispatcher.queue_depth(), 2)
+
+        release.set()
+        dispatcher.stop()
+        stats = dispatcher.stats()
+        self.assertEqual((stats["processed"], stats["dropped"]), (3, 3))
+        self.assertEqual(MQTT_DROPPED.labels("sensor", "queue_full").value, dropped + 3)
+
+
+class MessageBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        self.failing = False
+
+    def store(self, messages, batch_size):
+        if self.failing:
+            raise OperationalError("database is locked")
+        self.batches.append([message.value for message in messages])
+        return messages
+
+    def test_flushes_by_size_and_close_drains_remainder(self):
+        buffer = MessageBuffer(max_size=3, max_delay=60, store=self.store)
+        for i in range(7):
+            buffer.add(Message(value=i))
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5]])
+        buffer.close()
+        self.assertEqual(self.batches[-1], [6])
+
+    def test_flushes_by_delay(self):
+        buffer = MessageBuffer(max_size=100, max_delay=0.05, store=self.store)
+        buffer.start()
+        try:
+            buffer.add(Message(value=1))
+            deadline = time.monotonic() + 2
+            while not self.batches and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            buffer.close()
+        self.assertEqual(self.batches, [[1]])
+
+    def test_failed_batch_is_kept_and_retried(self):
+        buffer = MessageBuffer(max_size=2, max_delay=60, store=self.store, max_pending=5)
+        self.failing = True
+        with self.assertLogs("api.ingest", level="WARNING"):
+            for i in range(4):
+                buffer.add(Message(value=i))
+            # Неудавшаяся пачка осталась в начале буфера, повтор отложен
+            self.assertEqual([message.value for message in buffer._items], [0, 1, 2, 3])
+            self.assertEqual(buffer.flush(), 0)
+
+            # Сверх max_pending отбрасываются самые старые
+            for i in range(4, 7):
+                buffer.add(Message(value=i))
+            self.assertEqual(len(buffer), 5)
+
+        self.failing = False
+        self.assertEqual(buffer.flush(force=True), 5)
+        self.assertEqual(self.batches, [[2, 3, 4, 5, 6]])
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        self.registry = TopologyRegistry(ttl=60)
+        self.controller = Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller")
+        self.sensor = Sensor.objects.create(controller=self.controller, name="sensor", type=Sensor.SensorType.TEMPERATURE)
+        self.relay = Relay.objects.create(controller=self.controller, name="relay", type=Relay.RelayType.PUMP)
+        self.key = (str(self.controller.uuid), str(self.sensor.uuid))
+        # Сигналы сбрасывают общий реестр процесса; подменяем его тестовым
+        patcher = mock.patch("api.signals.registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_hit_and_ttl(self):
+        with self.assertNumQueries(1):
+            sensor = self.registry.get_sensor(*self.key)
+            self.assertIs(self.registry.get_sensor(*self.key), sensor)
+        # Датчик загружается вместе с контроллером и компанией
+        with self.assertNumQueries(0):
+            sensor.controller.company.name
+
+        with mock.patch("api.registry.time.monotonic", return_value=time.monotonic() + 61):
+            with self.assertNumQueries(1):
+                self.registry.get_sensor(*self.key)
+
+    def test_unknown_sensor_is_not_cached(self):
+        with self.assertRaises(Sensor.DoesNotExist):
+            self.registry.get_sensor(str(self.controller.uuid), str(uuid.uuid4()))
+
+    def assertReloaded(self, get, change):
+        get()
+        change()
+        with self.assertNumQueries(1):
+            get()
+
+    def test_sensor_save_and_delete_invalidate(self):
+        get = lambda: self.registry.get_sensor(*self.key)
+        self.assertReloaded(get, lambda: self.sensor.save())
+        get()
+        self.sensor.delete()
+        with self.assertRaises(Sensor.DoesNotExist):
+            get()
+
+    def test_relay_save_invalidates_but_state_change_does_not(self):
+        get = lambda: self.registry.get_relay(str(self.controller.uuid), str(self.relay.uuid))
+        self.assertReloaded(get, lambda: self.relay.save())
+
+        self.relay.is_working = True
+        self.relay.save(update_fields=["is_working"])
+        with self.assertNumQueries(0):
+            get()
+
+    def test_controller_save_invalidates_its_sensors(self):
+        self.assertReloaded(lambda: self.registry.get_sensor(*self.key), lambda: self.controller.save())
+        self.assertReloaded(lambda: self.registry.get_controller(str(self.controller.uuid)), lambda: self.controller.save())
+
+
+class ReplayTests(TestCase):
+    def test_replayed_readings_are_stored_once(self):
+        company = Company.objects.create(name="Acme")
+        sensor = Sensor.objects.create(
+            controller=Controller.objects.create(company=company, name="controller"),
+            name="sensor",
+            type=Sensor.SensorType.TEMPERATURE,
+        )
+        start = timezone.now() - timedelta(hours=1)
+        readings = [Message(sensor=sensor, value=i, timestamp=start + timedelta(seconds=i)) for i in range(10)]
+
+        buffer = MessageBuffer(max_size=100)
+        for message in readings[:5]:
+            buffer.add(message)
+        self.assertEqual(buffer.flush(), 5)
+
+        # Повторная выгрузка: первые пять уже в БД, одно показание пришло дважды
+        for message in readings + [readings[7]]:
+            buffer.add(Message(sensor=sensor, value=message.value, timestamp=message.timestamp))
+        self.assertEqual(buffer.flush(), 5)
+
+        self.assertEqual(Message.objects.filter(sensor=sensor).count(), 10)
+        minute_counts = MessageRollup.objects.filter(sensor=sensor, resolution=MessageRollup.Resolution.MINUTE)
+        self.assertEqual(sum(minute_counts.values_list("count", flat=True)), 10)
+
+    def test_concurrently_stored_readings_are_not_rolled_up_twice(self):
+        sensor = Sensor.objects.create(
+            controller=Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller"),
+            name="sensor",
+            type=Sensor.SensorType.TEMPERATURE,
+        )
+        start = timezone.now() - timedelta(hours=1)
+        readings = [Message(sensor=sensor, value=i, timestamp=start + timedelta(seconds=i)) for i in range(4)]
+        store_messages(readings[:2], 100)
+
+        # Первая проверка на повторы не видит строк, записанных другим процессом перед вставкой
+        real = ingest.deduplicate
+        calls = []
+
+        def deduplicate(messages):
+            calls.append(len(messages))
+            return messages if len(calls) == 1 else real(messages)
+
+        with mock.patch("api.ingest.deduplicate", side_effect=deduplicate):
+            with self.assertLogs("api.ingest", "WARNING"):
+                stored = store_messages(
+                    [Message(sensor=sensor, value=m.value, timestamp=m.timestamp) for m in readings], 100,
+                )
+        self.assertEqual(calls, [4, 4])
+        self.assertEqual([message.value for message in stored], [2, 3])
+        minute_counts = MessageRollup.objects.filter(sensor=sensor, resolution=MessageRollup.Resolution.MINUTE)
+        self.assertEqual(sum(minute_counts.values_list("count", flat=True)), 4)
+
+
+class AsyncIngestTests(TestCase):
+    def test_pipeline_stores_readings_in_batches(self):
+        from .async_ingest import AsyncIngestEngine
+
+        sensor = Sensor.objects.create(
+            controller=Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller"),
+            name="sensor",
+            type=Sensor.SensorType.TEMPERATURE,
+        )
+        topic = f"controller/{sensor.controller.uuid}/sensors/{sensor.uuid}".encode()
+        start = timezone.now().timestamp() - 3600
+        batches = []
+
+        def store(messages, batch_size):
+            batches.append(len(messages))
+            return store_messages(messages, batch_size)
+
+        async def run():
+            engine = AsyncIngestEngine(batch_size=3, batch_delay=60, store=store)
+            engine.start()
+            for i in range(7):
+                msg = MQTTMessage(topic=topic)
+                msg.payload = json.dumps({"value": i, "ts": start + i}).encode()
+                await engine.feed(msg)
+            await engine.stop()
+            return engine.stats()
+
+        stats = async_to_sync(run)()
+
+        # Полные пачки уходят по размеру, остаток — при остановке
+        self.assertEqual(batches, [3, 3, 1])
+        self.assertEqual(stats["stored"], 7)
+        self.assertEqual(
+            list(Message.objects.filter(sensor=sensor).order_by("timestamp").values_list("value", flat=True)),
+            list(range(7)),
+        )
+
+
+class AsyncWriteRetryTests(SimpleTestCase):
+    def run_writer(self, batches, failures, max_pending=100):
+        from .async_ingest import _STOP, AsyncIngestEngine
+
+        calls = []
+
+        def store(messages, batch_size):
+            calls.append(list(messages))
+            if len(calls) <= failures:
+                raise OperationalError("database is locked")
+            return messages
+
+        async def run():
+            engine = AsyncIngestEngine(batch_delay=0.01, store=store, max_pending=max_pending, retry_max_delay=0.02)
+            engine._batches = asyncio.Queue()
+            for batch in batches:
+                engine._batches.put_nowait([(message, time.perf_counter()) for message in batch])
+            engine._batches.put_nowait(_STOP)
+            with mock.patch("api.async_ingest.close_old_connections"):
+                await engine._write()
+            return engine.stats()
+
+        with self.assertLogs("api.async_ingest", "WARNING"):
+            return calls, async_to_sync(run)()
+
+    def test_failed_batch_is_retried(self):
+        calls, stats = self.run_writer([[1, 2], [3]], failures=2)
+        # Пачка не теряется: к ней добавляется следующая, и обе пишутся после восстановления
+        self.assertEqual(calls[-1], [1, 2, 3])
+        self.assertEqual((stats["stored"], stats["failed"]), (3, 0))
+
+    def test_pending_is_bounded_and_counted(self):
+        dropped = READINGS_DROPPED.labels().value
+        calls, stats = self.run_writer([[1, 2], [3, 4], [5]], failures=1, max_pending=3)
+        self.assertEqual(calls[-1], [3, 4, 5])
+        self.assertEqual(READINGS_DROPPED.labels().value, dropped + 2)
+
+    def test_shutdown_gives_up_after_attempts(self):
+        dropped = READINGS_DROPPED.labels().value
+        calls, stats = self.run_writer([[1, 2]], failures=10)
+        # Первая попытка до остановки и три после неё
+        self.assertEqual(len(calls), 4)
+        self.assertEqual((stats["stored"], stats["failed"]), (0, 2))
+        self.assertEqual(READINGS_DROPPED.labels().value, dropped + 2)
+
+
+class BulkIngestTests(APITestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.controller = Controller.objects.create(company=company, name="controller")
+        self.sensor = Sensor.objects.create(
+            controller=self.controller, name="sensor", type=Sensor.SensorType.TEMPERATURE
+        )
+        start = timezone.now().timestamp() - 3600
+        lines = [{"sensor": str(self.sensor.uuid), "value": i, "ts": start + i} for i in range(100)]
+        # Чужой датчик и показание без времени отклоняются
+        lines += [{"sensor": str(uuid.uuid4()), "value": 1, "ts": start}, {"sensor": str(self.sensor.uuid), "value": 1}]
+        self.body = gzip.compress("\n".join(json.dumps(line) for line in lines).encode())
+
+    def post(self, key="batch-1", api_key=None):
+        return self.client.post(
+            "/ingest/", self.body, content_type="application/x-ndjson",
+            HTTP_X_API_KEY=api_key or self.controller.api_key, HTTP_CONTENT_ENCODING="gzip",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_ingest_is_idempotent(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"received": 102, "stored": 100, "rejected": 2})
+
+        # Повтор с тем же ключом ничего не пишет, с новым — отбрасывает дубликаты
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        self.assertEqual(self.post(key="batch-2").json()["stored"], 0)
+        self.assertEqual(Message.objects.filter(sensor=self.sensor).count(), 100)
+
+    def test_requires_controller_key(self):
+        self.assertEqual(self.post(api_key="wrong").status_code, 403)
+
+
+class APIKeyCacheTests(APITestCase):
+    def setUp(self):
+        api_key_cache.clear()
+        failure_limiter.clear()
+        self.addCleanup(api_key_cache.clear)
+        self.addCleanup(failure_limiter.clear)
+        self.controller = Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller")
+
+    def get(self, api_key):
+        return self.client.post("/ingest/", b"", content_type="application/x-ndjson", HTTP_X_API_KEY=api_key)
+
+    def test_lookup_is_cached_until_controller_changes(self):
+        self.get(self.controller.api_key)
+        with self.assertNumQueries(0):
+            # Без Idempotency-Key запрос отклоняется до обращения к БД
+            self.assertEqual(self.get(self.controller.api_key).status_code, 400)
+
+        old_key = self.controller.api_key
+        self.controller.api_key = "rotated"
+        self.controller.save()
+        self.assertEqual(self.get(old_key).status_code, 403)
+        self.assertEqual(self.get("rotated").status_code, 400)
+
+    def test_invalid_keys_are_rate_limited(self):
+        for i in range(failure_limiter.limit):
+            self.assertEqual(self.get(f"wrong-{i}").status_code, 403)
+        self.assertEqual(self.get("wrong-again").status_code, 429)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get("wrong-0").status_code, 429)
+
+        # Верный ключ с того же адреса (общий NAT) проходит
+        self.assertEqual(self.get(self.controller.api_key).status_code, 400)
+
+    def test_client_address_behind_proxy(self):
+        with self.settings(CLIENT_IP_HEADER="HTTP_X_FORWARDED_FOR"):
+            for i in range(failure_limiter.limit):
+                self.client.post(
+                    "/ingest/", b"", content_type="application/x-ndjson", HTTP_X_API_KEY=f"wrong-{i}",
+                    HTTP_X_FORWARDED_FOR="spoofed, 203.0.113.7",
+                )
+            # Другой клиент за тем же прокси не заблокирован
+            response = self.client.post(
+                "/ingest/", b"", content_type="application/x-ndjson", HTTP_X_API_KEY="wrong",
+                HTTP_X_FORWARDED_FOR="203.0.113.8",
+            )
+        self.assertEqual(response.status_code, 403)
+        self.assertIsNotNone(failure_limiter.wait("203.0.113.7"))
+
+
+class RelayStateTests(TestCase):
+    def setUp(self):
+        controller = Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller")
+        self.relay = Relay.objects.create(controller=controller, name="pump", type=Relay.RelayType.PUMP)
+
+    def test_unchanged_state_is_not_written(self):
+        self.assertTrue(set_relay_state(self.relay, True, RelayStateLog.Source.MANUAL))
+        with self.assertNumQueries(1):
+            self.assertFalse(set_relay_state(self.relay, True, RelayStateLog.Source.MANUAL))
+        self.assertEqual(RelayStateLog.objects.filter(relay=self.relay).count(), 1)
+
+    def test_burst_is_coalesced(self):
+        writer = RelayStateWriter()
+        for is_working in (True, False, True, True):
+            writer.update(self.relay, is_working, RelayStateLog.Source.STATUS)
+        self.assertEqual(writer.flush(), 1)
+        self.relay.refresh_from_db()
+        self.assertTrue(self.relay.is_working)
+        self.assertEqual(list(self.relay.state_log.values_list("is_working", flat=True)), [True])
+
+    def test_failed_flush_is_retried_with_newer_states_winning(self):
+        other = Relay.objects.create(controller=self.relay.controller, name="fan", type=Relay.RelayType.PUMP)
+        writer = RelayStateWriter()
+        writer.update(self.relay, True, RelayStateLog.Source.STATUS)
+        writer.update(other, True, RelayStateLog.Source.STATUS)
+
+        def fail(states):
+            # Пока запись идёт, приходит более новое состояние первого реле
+            writer.update(self.relay, False, RelayStateLog.Source.STATUS)
+            raise OperationalError("database is locked")
+
+        with mock.patch("api.relays.apply_states", side_effect=fail), self.assertLogs("api.relays", "ERROR"):
+            self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.flush(), 1)
+
+        self.relay.refresh_from_db()
+        other.refresh_from_db()
+        self.assertFalse(self.relay.is_working)
+        self.assertTrue(other.is_working)
+
+
+class BulkRelayControlTests(APITestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        controller = Controller.objects.create(company=company, name="controller")
+        self.relays = [
+            Relay.objects.create(controller=controller, name=f"relay-{i}", type=Relay.RelayType.LIGHT)
+            for i in range(3)
+        ]
+        self.client.force_authenticate(
+            User.objects.create_user("manager@example.com", None, role=User.Role.MANAGER, company=company)
+        )
+        self.publisher = mock.Mock()
+        for patcher in (
+            mock.patch("api.views.get_publisher", return_value=self.publisher),
+            mock.patch("api.commands.listen_for_acks"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, states):
+        return self.client.post("/control/relays/", {"relays": [
+            {"relay_uuid": str(relay.uuid), "is_working": state} for relay, state in zip(self.relays, states)
+        ]}, format="json")
+
+    def test_toggles_relays_with_one_publish_batch(self):
+        response = self.post([True, False, True])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["changed"] for item in response.json()["relays"]], [True, False, True])
+
+        self.publisher.publish_many.assert_called_once()
+        topics = [topic for topic, _ in self.publisher.publish_many.call_args.args[0]]
+        self.assertEqual(topics, [f"controller/{r.controller.uuid}/commands/{r.uuid}" for r in self.relays])
+        self.assertEqual(RelayStateLog.objects.count(), 2)
+
+    def test_fire_and_forget_commands_are_tracked(self):
+        controller_uuid = str(self.relays[0].controller.uuid)
+        self.post([True, True, True])
+        stats = command_tracker.stats([controller_uuid])[controller_uuid]
+        self.assertEqual((stats["sent"], stats["pending"]), (3, 3))
+
+        # Статус от контроллера подтверждает команду и без ожидания в запросе
+        command_tracker.ack(controller_uuid, str(self.relays[0].uuid), True)
+        self.assertEqual(command_tracker.stats([controller_uuid])[controller_uuid]["acked"], 1)
+
+    def test_only_acknowledged_commands_are_applied(self):
+        def publish_many(messages):
+            # Контроллер подтверждает только первую команду
+            command_tracker.ack(str(self.relays[0].controller.uuid), str(self.relays[0].uuid), True)
+
+        self.publisher.publish_many.side_effect = publish_many
+        with mock.patch.object(command_tracker, "timeout", 0.05):
+            response = self.client.post("/control/relays/", {
+                "relays": [{"relay_uuid": str(relay.uuid), "is_working": True} for relay in self.relays],
+                "wait_for_ack": True,
+            }, format="json")
+        self.assertEqual([item["acked"] for item in response.json()["relays"]], [True, False, False])
+        self.assertEqual(list(Relay.objects.filter(is_working=True)), self.relays[:1])
+        self.assertEqual(list(ManualControlLog.objects.values_list("relay", flat=True)), [self.relays[0].pk])
+
+    def test_nothing_changes_when_broker_is_down(self):
+        self.publisher.publish_many.side_effect = PublishError("broker is down")
+        self.assertEqual(self.post([True, True, True]).status_code, 503)
+        self.assertFalse(Relay.objects.filter(is_working=True).exists())
+
+
+class CommandTrackerTests(SimpleTestCase):
+    def test_ack_by_id_and_by_state(self):
+        tracker = CommandTracker(timeout=10)
+        first = tracker.register("c1", "r1", True)
+        second = tracker.register("c1", "r1", False)
+
+        # Прошивка без command_id: подтверждается старшая команда с тем же состоянием
+        self.assertIs(tracker.ack("c1", "r1", False), second)
+        self.assertIs(tracker.ack("c1", "r1", True, first.id), first)
+        self.assertIsNone(tracker.ack("c1", "r1", True))
+        self.assertTrue(first.wait(0))
+
+        stats = tracker.stats()["c1"]
+        self.assertEqual((stats["sent"], stats["acked"], stats["pending"]), (2, 2, 0))
+        self.assertEqual(stats["latency_histogram"]["+Inf"], 2)
+
+    def test_unacknowledged_commands_time_out(self):
+        tracker = CommandTracker(timeout=0.01)
+        command = tracker.register("c1", "r1", True)
+        self.assertFalse(command.wait(0.05))
+        self.assertEqual(tracker.stats()["c1"]["timeouts"], 1)
+        self.assertEqual(command.status, "timeout")
+
+
+class AlertDeliveryTests(SimpleTestCase):
+    """Доставка уведомлений на заглушку Telegram API в этом же процессе."""
+
+    def setUp(self):
+        self.requests = queue.Queue()
+        self.release = threading.Event()
+        self.release.set()
+        self.status = 200
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                test.requests.put((self.path, json.loads(self.rfile.read(int(self.headers["Content-Length"])))))
+                test.release.wait(5)
+                self.send_response(test.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        overrides = override_settings(
+            TELEGRAM_API_URL=f"http://127.0.0.1:{server.server_address[1]}",
+            TELEGRAM_BOT_TOKEN="token",
+            ALERT_REMINDER_INTERVAL=0,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        company = Company(pk=1, name="Acme")
+        self.sensor = Sensor(
+            pk=1, controller=Controller(company=company, name="controller"), name="sensor",
+            type=Sensor.SensorType.TEMPERATURE, critical_max=30,
+        )
+        self.dispatcher = AlertDispatcher()
+        # Получатели закэшированы заранее: поток доставки не обращается к БД
+        self.dispatcher._recipients[company.pk] = ([("42", "manager@example.com")], time.monotonic())
+        self.dispatcher.start()
+
+    def check(self, *values):
+        for value in values:
+            self.dispatcher.check(self.sensor, value, timezone.now())
+
+    def test_only_state_changes_are_sent(self):
+        self.check(25, 35, 36, 40, 20, 21)
+        self.dispatcher.stop()
+
+        sent = [self.requests.get_nowait() for _ in range(self.requests.qsize())]
+        self.assertEqual([path for path, _ in sent], ["/bottoken/sendMessage"] * 2)
+        self.assertEqual([body["chat_id"] for _, body in sent], ["42", "42"])
+        self.assertIn("Критическое значение", sent[0][1]["text"])
+        self.assertIn("вернулось в норму", sent[1][1]["text"])
+
+    def test_delivery_does_not_block_ingestion(self):
+        self.release.clear()
+        started = time.monotonic()
+        self.check(35)
+        # Запрос ещё ждёт ответа, а check() уже вернулся
+        self.requests.get(timeout=5)
+        self.assertLess(time.monotonic() - started, 1)
+        self.release.set()
+        self.dispatcher.stop()
+
+    def test_failing_endpoint_is_logged_not_raised(self):
+        self.status = 500
+        failed = ALERTS_FAILED.labels("error").value
+        with self.assertLogs("api.alerts", "ERROR"):
+            self.check(35)
+            self.dispatcher.stop()
+        self.assertEqual(ALERTS_FAILED.labels("error").value, failed + 1)
+
+
+class ProvisioningTests(TestCase):
+    def payload(self, sensors):
+        return {
+            "company_name": "Acme",
+            "name": "controller",
+            "sensors": [
+                {"uuid": str(uuid.UUID(int=i)), "name": name, "type": "temperature", "unit_of_measurements": "C"}
+                for i, name in enumerate(sensors, 1)
+            ],
+            "relays": [{"uuid": str(uuid.UUID(int=100)), "name": "pump"}],
+        }
+
+    def test_init_is_applied_in_bulk_and_skipped_when_unchanged(self):
+        controller_uuid = str(uuid.uuid4())
+        payload = self.payload([f"sensor-{i}" for i in range(50)])
+        # Число запросов не зависит от числа датчиков: по одной выборке и одной вставке на модель
+        with self.assertNumQueries(15):
+            controller = provision(controller_uuid, payload)
+        self.assertEqual(controller.sensors.count(), 50)
+        self.assertTrue(is_unchanged(controller_uuid, init_hash(payload)))
+
+        payload = self.payload(["renamed"] + [f"sensor-{i}" for i in range(1, 51)])
+        self.assertFalse(is_unchanged(controller_uuid, init_hash(payload)))
+        provision(controller_uuid, payload)
+        self.assertEqual(controller.sensors.count(), 51)
+        self.assertEqual(controller.sensors.get(uuid=uuid.UUID(int=1)).name, "renamed")
+
+        # Изменение датчика через API заставляет применить следующий init заново
+        Sensor.objects.filter(uuid=uuid.UUID(int=1)).get().delete()
+        self.assertFalse(is_unchanged(controller_uuid, init_hash(payload)))
+
+    def test_malformed_uuid_skips_only_that_entry(self):
+        controller_uuid = str(uuid.uuid4())
+        payload = self.payload(["good", "bad"])
+        payload["sensors"][1]["uuid"] = "not-a-uuid"
+        payload["relays"].append({"uuid": 42, "name": "broken"})
+        with self.assertLogs("api.provisioning", "WARNING") as logs:
+            controller = provision(controller_uuid, payload)
+        self.assertEqual(list(controller.sensors.values_list("name", flat=True)), ["good"])
+        self.assertEqual(list(controller.relays.values_list("name", flat=True)), ["pump"])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_unsupported_encoding_is_reported_to_controller(self):
+        controller_uuid = str(uuid.uuid4())
+        publisher = mock.Mock()
+        with mock.patch("api.provisioning.supported_encodings", return_value=["json", "struct"]), \
+                mock.patch("api.provisioning.get_publisher", return_value=publisher), \
+                self.assertLogs("api.provisioning", "WARNING"):
+            controller = provision(controller_uuid, {**self.payload(["sensor"]), "encoding": "msgpack"})
+        self.assertEqual(controller.payload_encoding, "json")
+        publisher.publish.assert_called_once_with(
+            f"controller/{controller_uuid}/config", {"encoding": "json"}, retain=True,
+        )
+
+        publisher.reset_mock()
+        with mock.patch("api.provisioning.get_publisher", return_value=publisher):
+            provision(controller_uuid, {**self.payload(["sensor"]), "encoding": "struct"})
+        publisher.publish.assert_not_called()
+
+
+class LiveStreamTests(TestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.user = User.objects.create_user("manager@example.com", None, role=User.Role.MANAGER, company=company)
+        self.controller = Controller.objects.create(company=company, name="controller")
+        self.sensors = [
+            Sensor.objects.create(controller=self.controller, name=f"sensor-{i}", type=Sensor.SensorType.TEMPERATURE)
+            for i in range(2)
+        ]
+
+    def record(self, sensor, value, controller_uuid=None):
+        return {
+            "sensor_uuid": str(sensor.uuid),
+            "controller_uuid": controller_uuid or str(self.controller.uuid),
+            "value": value,
+            "status": Message.Status.OK,
+            "timestamp": timezone.now(),
+        }
+
+    def test_fanout_follows_filters(self):
+        broker = LocalBroker()
+
+        async def run():
+            everything = broker.subscribe(str(self.controller.uuid))
+            second = broker.subscribe(str(self.controller.uuid), [str(self.sensors[1].uuid)])
+            broker.publish(self.record(self.sensors[0], 1))
+            broker.publish(self.record(self.sensors[1], 2))
+            broker.publish(self.record(self.sensors[1], 3, controller_uuid=str(uuid.uuid4())))
+            await asyncio.sleep(0)
+            broker.unsubscribe(everything)
+            broker.unsubscribe(second)
+            return [[s.queue.get_nowait()["value"] for _ in range(s.queue.qsize())] for s in (everything, second)]
+
+        self.assertEqual(async_to_sync(run)(), [[1, 2], [2]])
+
+    def test_unwatched_controllers_are_not_published(self):
+        broker = MQTTBroker(watch_interval=10)
+        client = mock.Mock()
+        broker._client = client
+        broker.publish(self.record(self.sensors[0], 1))
+        client.publish.assert_not_called()
+
+        watch = MQTTMessage(topic=f"live-watch/{self.controller.uuid}".encode())
+        broker._on_watch(client, None, watch)
+        broker.publish(self.record(self.sensors[0], 2))
+        self.assertEqual(client.publish.call_args.args[0], f"live/{self.controller.uuid}/{self.sensors[0].uuid}")
+
+        # Объявление устарело: веб-процесс перестал смотреть контроллер
+        client.publish.reset_mock()
+        with mock.patch("api.live.time.monotonic", return_value=time.monotonic() + 31):
+            broker.publish(self.record(self.sensors[0], 3))
+        client.publish.assert_not_called()
+
+    async def test_stream_delivers_readings(self):
+        broker = LocalBroker()
+        with mock.patch("api.views.get_broker", return_value=broker):
+            response = await self.async_client.get(
+                "/live/", {"controller": str(self.controller.uuid)},
+                headers={"Authorization": f"Bearer {AccessToken.for_user(self.user)}"},
+            )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        events = response.streaming_content
+        self.assertEqual(await anext(events), b"retry: 3000\n\n")
+        broker.publish(self.record(self.sensors[0], 21.5))
+        event = await anext(events)
+        self.assertEqual(json.loads(event.decode().removeprefix("data: "))["value"], 21.5)
+
+    async def test_stream_requires_access(self):
+        other = await User.objects.acreate(
+            email="other@example.com", role=User.Role.MANAGER, company=await Company.objects.acreate(name="Other"),
+        )
+        response = await self.async_client.get(
+            "/live/", {"controller": str(self.controller.uuid)},
+            headers={"Authorization": f"Bearer {AccessToken.for_user(other)}"},
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_ticket_opens_stream_once_issued(self):
+        ticket = self.client.post(
+            "/live/ticket/", headers={"Authorization": f"Bearer {AccessToken.for_user(self.user)}"},
+        ).json()["ticket"]
+        params = {"controller": str(self.controller.uuid), "ticket": ticket}
+
+        with mock.patch("api.views.get_broker", return_value=LocalBroker()):
+            response = async_to_sync(self.async_client.get)("/live/", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        # Просроченный и поддельный билеты отклоняются
+        with override_settings(LIVE_TICKET_TTL=-1):
+            self.assertEqual(async_to_sync(self.async_client.get)("/live/", params).status_code, 401)
+        params["ticket"] = ticket + "x"
+        self.assertEqual(async_to_sync(self.async_client.get)("/live/", params).status_code, 401)
+
+    def test_wsgi_is_rejected(self):
+        response = self.client.get("/live/", {"controller": str(self.controller.uuid)})
+        self.assertEqual(response.status_code, 501)
+
+
+class FakeProcess:
+    pids = iter(range(1000, 2000))
+
+    def __init__(self, target=None, args=(), name=None):
+        self.name = name
+        self.pid = next(self.pids)
+        self.exitcode = None
+        self.alive = False
+        self.drains = True
+        self.killed = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def exit(self, code=1):
+        self.alive = False
+        self.exitcode = code
+
+    def terminate(self):
+        if self.drains:
+            self.exit(0)
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        self.killed = True
+        self.exit(-9)
+
+
+class SupervisorTests(SimpleTestCase):
+    def test_partition_is_stable_per_controller(self):
+        from .mqtt_client import partition, partitioned
+
+        controller_uuid = "7f8c1a52-4c3e-4b8e-9a43-1d2f0e6b5c11"
+        topics = [
+            f"init/{controller_uuid}",
+            f"controller/{controller_uuid}/sensors/{uuid.uuid4()}",
+            f"controller/{controller_uuid}/relays/{uuid.uuid4()}/status",
+        ]
+        # md5, а не hash(): номер не меняется между процессами и запусками
+        self.assertEqual({partition(topic, 4) for topic in topics}, {1})
+
+        counts = [0] * 4
+        for _ in range(400):
+            counts[partition(f"controller/{uuid.uuid4()}/sensors/s", 4)] += 1
+        self.assertTrue(all(count > 50 for count in counts))
+
+        callback = mock.Mock()
+        for index in range(4):
+            partitioned(callback, index, 4)(None, None, MQTTMessage(topic=topics[0].encode()))
+        callback.assert_called_once()
+
+    def test_crashing_worker_is_restarted_with_backoff(self):
+        supervisor = WorkerSupervisor(1, drain_timeout=1, min_uptime=10, max_backoff=4)
+        clock = mock.Mock(return_value=0.0)
+        with mock.patch.object(supervisor._context, "Process", FakeProcess), \
+                mock.patch("api.supervisor.time.monotonic", clock), self.assertLogs("api.supervisor", "INFO"):
+            supervisor._spawn(0)
+
+            def crash_at(now):
+                clock.return_value = now
+                supervisor._processes[0].exit()
+                supervisor._check(0)
+
+            def running_at(now):
+                clock.return_value = now
+                supervisor._check(0)
+                return supervisor._processes[0] is not None
+
+            # Быстрые падения: пауза 1, затем 2, затем 4 — не больше max_backoff
+            crash_at(1)
+            self.assertFalse(running_at(1.5))
+            self.assertTrue(running_at(2))
+            crash_at(3)
+            self.assertFalse(running_at(4.9))
+            self.assertTrue(running_at(5))
+            crash_at(6)
+            self.assertEqual((supervisor._restart_at[0], supervisor._backoff[0]), (10, 4))
+
+            # Воркер, проработавший дольше min_uptime, перезапускается сразу, пауза сбрасывается
+            self.assertTrue(running_at(10))
+            crash_at(30)
+            self.assertIsNotNone(supervisor._processes[0])
+            self.assertEqual(supervisor._backoff[0], 1.0)
+
+    def test_stop_kills_workers_that_do_not_drain(self):
+        supervisor = WorkerSupervisor(2, drain_timeout=0)
+        with mock.patch.object(supervisor._context, "Process", FakeProcess), self.assertLogs("api.supervisor", "INFO"):
+            supervisor._spawn(0)
+            supervisor._spawn(1)
+            supervisor._processes[1].drains = False
+            supervisor._stop_all()
+        self.assertEqual([process.killed for process in supervisor._processes], [False, True])
+
+
+class MetricsTests(APITestCase):
+    def test_histogram_exposition(self):
+        histogram = Histogram("test_seconds", "Test", ["topic"], buckets=(0.1, 1))
+        histogram.labels("sensor").observe(0.05)
+        histogram.labels("sensor").observe(0.5)
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{topic="sensor",le="0.1"} 1',
+            'test_seconds_bucket{topic="sensor",le="1.0"} 2',
+            'test_seconds_bucket{topic="sensor",le="+Inf"} 2',
+            'test_seconds_sum{topic="sensor"} 0.55',
+            'test_seconds_count{topic="sensor"} 2',
+        ])
+
+    def test_endpoint_reports_requests_and_stored_readings(self):
+        sensor = Sensor.objects.create(
+            controller=Controller.objects.create(company=Company.objects.create(name="Acme"), name="controller"),
+            name="sensor",
+            type=Sensor.SensorType.TEMPERATURE,
+        )
+        stored = READINGS_STORED.labels().value
+        store_messages([Message(sensor=sensor, value=1, timestamp=timezone.now())], 100)
+        self.assertEqual(READINGS_STORED.labels().value, stored + 1)
+
+        self.client.get("/api/sensors/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        # Метка — имя маршрута, а не путь
+        self.assertIn('iot_http_responses_total{view="sensor-list",method="GET",status="401"}', body)
+        self.assertIn("iot_readings_stored_total", body)
+
+    def test_endpoint_is_restricted(self):
+        # Произвольный метод не становится отдельной меткой
+        self.client.generic("BREW", "/api/sensors/")
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('iot_http_responses_total{view="sensor-list",method="other"', body)
+
+        with self.settings(METRICS_ALLOWED_IPS=["10.1.0.0/16"], METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.1.2.3").status_code, 200)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+
+
+class SampledLoggingTests(SimpleTestCase):
+    def record(self, level=logging.INFO, log_key="sensor-1"):
+        record = logging.LogRecord("api.mqtt_client", level, "", 0, "Buffered sensor data: %s", ("t",), None)
+        if log_key is not None:
+            record.log_key = log_key
+        return record
+
+    def test_sampling_and_rate_limit(self):
+        log_filter = SamplingFilter(sample_rate=10, rate_limit=3, window=60)
+
+        # Одна запись из десяти на ключ; записанная несёт число пропущенных перед ней
+        records = [self.record() for _ in range(20)]
+        passed = [record for record in records if log_filter.filter(record)]
+        self.assertEqual(passed, [records[0], records[10]])
+        self.assertEqual(records[10].suppressed, 9)
+        # У другого ключа свой счёт
+        self.assertTrue(log_filter.filter(self.record(log_key="sensor-2")))
+
+        # Предупреждения не прореживаются, но ограничены числом за окно; ошибки проходят всегда
+        warnings = [log_filter.filter(self.record(logging.WARNING, "sensor-3")) for _ in range(5)]
+        self.assertEqual(warnings, [True, True, True, False, False])
+        self.assertTrue(log_filter.filter(self.record(logging.ERROR, "sensor-3")))
+        self.assertTrue(log_filter.filter(self.record(log_key=None)))
+
+    def test_least_recently_seen_key_is_evicted(self):
+        log_filter = SamplingFilter(sample_rate=10, rate_limit=3, window=60, max_keys=2)
+        self.assertTrue(log_filter.filter(self.record(log_key="sensor-1")))
+        self.assertTrue(log_filter.filter(self.record(log_key="sensor-2")))
+        self.assertFalse(log_filter.filter(self.record(log_key="sensor-1")))
+        # sensor-1 встречался позже sensor-2, поэтому вытесняется sensor-2
+        self.assertTrue(log_filter.filter(self.record(log_key="sensor-3")))
+        self.assertFalse(log_filter.filter(self.record(log_key="sensor-1")))
+        self.assertTrue(log_filter.filter(self.record(log_key="sensor-2")))
+
+    def test_import_leaves_logging_alone(self):
+        from . import mqtt_client, supervisor  # noqa: F401
+
+        self.assertFalse(any(isinstance(handler, LocalQueueHandler) for handler in logging.getLogger().handlers))
+
+    def test_json_output(self):
+        record = self.record()
+        record.suppressed = 4
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual(data["message"], "Buffered sensor data: t")
+        self.assertEqual(data["level"], "INFO")
+        self.assertEqual((data["log_key"], data["suppressed"]), ("sensor-1", 4))
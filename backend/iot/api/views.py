@@ -1,19 +1,56 @@
+import gzip
 import json
+import math
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import time
+import importlib.util
+from datetime import datetime, timedelta
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import (
+    APIException, AuthenticationFailed, NotAuthenticated, NotFound, PermissionDenied, ValidationError
+)
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Subquery
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 
-import paho.mqtt.publish as publish
-
-from .models import Company, Relay, User, Controller, Sensor, Message, ManualControlLog
+from .models import (
+    Company, Relay, User, Controller, Sensor, Message, MessageRollup,
+    ManualControlLog, IngestBatch, RelayStateLog,
+)
 from .serializers import (
     CompanySerializer, UserSerializer, RelaySerializer,
-    ControllerSerializer, SensorSerializer, MessageSerializer
+    ControllerSerializer, SensorSerializer, MessageSerializer, MessageValuesSerializer,
+    MessageRollupSerializer, LatestValueSerializer
 )
-from .permissions import IsSuperUser, IsCompanyUser
+from .permissions import IsSuperUser, IsCompanyUser, IsController
+from .authentication import ControllerAPIKeyAuthentication
+from .pagination import MessageCursorPagination, RollupCursorPagination
+from .downsampling import fetch_series, lttb
+from .export import CONTENT_TYPES, EXPORTERS, REQUIREMENTS, iter_rows
+from .latest import get_latest_store
+from .live import get_broker
+from .codecs import decode_batch, to_datetime
+from .ingest import MAX_CLOCK_SKEW, store_messages
+from .relays import apply_states, set_relay_state
+from .publisher import PublishError, get_publisher
+from .commands import command_tracker, create_command
+from . import metrics
 
 class CompanyViewSet(viewsets.ModelViewSet):
     queryset = Company.objects.all()
@@ -37,9 +74,10 @@ class ControllerViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        queryset = Controller.objects.select_related('company')
         if user.role == 'SUPERUSER':
-            return Controller.objects.all()
-        return Controller.objects.filter(company=user.company)
+            return queryset
+        return queryset.filter(company=user.company)
 
 class SensorViewSet(viewsets.ModelViewSet):
     serializer_class = SensorSerializer
@@ -47,9 +85,10 @@ class SensorViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        queryset = Sensor.objects.select_related('controller__company')
         if user.role == 'SUPERUSER':
-            return Sensor.objects.all()
-        return Sensor.objects.filter(controller__company=user.company)
+            return queryset
+        return queryset.filter(controller__company=user.company)
 
 
 class RelayViewSet(viewsets.ModelViewSet):
@@ -58,17 +97,125 @@ class RelayViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        queryset = Relay.objects.select_related('controller__company')
         if user.role == 'SUPERUSER':
-            return Relay.objects.all()
-        return Relay.objects.filter(controller__company=user.company)
+            return queryset
+        return queryset.filter(controller__company=user.company)
 
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated, IsCompanyUser]
+    pagination_class = MessageCursorPagination
+    # Размер страницы, при котором ответ по ?max_points= не обрезается; задаёт get_resolution()
+    series_page_size = None
 
     def get_queryset(self):
+        queryset = self.filter_by_params(Message.objects.select_related('sensor__controller__company'), 'timestamp')
+
+        # фильтрация по статусу, можно несколько через запятую: ?status=warning,error
+        status = self.request.query_params.get('status')
+        if status:
+            statuses = status.split(',')
+            if not set(statuses) <= set(Message.Status.values):
+                raise ValidationError({"status": f"Allowed values: {', '.join(Message.Status.values)}."})
+            queryset = queryset.filter(status__in=statuses)
+
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        resolution = self.get_resolution()
+        if resolution is None:
+            return self.list_raw()
+
+        queryset = self.filter_by_params(MessageRollup.objects.filter(resolution=resolution), 'bucket')
+        queryset = queryset.select_related('sensor__controller')
+        paginator = RollupCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self, page_size=self.series_page_size)
+        return paginator.get_paginated_response(MessageRollupSerializer(page, many=True).data)
+
+    def list_raw(self):
+        # Список читается через values(): без экземпляров модели и без запросов на каждую строку
+        queryset = self.filter_queryset(self.get_queryset()).values(*MessageValuesSerializer.Meta.fields)
+        page = self.paginator.paginate_queryset(queryset, self.request, view=self, page_size=self.series_page_size)
+        return self.get_paginated_response(MessageValuesSerializer(page, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Потоковая выгрузка истории: ?export_format=csv|ndjson|parquet|xlsx и те же фильтры, что у списка.
+        """
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORTERS:
+            raise ValidationError({"export_format": f"Allowed values: {', '.join(EXPORTERS)}."})
+
+        requirement = REQUIREMENTS.get(export_format)
+        if requirement and importlib.util.find_spec(requirement) is None:
+            raise ValidationError({"export_format": f"{export_format} export requires {requirement} to be installed."})
+
+        chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+        rows = iter_rows(self.get_queryset(), chunk_size)
+        response = StreamingHttpResponse(
+            EXPORTERS[export_format](rows, chunk_size),
+            content_type=CONTENT_TYPES[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="messages.{export_format}"'
+        return response
+
+    @action(detail=False, methods=['get'])
+    def series(self, request):
+        """
+        Прореженный методом LTTB ряд значений для графиков:
+        ?sensors=uuid1,uuid2&start=...&end=...&points=1000
+        """
+        sensor_uuids = request.query_params.get('sensors') or request.query_params.get('sensor')
+        if not sensor_uuids:
+            raise ValidationError({"sensors": "At least one sensor UUID is required."})
+        sensor_uuids = sensor_uuids.split(',')
+
+        try:
+            points = int(request.query_params.get('points', 1000))
+            if not 3 <= points <= 10000:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({"points": "points must be an integer between 3 and 10000."})
+
+        try:
+            sensors = Sensor.objects.select_related('controller').filter(uuid__in=sensor_uuids)
+        except DjangoValidationError:
+            raise ValidationError({"sensors": "Invalid sensor UUID."})
+        if request.user.role != 'SUPERUSER':
+            sensors = sensors.filter(controller__company=request.user.company)
+        sensors = list(sensors)
+        if len(sensors) != len(set(sensor_uuids)):
+            raise ValidationError({"sensors": "Sensor with this UUID does not exist."})
+
+        start_date, end_date = self.get_date_range()
+        tz = timezone.get_current_timezone()
+        result = []
+        for sensor in sensors:
+            queryset = Message.objects.filter(sensor=sensor)
+            if start_date:
+                queryset = queryset.filter(timestamp__gte=start_date)
+            if end_date:
+                queryset = queryset.filter(timestamp__lte=end_date)
+
+            x, y = fetch_series(queryset)
+            selected = lttb(x, y, points)
+            result.append({
+                "sensor_uuid": str(sensor.uuid),
+                "controller_uuid": str(sensor.controller.uuid),
+                "total": len(x),
+                "points": [
+                    {"timestamp": datetime.fromtimestamp(x[i], tz).isoformat(), "value": float(y[i])}
+                    for i in selected
+                ],
+            })
+
+        return Response(result)
+
+    def filter_by_params(self, queryset, time_field):
+        """Общие фильтры для сообщений и агрегатов: компания, датчик, контроллер, период."""
         user = self.request.user
-        queryset = Message.objects.all()
 
         if user.role != 'SUPERUSER':
             queryset = queryset.filter(sensor__controller__company=user.company)
@@ -90,32 +237,78 @@ class MessageViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(sensor__controller__uuid=controller_uuid)
 
         # кастомная фильтрация по дате
+        start_date, end_date = self.get_date_range()
+
+        if start_date:
+            queryset = queryset.filter(**{f'{time_field}__gte': start_date})
+
+        if end_date:
+            queryset = queryset.filter(**{f'{time_field}__lte': end_date})
+
+        return queryset
+
+    def get_date_range(self):
         start = self.request.query_params.get('start')
         end = self.request.query_params.get('end')
+        return (parse_datetime(start) if start else None, parse_datetime(end) if end else None)
+
+    def get_resolution(self):
+        """
+        Выбирает агрегат для ответа: явно через ?resolution=1m|1h|1d или по ?max_points=.
+        None означает сырые сообщения. Агрегаты не хранят статусы, поэтому
+        ?status= вместе с агрегатом — ошибка, а с ?max_points= отдаются сырые строки.
+        """
+        resolution = self.request.query_params.get('resolution')
+        if resolution:
+            allowed = ['raw', *MessageRollup.Resolution.values]
+            if resolution not in allowed:
+                raise ValidationError({"resolution": f"Allowed values: {', '.join(allowed)}."})
+            if resolution != 'raw' and self.request.query_params.get('status'):
+                raise ValidationError({"status": "status can not be combined with an aggregated resolution."})
+            return None if resolution == 'raw' else resolution
+
+        max_points = self.request.query_params.get('max_points')
+        if not max_points or self.request.query_params.get('status'):
+            return None
 
-        if start:
-            start_date = parse_datetime(start)
-            if start_date:
-                queryset = queryset.filter(timestamp__gte=start_date)
+        try:
+            max_points = int(max_points)
+            if max_points <= 0:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({"max_points": "max_points must be a positive integer."})
 
-        if end:
-            end_date = parse_datetime(end)
-            if end_date:
-                queryset = queryset.filter(timestamp__lte=end_date)
+        start_date, end_date = self.get_date_range()
+        if not start_date:
+            raise ValidationError({"start": "start is required together with max_points."})
+
+        # Ряд по ?max_points= отдаётся одной страницей до max_points строк, а не по page_size
+        self.series_page_size = max_points
+
+        # Подсчёт идёт по индексу (sensor, timestamp) и дешевле выборки самих строк
+        if self.get_queryset().count() <= max_points:
+            return None
+
+        span = ((end_date or timezone.now()) - start_date).total_seconds()
+        for resolution in MessageRollup.Resolution:
+            if span / MessageRollup.SECONDS[resolution] <= max_points:
+                return resolution
+        return MessageRollup.Resolution.DAY
 
-        return queryset
-    
 
 class LatestSensorMessageView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
+        if request.query_params.get("sensors") or request.query_params.get("controller"):
+            return self.get_many(request)
+
         sensor_uuid = request.query_params.get("sensor")
         if not sensor_uuid:
             raise ValidationError({"sensor": "sensor UUID is required"})
 
         try:
-            sensor = Sensor.objects.get(uuid=sensor_uuid)
+            sensor = Sensor.objects.select_related('controller__company').get(uuid=sensor_uuid)
         except Sensor.DoesNotExist:
             raise ValidationError({"sensor": "Sensor not found"})
 
@@ -131,26 +324,88 @@ class LatestSensorMessageView(APIView):
         serializer = MessageSerializer(message)
         return Response(serializer.data)
 
+    def get_many(self, request):
+        """
+        Последние значения сразу по нескольким датчикам: ?sensors=uuid1,uuid2 или ?controller=uuid.
+        Значения берутся из общего хранилища последних значений (Redis), недостающие —
+        одним запросом к БД. Хранилище в памяти процесса не используется: его наполняет
+        только этот процесс, и устаревшее значение (а с ним и ETag) осталось бы в ответе.
+        """
+        sensors = Sensor.objects.all()
+        try:
+            if request.query_params.get("sensors"):
+                sensors = sensors.filter(uuid__in=request.query_params["sensors"].split(","))
+            if request.query_params.get("controller"):
+                sensors = sensors.filter(controller__uuid=request.query_params["controller"])
+        except DjangoValidationError:
+            raise ValidationError({"sensors": "Invalid UUID."})
+
+        if request.user.role != 'SUPERUSER':
+            sensors = sensors.filter(controller__company=request.user.company)
+        sensors = {str(uuid): pk for uuid, pk in sensors.values_list("uuid", "pk")}
+
+        store = get_latest_store()
+        records = store.get_many(list(sensors)) if store.shared else {}
+
+        missing = [pk for uuid, pk in sensors.items() if uuid not in records]
+        if missing:
+            latest_id = Message.objects.filter(sensor=OuterRef("pk")).order_by("-timestamp", "-id").values("id")[:1]
+            latest_ids = Sensor.objects.filter(pk__in=missing).annotate(latest_id=Subquery(latest_id)).values("latest_id")
+            for row in Message.objects.filter(id__in=latest_ids).values(
+                "value", "status", "timestamp", "sensor__uuid", "sensor__controller__uuid"
+            ):
+                records[str(row["sensor__uuid"])] = {
+                    "sensor_uuid": str(row["sensor__uuid"]),
+                    "controller_uuid": str(row["sensor__controller__uuid"]),
+                    "value": row["value"],
+                    "status": row["status"],
+                    "timestamp": row["timestamp"],
+                }
+
+        records = sorted(records.values(), key=lambda record: record["sensor_uuid"])
+        etag = '"%s"' % hashlib.md5(
+            "|".join(f"{r['sensor_uuid']}:{r['timestamp'].isoformat()}:{r['value']}" for r in records).encode()
+        ).hexdigest()
+
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers={"ETag": etag})
+
+        serializer = LatestValueSerializer(records, many=True)
+        return Response(serializer.data, headers={"ETag": etag})
+
+
+def parse_is_working(value):
+    if str(value).lower() in ["1", "true"]:
+        return True
+    if str(value).lower() in ["0", "false"]:
+        return False
+    return None
+
+
+def command_topic(relay):
+    return f"controller/{relay.controller.uuid}/commands/{relay.uuid}"
+
+
+def check_manual_control(user, controller):
+    """Ответ с ошибкой, если пользователь не может вручную управлять контроллером."""
+    if not user.is_superuser and controller.company != user.company:
+        return Response({"error": "Access denied"}, status=403)
+    if controller.control_mode != "manual":
+        return Response({"error": "Controller in auto mode. Manual control not allowed."}, status=400)
+    return None
+
 
 class RelayControlView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, controller_uuid):
         relay_uuid = request.data.get("relay_uuid")  # relay uuid
-        is_working_raw = request.data.get("is_working")
-
-        if str(is_working_raw).lower() in ["1", "true"]:
-            is_working = True
-        elif str(is_working_raw).lower() in ["0", "false"]:
-            is_working = False
-        else:
+        is_working = parse_is_working(request.data.get("is_working"))
+        if is_working is None:
             return Response({"error": "is_working must be a boolean or 0/1"}, status=400)
 
-        if not isinstance(is_working, bool):
-            return Response({"error": "is_working must be boolean"}, status=400)
-
         try:
-            controller = Controller.objects.get(uuid=controller_uuid)
+            controller = Controller.objects.select_related("company").get(uuid=controller_uuid)
         except Controller.DoesNotExist:
             return Response({"error": "Controller not found"}, status=404)
 
@@ -159,28 +414,28 @@ class RelayControlView(APIView):
         except Relay.DoesNotExist:
             return Response({"error": "Relay not found or does not belong to this controller"}, status=404)
 
+        error = check_manual_control(request.user, controller)
+        if error is not None:
+            return error
 
-        if not request.user.is_superuser and controller.company != request.user.company:
-            return Response({"error": "Access denied"}, status=403)
-        
-        if controller.control_mode != "manual":
-            return Response({"error": "Controller in auto mode. Manual control not allowed."}, status=400)
-
-        # MQTT publish
-        topic = f"controller/{controller.uuid}/commands/{relay_uuid}"
-        payload = {
-            "is_working": is_working
-        }
+        wait_for_ack = parse_is_working(request.data.get("wait_for_ack", False)) is True
+        command = create_command(controller.uuid, relay.uuid, is_working)
 
-        publish.single(
-            topic,
-            json.dumps(payload),
-            hostname="localhost",
-            port=1883
-        )
+        # Публикация через общее соединение с брокером, без подключения на каждый запрос
+        try:
+            get_publisher().publish(command_topic(relay), command.payload())
+        except PublishError as e:
+            command_tracker.fail(command)
+            return Response({"error": str(e)}, status=503)
 
-        relay.is_working = is_working
-        relay.save(update_fields=["is_working"])
+        # Без ожидания состояние записывается сразу, не дожидаясь ответа контроллера
+        if wait_for_ack and not command.wait(command_tracker.timeout):
+            return Response(
+                {"error": "Controller did not acknowledge the command", "command_id": command.id}, status=504
+            )
+
+        # Условный UPDATE: повторное нажатие не пишет в БД и не попадает в историю
+        set_relay_state(relay, is_working, RelayStateLog.Source.MANUAL)
 
         # Логирование
         ManualControlLog.objects.create(
@@ -190,6 +445,332 @@ class RelayControlView(APIView):
             performed_by=request.user
         )
 
-        return Response({"message": f"{relay_uuid} turned {'on' if is_working else 'off'}"})
+        return Response({
+            "message": f"{relay_uuid} turned {'on' if is_working else 'off'}",
+            "command_id": command.id,
+            "ack_latency": command.latency,
+        })
+
+
+class BulkRelayControlView(APIView):
+    """
+    Переключение нескольких реле одним запросом, например для сценария:
+    {"relays": [{"relay_uuid": "...", "is_working": true}, ...]}
+
+    Команды публикуются подряд по одному соединению, подтверждения брокера
+    ожидаются разом. Если хоть одно реле недоступно, не отправляется ничего.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        items = request.data.get("relays")
+        max_relays = getattr(settings, "RELAY_CONTROL_MAX_BATCH", 500)
+        if not isinstance(items, list) or not items:
+            return Response({"error": "relays must be a non-empty list"}, status=400)
+        if len(items) > max_relays:
+            return Response({"error": f"At most {max_relays} relays per request"}, status=400)
+
+        commands = {}
+        for item in items:
+            is_working = parse_is_working(item.get("is_working")) if isinstance(item, dict) else None
+            if is_working is None:
+                return Response({"error": "Each item needs relay_uuid and is_working (boolean or 0/1)"}, status=400)
+            commands[str(item.get("relay_uuid"))] = is_working
+
+        try:
+            relays = {
+                str(relay.uuid): relay
+                for relay in Relay.objects.select_related("controller__company").filter(uuid__in=commands)
+            }
+        except DjangoValidationError:
+            return Response({"error": "Invalid relay UUID"}, status=400)
+        missing = [relay_uuid for relay_uuid in commands if relay_uuid not in relays]
+        if missing:
+            return Response({"error": "Relays not found", "relays": missing}, status=404)
+
+        for relay in relays.values():
+            error = check_manual_control(request.user, relay.controller)
+            if error is not None:
+                return error
+
+        wait_for_ack = parse_is_working(request.data.get("wait_for_ack", False)) is True
+        tracked = {
+            relay_uuid: create_command(relays[relay_uuid].controller.uuid, relay_uuid, is_working)
+            for relay_uuid, is_working in commands.items()
+        }
+        try:
+            get_publisher().publish_many([
+                (command_topic(relays[relay_uuid]), command.payload()) for relay_uuid, command in tracked.items()
+            ])
+        except PublishError as e:
+            for command in tracked.values():
+                command_tracker.fail(command)
+            return Response({"error": str(e)}, status=503)
+
+        # С ожиданием записываются только подтверждённые команды, общий срок — один на запрос
+        if wait_for_ack:
+            deadline = time.monotonic() + command_tracker.timeout
+            acked = {
+                relay_uuid for relay_uuid, command in tracked.items()
+                if command.wait(max(deadline - time.monotonic(), 0))
+            }
+        else:
+            acked = set(commands)
+
+        now = timezone.now()
+        changed = set(apply_states({
+            relays[relay_uuid].pk: (commands[relay_uuid], RelayStateLog.Source.MANUAL, now)
+            for relay_uuid in acked
+        }))
+        ManualControlLog.objects.bulk_create([
+            ManualControlLog(
+                controller=relays[relay_uuid].controller,
+                relay=relays[relay_uuid],
+                action="on" if is_working else "off",
+                performed_by=request.user,
+            )
+            for relay_uuid, is_working in commands.items()
+            if relay_uuid in acked
+        ])
+
+        return Response({"relays": [
+            {
+                "relay_uuid": relay_uuid,
+                "is_working": is_working,
+                "changed": relays[relay_uuid].pk in changed,
+                "command_id": tracked[relay_uuid].id,
+                "acked": relay_uuid in acked if wait_for_ack else None,
+                "ack_latency": tracked[relay_uuid].latency,
+            }
+            for relay_uuid, is_working in commands.items()
+        ]})
+
+
+class CommandStatsView(APIView):
+    """
+    Статистика команд реле по контроллерам: отправлено, подтверждено,
+    просрочено, гистограмма задержки подтверждения (секунды, накопительно).
+    Учитываются все команды, в том числе отправленные без wait_for_ack.
+    Счётчики ведутся в памяти процесса: ?controller=uuid1,uuid2 сужает выборку.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        controllers = Controller.objects.all()
+        if request.user.role != 'SUPERUSER':
+            controllers = controllers.filter(company=request.user.company)
+
+        controller_uuids = request.query_params.get("controller")
+        try:
+            if controller_uuids:
+                controllers = controllers.filter(uuid__in=controller_uuids.split(","))
+            uuids = list(controllers.values_list("uuid", flat=True))
+        except DjangoValidationError:
+            raise ValidationError({"controller": "Invalid controller UUID."})
+
+        return Response(command_tracker.stats(uuids))
+
+
+class BulkIngestView(APIView):
+    """
+    Выгрузка показаний, накопленных контроллером без связи, одним запросом.
+
+    Тело — NDJSON (``application/x-ndjson``) или пакет struct в формате топика
+    controller/<uuid>/sensors/batch (``application/octet-stream``), при
+    ``Content-Encoding: gzip`` — сжатое. У каждого показания должно быть время
+    устройства. Повтор с тем же ``Idempotency-Key`` возвращает прежний результат.
+    """
+    authentication_classes = [ControllerAPIKeyAuthentication]
+    permission_classes = [IsController]
+
+    encodings = {
+        "application/x-ndjson": "ndjson",
+        "application/octet-stream": "struct",
+    }
+
+    def post(self, request):
+        controller = request.user
+        key = request.headers.get("Idempotency-Key", "")
+        if not key or len(key) > 100:
+            return Response({"error": "Idempotency-Key header (up to 100 chars) is required"}, status=400)
+
+        batch = IngestBatch.objects.filter(controller=controller, idempotency_key=key).first()
+        if batch is not None:
+            return self.batch_response(batch, replayed=True)
+
+        encoding = self.encodings.get(request.content_type.split(";")[0].strip())
+        if encoding is None:
+            return Response({"error": f"Unsupported content type, use one of: {', '.join(self.encodings)}"}, status=415)
+
+        max_size = getattr(settings, "INGEST_MAX_BODY_SIZE", 32 * 1024 * 1024)
+        try:
+            body = self.read_body(request, max_size)
+            if len(body) > max_size:
+                return Response({"error": f"Payload exceeds {max_size} bytes"}, status=413)
+            readings = decode_batch(encoding, body)
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+            return Response({"error": f"Invalid payload: {e}"}, status=400)
+
+        sensors = {str(sensor.uuid): sensor for sensor in Sensor.objects.filter(controller=controller)}
+        received_at = timezone.now()
+        messages = []
+        for sensor_uuid, value, ts in readings:
+            sensor = sensors.get(str(sensor_uuid))
+            timestamp = to_datetime(ts)
+            # Без времени устройства показание не разместить на шкале и не отличить повтор
+            if sensor is None or timestamp is None or timestamp - received_at > MAX_CLOCK_SKEW:
+                continue
+            if not math.isfinite(value):
+                continue
+            sensor.controller = controller
+            messages.append(Message(sensor=sensor, value=value, status=sensor.get_status(value), timestamp=timestamp))
+
+        try:
+            with transaction.atomic():
+                batch = IngestBatch.objects.create(
+                    controller=controller,
+                    idempotency_key=key,
+                    received=len(readings),
+                    rejected=len(readings) - len(messages),
+                )
+                batch.stored = len(store_messages(messages, getattr(settings, "INGEST_BATCH_SIZE", 1000)))
+                batch.save(update_fields=["stored"])
+        except IntegrityError:
+            # Параллельный запрос с тем же ключом успел раньше
+            batch = IngestBatch.objects.get(controller=controller, idempotency_key=key)
+            return self.batch_response(batch, replayed=True)
+
+        ttl = getattr(settings, "INGEST_IDEMPOTENCY_TTL", 7 * 24 * 3600)
+        IngestBatch.objects.filter(created_at__lt=received_at - timedelta(seconds=ttl)).delete()
+        return self.batch_response(batch)
+
+    def read_body(self, request, max_size):
+        # request.body упирается в DATA_UPLOAD_MAX_MEMORY_SIZE, поэтому читаем поток сами
+        stream = request._request
+        if request.headers.get("Content-Encoding", "").lower() == "gzip":
+            stream = gzip.GzipFile(fileobj=stream)
+        return stream.read(max_size + 1)
+
+    def batch_response(self, batch, replayed=False):
+        return Response(
+            {"received": batch.received, "stored": batch.stored, "rejected": batch.rejected},
+            status=200 if replayed else 201,
+            headers={"Idempotent-Replayed": "true"} if replayed else None,
+        )
+
+
+LIVE_TICKET_SALT = "api.live-stream"
 
 
+class LiveTicketView(APIView):
+    """
+    Короткоживущий билет для /live/?ticket=. EventSource не умеет передавать
+    заголовки, а JWT в строке запроса остался бы в журналах доступа.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        return Response({
+            "ticket": signing.dumps(request.user.pk, salt=LIVE_TICKET_SALT),
+            "expires_in": getattr(settings, "LIVE_TICKET_TTL", 30),
+        })
+
+
+async def live_stream(request):
+    """
+    Server-Sent Events с показаниями в реальном времени: /live/?controller=uuid[&sensors=a,b].
+    Доступ по заголовку Authorization или по билету из /live/ticket/ в ?ticket=.
+
+    Поток бесконечный и держит соединение, поэтому работает только под
+    ASGI-сервером (uvicorn iot.asgi:application); под WSGI отвечает 501.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"error": "Live stream requires an ASGI server"}, status=501)
+
+    try:
+        controller = await sync_to_async(authorize_live_stream)(request)
+    except APIException as e:
+        return JsonResponse({"error": str(e.detail)}, status=e.status_code)
+
+    sensors = request.GET.get("sensors")
+    broker = get_broker()
+    subscription = broker.subscribe(str(controller.uuid), sensors.split(",") if sensors else None)
+    keepalive = getattr(settings, "LIVE_KEEPALIVE", 15)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    record = await subscription.get(timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(record, cls=DjangoJSONEncoder)}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def metrics_allowed(request):
+    token = getattr(settings, "METRICS_TOKEN", None)
+    header = request.headers.get("Authorization", "")
+    if token and hmac.compare_digest(header.encode(), f"Bearer {token}".encode()):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+    )
+
+
+def authorize_live_stream(request):
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    if header:
+        request.user = authentication.get_user(authentication.get_validated_token(authentication.get_raw_token(header)))
+    elif request.GET.get("ticket"):
+        request.user = user_from_ticket(request.GET["ticket"])
+    else:
+        raise NotAuthenticated()
+
+    controller_uuid = request.GET.get("controller")
+    if not controller_uuid:
+        raise ValidationError({"controller": "controller UUID is required"})
+    try:
+        controller = Controller.objects.select_related("company").get(uuid=controller_uuid)
+    except (Controller.DoesNotExist, DjangoValidationError):
+        raise NotFound("Controller not found")
+
+    # Та же проверка доступа, что и у REST-эндпоинтов
+    if not IsCompanyUser().has_object_permission(request, None, controller):
+        raise PermissionDenied("Access denied")
+    return controller
+
+
+def user_from_ticket(ticket):
+    try:
+        user_id = signing.loads(ticket, salt=LIVE_TICKET_SALT, max_age=getattr(settings, "LIVE_TICKET_TTL", 30))
+    except signing.BadSignature:
+        raise AuthenticationFailed("Invalid or expired ticket")
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    if user is None:
+        raise AuthenticationFailed("User not found")
+    return user
+
+
+def metrics_view(request):
+    """
+    Метрики этого процесса в формате Prometheus. Доступны с адресов из
+    ``METRICS_ALLOWED_IPS`` или с заголовком ``Authorization: Bearer <METRICS_TOKEN>``.
+    """
+    if not metrics_allowed(request):
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
@@ -72,6 +72,7 @@ DJOSER = {
 AUTH_USER_MODEL = 'api.User'
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -141,6 +142,133 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 TELEGRAM_BOT_TOKEN = '8070759008:AAEDJwWs0zrQVMO_LgeyoKql_9UgsxW9SXc'
+TELEGRAM_API_URL = 'https://api.telegram.org'
+
+# Alerts are sent when a sensor enters or leaves the critical range,
+# then repeated every ALERT_REMINDER_INTERVAL seconds (0 disables reminders)
+ALERT_REMINDER_INTERVAL = 15 * 60
+ALERT_HYSTERESIS = 0.0  # in sensor units
+ALERT_TIMEOUT = 5  # seconds
+ALERT_RECIPIENTS_TTL = 5 * 60  # seconds
+ALERT_QUEUE_SIZE = 1000
+
+# Readings within this fraction of the critical range from a limit are stored as warnings
+SENSOR_WARNING_BAND = 0.1
+# With a single limit of 0 there is no range to take a fraction of: warn this close to it instead
+SENSOR_WARNING_MARGIN = 1.0
+
+# Rows fetched per server-side cursor round trip in /api/messages/export/
+EXPORT_CHUNK_SIZE = 2000
+
+# Where the ingestion process publishes the latest value of every sensor:
+# 'local' (nothing is kept, /messages/latest/ reads the database), 'redis' (shared, needs the
+# redis package) or 'fake' (in-memory Redis stand-in, visible only inside one process).
+LATEST_VALUE_BACKEND = 'local'
+LATEST_VALUE_REDIS_URL = 'redis://localhost:6379/0'
+
+# Live telemetry for /live/ subscribers: 'mqtt' fans readings out through the broker
+# under LIVE_TOPIC_PREFIX, 'local' only reaches subscribers in the same process
+LIVE_BACKEND = 'mqtt'
+LIVE_TOPIC_PREFIX = 'live'
+LIVE_KEEPALIVE = 15  # seconds between SSE keepalive comments
+LIVE_TICKET_TTL = 30  # seconds a /live/ticket/ ticket is valid for opening a stream
+# While it has subscribers, the web process announces watched controllers this often (seconds);
+# the ingestion process skips live publishing for controllers nobody announced in three intervals
+LIVE_WATCH_INTERVAL = 10
+
+
+# MQTT ingestion
+
+MQTT_BROKER_HOST = 'localhost'
+MQTT_BROKER_PORT = 1883
+
+# Relay commands from the API go through one persistent connection per process
+MQTT_PUBLISH_QOS = 1
+MQTT_PUBLISH_TIMEOUT = 5  # seconds to wait for the broker or a publish acknowledgement
+MQTT_RECONNECT_MIN_DELAY = 1  # seconds, doubled after each failed attempt
+MQTT_RECONNECT_MAX_DELAY = 60
+RELAY_CONTROL_MAX_BATCH = 500
+
+# A relay command counts as acknowledged when the controller echoes its status
+# (with the command_id when the firmware sends it back); after COMMAND_ACK_TIMEOUT
+# seconds it is counted as timed out. wait_for_ack requests block up to this long
+COMMAND_ACK_TIMEOUT = 10
+COMMAND_MAX_PENDING = 10000
+
+# Readings are flushed to the DB when either threshold is reached
+MQTT_BUFFER_SIZE = 500
+MQTT_BUFFER_DELAY = 0.2  # seconds
+# A failed write is retried with doubling delay; while the DB is down at most
+# MQTT_BUFFER_MAX_PENDING readings are kept and the oldest beyond that are dropped
+MQTT_BUFFER_MAX_PENDING = 50000
+MQTT_BUFFER_RETRY_MAX_DELAY = 30  # seconds
+
+# Cached sensors/relays are reloaded after this many seconds
+MQTT_REGISTRY_TTL = 60
+
+# Message handlers run in a thread pool; messages of one controller keep their order
+MQTT_WORKERS = 4
+MQTT_QUEUE_SIZE = 1000
+MQTT_QUEUE_PUT_TIMEOUT = 5  # seconds to wait on a full queue before dropping
+
+# startmqtt runs MQTT_PROCESSES ingestion processes under a supervisor that restarts
+# crashed ones. 'shared' uses MQTT v5 shared subscriptions ($share/<group>/...), the
+# broker balances messages and per-controller order is not kept; 'hash' gives every
+# process all messages and each handles the controllers whose uuid hashes to it
+MQTT_PROCESSES = 1
+MQTT_SCALING_MODE = 'shared'
+MQTT_SHARE_GROUP = 'iot-ingest'
+MQTT_DRAIN_TIMEOUT = 30  # seconds for a worker to flush after SIGTERM before SIGKILL
+
+# 'threads' runs handlers on paho's network thread plus a worker pool, 'asyncio' runs
+# decode/evaluate/batch/write as event loop stages with bounded queues (api/async_ingest.py)
+MQTT_ENGINE = 'threads'
+
+# Prometheus metrics of an ingestion process are served on this port (a worker under
+# the supervisor uses MQTT_METRICS_PORT + its index); None disables the server.
+# The web app serves its own metrics at /metrics
+MQTT_METRICS_PORT = 9101
+# Address the ingestion metrics server binds to; it has no access control of its own
+MQTT_METRICS_ADDR = '127.0.0.1'
+# /metrics of the web app answers only these addresses or networks, or a request
+# with "Authorization: Bearer <METRICS_TOKEN>" when a token is set
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = None
+
+# Ingestion processes log JSON lines ('json') or plain text ('text') from a background
+# thread. Per-reading lines are thinned per key: 1 in MQTT_LOG_SAMPLE_RATE for INFO,
+# at most MQTT_LOG_RATE_LIMIT per MQTT_LOG_RATE_WINDOW seconds up to WARNING; errors always pass
+MQTT_LOG_FORMAT = 'json'
+MQTT_LOG_SAMPLE_RATE = 100
+MQTT_LOG_RATE_LIMIT = 10
+MQTT_LOG_RATE_WINDOW = 60  # seconds
+MQTT_LOG_QUEUE_SIZE = 10000  # records waiting for output; newer ones are dropped when full
+
+# Relay states from MQTT are coalesced and written at most once per interval
+MQTT_RELAY_FLUSH_DELAY = 0.5  # seconds
+
+# Device timestamps: older readings skip the live stream and alerts,
+# timestamps too far in the future are replaced by the receive time
+MQTT_LATE_THRESHOLD = 60  # seconds
+MQTT_MAX_CLOCK_SKEW = 300  # seconds
+
+# Bulk HTTP upload of readings buffered by controllers while offline (POST /ingest/)
+INGEST_MAX_BODY_SIZE = 32 * 1024 * 1024  # bytes, after gzip decompression
+INGEST_BATCH_SIZE = 1000
+INGEST_IDEMPOTENCY_TTL = 7 * 24 * 3600  # seconds to remember Idempotency-Key values
+
+# Controller x-api-key lookups are cached in-process (keyed by SHA-256 of the key);
+# unknown keys are cached for API_KEY_NEGATIVE_TTL and a client sending more than
+# API_KEY_FAILURE_LIMIT invalid keys within API_KEY_FAILURE_WINDOW gets HTTP 429
+API_KEY_CACHE_SIZE = 10000
+API_KEY_CACHE_TTL = 60  # seconds
+API_KEY_NEGATIVE_TTL = 30  # seconds
+API_KEY_FAILURE_LIMIT = 20
+API_KEY_FAILURE_WINDOW = 60  # seconds
+# Only failed checks are limited: a valid key passes even from a throttled address.
+# Behind a reverse proxy, the client address is read from this META header instead of
+# REMOTE_ADDR (for X-Forwarded-For the last entry, the one added by the proxy, is used)
+CLIENT_IP_HEADER = None  # e.g. 'HTTP_X_REAL_IP'
 
 
 # Internationalization
@@ -26,7 +26,7 @@ Including another URLconf
 from django.contrib import admin
 from rest_framework.routers import DefaultRouter
 from django.urls import path, include
-from api.views import CompanyViewSet, UserViewSet, ControllerViewSet, SensorViewSet, MessageViewSet, RelayControlView, RelayViewSet, LatestSensorMessageView
+from api.views import CompanyViewSet, UserViewSet, ControllerViewSet, SensorViewSet, MessageViewSet, RelayControlView, BulkRelayControlView, CommandStatsView, RelayViewSet, LatestSensorMessageView, BulkIngestView, LiveTicketView, live_stream, metrics_view
 
 router = DefaultRouter()
 router.register(r'companies', CompanyViewSet)
@@ -42,5 +42,11 @@ urlpatterns = [
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
     path("control/<slug:controller_uuid>/relay/", RelayControlView.as_view(), name="relay-control"),
+    path("control/relays/", BulkRelayControlView.as_view(), name="relay-control-bulk"),
+    path("control/commands/stats/", CommandStatsView.as_view(), name="command-stats"),
     path('messages/latest/', LatestSensorMessageView.as_view(), name='latest-sensor-message'),
+    path('live/', live_stream, name='live-stream'),
+    path('live/ticket/', LiveTicketView.as_view(), name='live-ticket'),
+    path('ingest/', BulkIngestView.as_view(), name='bulk-ingest'),
+    path('metrics', metrics_view, name='metrics'),
 ]